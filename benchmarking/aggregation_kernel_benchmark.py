@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+User Aggregation Kernel Benchmark
+=================================
+Compares the pandas named-aggregation groupby in `aggregate_user_metrics`
+with the sort-based segment-reduction kernel `aggregate_user_metrics_sorted`
+and the hash-partitioned multiprocess `aggregate_user_metrics_parallel`
+on the data sizes used by `performance_benchmark.py`. The host's CPU count is
+recorded with each row: a parallel speedup is only meaningful with workers on
+separate cores.
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+from etl.etl_pipeline_enhanced import (  # noqa: E402
+    aggregate_user_metrics, aggregate_user_metrics_parallel, aggregate_user_metrics_sorted,
+)
+
+# Same configurations as PerformanceBenchmark.data_sizes
+DATA_SIZES = {
+    "small": {"users": 1000, "sessions": 5000, "content": 100},
+    "medium": {"users": 5000, "sessions": 25000, "content": 500},
+    "large": {"users": 10000, "sessions": 50000, "content": 1000},
+    "xlarge": {"users": 20000, "sessions": 100000, "content": 2000},
+    "xxlarge": {"users": 50000, "sessions": 250000, "content": 5000},
+}
+
+
+def generate_merged(size_config: dict, seed: int = 42) -> pd.DataFrame:
+    """Build a merged sessions frame with the same distributions as the benchmark generator"""
+    rng = np.random.default_rng(seed)
+    users_count, sessions_count, content_count = size_config["users"], size_config["sessions"], size_config["content"]
+    users = pd.DataFrame({
+        "user_id": [f"U{i+1:05d}" for i in range(users_count)],
+        "age": rng.integers(18, 80, users_count),
+        "subscription_type": rng.choice(["Basic", "Standard", "Premium"], users_count, p=[0.4, 0.4, 0.2]),
+        "country": rng.choice(["Argentina", "Mexico", "Brazil", "Chile", "Colombia", "Peru"], users_count),
+    })
+    duration_watched = rng.integers(1, 120, sessions_count)
+    sessions = pd.DataFrame({
+        "session_id": [f"S{i+1:08d}" for i in range(sessions_count)],
+        "user_id": users["user_id"].to_numpy()[rng.integers(0, users_count, sessions_count)],
+        "content_id": [f"C{i:05d}" for i in rng.integers(1, content_count + 1, sessions_count)],
+        "duration_watched": duration_watched,
+        "completion_rate": np.minimum(100, duration_watched / 90 * 100),
+    })
+    return sessions.merge(users, on="user_id", how="left")
+
+
+def best_of(func, df: pd.DataFrame, repeats: int) -> tuple[float, pd.DataFrame]:
+    best, result = float("inf"), None
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = func(df)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark user aggregation kernels")
+    parser.add_argument("--sizes", nargs="+", default=["xxlarge"], choices=list(DATA_SIZES))
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--out", type=str, default=str(REPO / "benchmarking" / "results" / "aggregation_kernel_benchmark.csv"))
+    args = parser.parse_args()
+
+    rows = []
+    for size_name in args.sizes:
+        df = generate_merged(DATA_SIZES[size_name])
+        pandas_s, expected = best_of(aggregate_user_metrics, df, args.repeats)
+        sorted_s, result = best_of(aggregate_user_metrics_sorted, df, args.repeats)
+        pd.testing.assert_frame_equal(result, expected)
+        parallel_s, result = best_of(lambda frame: aggregate_user_metrics_parallel(frame, args.workers), df, args.repeats)
+        pd.testing.assert_frame_equal(result, expected)
+        rows.append({
+            "data_size": size_name,
+            "sessions": len(df),
+            "users": len(expected),
+            "pandas_groupby_s": round(pandas_s, 4),
+            "sorted_kernel_s": round(sorted_s, 4),
+            "speedup": round(pandas_s / sorted_s, 2),
+            "cpus": os.cpu_count(),
+            "workers": args.workers,
+            "parallel_s": round(parallel_s, 4),
+            "parallel_speedup": round(pandas_s / parallel_s, 2),
+        })
+        print(f"{size_name}: pandas {pandas_s:.4f}s, sorted kernel {sorted_s:.4f}s ({pandas_s / sorted_s:.2f}x), "
+              f"parallel x{args.workers} {parallel_s:.4f}s ({pandas_s / parallel_s:.2f}x)")
+
+    # Append, so results of earlier runs (other sizes, kernels, hosts) are kept
+    results = pd.DataFrame(rows)
+    if Path(args.out).exists():
+        results = pd.concat([pd.read_csv(args.out), results], ignore_index=True)
+    results = results.astype({"cpus": "Int64", "workers": "Int64"})
+    results.to_csv(args.out, index=False)
+    print(f"Results appended to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Sample-Fit Clustering Benchmark
+===============================
+Measures the fit-time saving and the quality loss of `cluster_users_sampled`
+(scaler + KMeans fitted on a stratified sample, every user assigned to the
+nearest centroid) against the full fit in `cluster_users`. Quality loss is the
+relative increase of the mean squared distance of all users to their centroid
+(both measured in the full fit's standardized space) and the agreement of the
+two labelings (adjusted Rand index).
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import adjusted_rand_score
+from sklearn.preprocessing import StandardScaler
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+sys.path.insert(0, str(REPO / "benchmarking"))
+
+from aggregation_kernel_benchmark import DATA_SIZES, generate_merged  # noqa: E402
+from etl.etl_pipeline_enhanced import (  # noqa: E402
+    aggregate_user_metrics, cluster_features, cluster_users, cluster_users_sampled,
+)
+
+
+def inertia(X: np.ndarray, labels: np.ndarray) -> float:
+    centroids = np.stack([X[labels == c].mean(axis=0) for c in np.unique(labels)])
+    return float(((X - centroids[np.searchsorted(np.unique(labels), labels)]) ** 2).sum(axis=1).mean())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sample-fit / full-assign clustering")
+    parser.add_argument("--sizes", nargs="+", default=["xlarge", "xxlarge"], choices=list(DATA_SIZES))
+    parser.add_argument("--sample-size", type=int, default=10000)
+    parser.add_argument("--clusters", type=int, default=3)
+    parser.add_argument("--out", type=str, default=str(REPO / "benchmarking" / "results" / "clustering_sample_benchmark.csv"))
+    args = parser.parse_args()
+
+    rows = []
+    for size_name in args.sizes:
+        user_agg = aggregate_user_metrics(generate_merged(DATA_SIZES[size_name]))
+        t0 = time.perf_counter()
+        full, _ = cluster_users(user_agg, args.clusters)
+        full_s = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        sampled, _, info = cluster_users_sampled(user_agg, args.clusters, args.sample_size)
+        sample_s = time.perf_counter() - t0
+
+        X = StandardScaler().fit_transform(user_agg[cluster_features(user_agg)].astype(float).values)
+        full_inertia = inertia(X, full["cluster_kmeans"].to_numpy())
+        sample_inertia = inertia(X, sampled["cluster_kmeans"].to_numpy())
+        rows.append({
+            "data_size": size_name,
+            "users": len(user_agg),
+            "sample_rows": info["sample_rows"],
+            "full_fit_s": round(full_s, 4),
+            "sample_fit_s": round(sample_s, 4),
+            "speedup": round(full_s / sample_s, 2),
+            "inertia_loss_pct": round((sample_inertia / full_inertia - 1) * 100, 3),
+            "adjusted_rand": round(adjusted_rand_score(full["cluster_kmeans"], sampled["cluster_kmeans"]), 4),
+        })
+        print(rows[-1])
+
+    pd.DataFrame(rows).to_csv(args.out, index=False)
+    print(f"Results saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
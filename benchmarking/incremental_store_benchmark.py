@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Incremental User Store Benchmark
+================================
+Replays a sequence of incremental loads against the persisted user aggregate
+store (`update_user_aggregate_store` + `load_user_aggregates`, including the
+compactions they trigger) and compares the time per run with recomputing the
+user aggregates from the whole loaded history (`aggregate_user_metrics`).
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+sys.path.insert(0, str(REPO / "benchmarking"))
+
+import etl.etl_pipeline_enhanced as etl  # noqa: E402
+from aggregation_kernel_benchmark import generate_merged  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the incremental user aggregate store")
+    parser.add_argument("--users", type=int, default=200_000)
+    parser.add_argument("--sessions", type=int, default=2_000_000)
+    parser.add_argument("--content", type=int, default=5000)
+    parser.add_argument("--batch", type=float, default=0.02, help="Sessions per run, as a fraction of the history")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--out", type=str, default=str(REPO / "benchmarking" / "results" / "incremental_store_benchmark.csv"))
+    args = parser.parse_args()
+
+    df = generate_merged({"users": args.users, "sessions": args.sessions, "content": args.content})
+    batch_rows = int(len(df) * args.batch)
+    initial = len(df) - batch_rows * args.runs
+
+    rows = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        etl.PROCESSED_PATH = Path(temp_dir)
+        etl.update_user_aggregate_store(df.iloc[:initial])
+        etl.commit_staged_state()
+        for run in range(args.runs):
+            start = initial + run * batch_rows
+            batch = df.iloc[start:start + batch_rows]
+            t0 = time.perf_counter()
+            touched = etl.update_user_aggregate_store(batch)
+            etl.commit_staged_state()
+            update_s = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            result = etl.load_user_aggregates()
+            load_s = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            expected = etl.aggregate_user_metrics(df.iloc[:start + batch_rows])
+            recompute_s = time.perf_counter() - t0
+            manifest = etl._read_store_manifest()
+            rows.append({
+                "run": run + 1,
+                "sessions": start + batch_rows,
+                "users": len(expected),
+                "batch_sessions": len(batch),
+                "touched_users": touched,
+                "deltas": len(manifest["deltas"]),
+                "compacted": not manifest["deltas"],
+                "update_s": round(update_s, 4),
+                "load_s": round(load_s, 4),
+                "incremental_s": round(update_s + load_s, 4),
+                "recompute_s": round(recompute_s, 4),
+            })
+            print(f"run {run + 1}: {touched} users touched, update {update_s:.3f}s + load {load_s:.3f}s "
+                  f"vs recompute {recompute_s:.3f}s{' (compacted)' if not manifest['deltas'] else ''}")
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    results = pd.DataFrame(rows)
+    results.to_csv(args.out, index=False)
+    incremental, recompute = results["incremental_s"].mean(), results["recompute_s"].mean()
+    print(f"Mean per run: incremental {incremental:.3f}s vs recompute {recompute:.3f}s ({recompute / incremental:.2f}x)")
+    print(f"Results saved to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,9 +14,16 @@ Reflects Phases 1→3 and measures Phase 4:
 from __future__ import annotations
 
 import os
+import math
 import time
 import json
+import pickle
+import hashlib
+import shutil
 import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
 from pathlib import Path
 from dataclasses import dataclass
 from contextlib import contextmanager
@@ -30,10 +37,23 @@ from dotenv import load_dotenv
 # Optional ML imports
 try:
     from sklearn.preprocessing import StandardScaler
-    from sklearn.cluster import KMeans
+    from sklearn.cluster import Birch, KMeans, MiniBatchKMeans
+    from sklearn.ensemble import RandomForestClassifier
 except Exception:  # noqa: BLE001
     StandardScaler = None
     KMeans = None
+    MiniBatchKMeans = None
+    Birch = None
+    RandomForestClassifier = None
+
+try:
+    from scipy import stats as scipy_stats
+    from scipy.cluster import hierarchy as scipy_hierarchy
+    from scipy import sparse as scipy_sparse
+except Exception:  # noqa: BLE001
+    scipy_stats = None
+    scipy_hierarchy = None
+    scipy_sparse = None
 
 # Optional system metrics
 try:
@@ -57,6 +77,8 @@ RAW_PATH = BASE_DIR / "data" / "raw"
 PROCESSED_PATH = BASE_DIR / "data" / "processed"
 LOG_PATH = BASE_DIR / "monitoring"
 BENCHMARK_PATH = BASE_DIR.parent / "benchmarking"
+CHUNK_ROWS = 50000
+PARQUET_ENGINE = "fastparquet"
 
 PROCESSED_PATH.mkdir(parents=True, exist_ok=True)
 LOG_PATH.mkdir(parents=True, exist_ok=True)
@@ -184,6 +206,77 @@ def _mongo_col():
     db = client[os.getenv("MONGO_DB", "streaming")]
     return db[os.getenv("MONGO_COLLECTION_CONTENT", "content")], client
 
+# ---------------- Skew detection -----------------
+# Heavy hitters are tracked while sessions are read, chunk by chunk. A
+# Misra-Gries summary (the mergeable form of Space-Saving) keeps at most k
+# candidate keys with a lower bound on their count, and a Count-Min sketch
+# gives the matching upper bound. Keys above SKEW_THRESHOLD of all rows are
+# salted across shards by the partitioned aggregation.
+SKEW_COLUMNS = ["user_id", "content_id"]
+
+def skew_threshold() -> float:
+    return float(os.getenv("SKEW_THRESHOLD", "0.01"))
+
+@dataclass
+class HeavyHitterSketch:
+    k: int = 64
+    width: int = 4096
+    depth: int = 4
+    total: int = 0
+    counters: pd.Series | None = None
+    table: np.ndarray | None = None
+
+    def __post_init__(self):
+        if self.counters is None:
+            self.counters = pd.Series(dtype=np.int64)
+        if self.table is None:
+            self.table = np.zeros((self.depth, self.width), dtype=np.int64)
+
+    def _buckets(self, keys: pd.Index) -> np.ndarray:
+        values = pd.Series(keys.astype(str))
+        return np.stack([
+            (pd.util.hash_pandas_object(values, index=False, hash_key=f"countmin{row:08d}").to_numpy() % np.uint64(self.width)).astype(np.int64)
+            for row in range(self.depth)
+        ])
+
+    def update(self, keys: pd.Series) -> None:
+        counts = keys.dropna().value_counts()
+        if counts.empty:
+            return
+        self.total += int(counts.sum())
+        buckets = self._buckets(counts.index)
+        for row in range(self.depth):
+            np.add.at(self.table[row], buckets[row], counts.to_numpy())
+        merged = self.counters.add(counts, fill_value=0)
+        if len(merged) > self.k:
+            # Decrement every counter by the (k+1)-th largest and drop the non-positive ones
+            cut = merged.nlargest(self.k + 1).iloc[-1]
+            merged = merged[merged > cut] - cut
+        self.counters = merged.astype(np.int64)
+
+    def estimate(self, keys) -> np.ndarray:
+        buckets = self._buckets(pd.Index(keys))
+        return self.table[np.arange(self.depth)[:, None], buckets].min(axis=0)
+
+    def top(self, n: int | None = None) -> pd.DataFrame:
+        candidates = self.counters.sort_values(ascending=False).head(n or self.k)
+        top = pd.DataFrame({"key": candidates.index, "count_lower": candidates.to_numpy()})
+        top["count_upper"] = self.estimate(top["key"]) if len(top) else np.zeros(0, dtype=np.int64)
+        top["share"] = top["count_upper"] / max(self.total, 1)
+        return top
+
+    def heavy_keys(self, threshold: float) -> list:
+        top = self.top()
+        return top.loc[top["count_lower"] >= threshold * self.total, "key"].tolist()
+
+def skew_metrics(sketches: dict[str, HeavyHitterSketch], threshold: float) -> dict:
+    metrics = {}
+    for column, sketch in sketches.items():
+        top = sketch.top(1)
+        metrics[f"{column}_heavy_keys"] = len(sketch.heavy_keys(threshold))
+        metrics[f"{column}_top_share"] = round(float(top["share"].iloc[0]), 4) if len(top) else 0.0
+    return metrics
+
 def extract_users() -> pd.DataFrame:
     try:
         mode = os.getenv("SOURCE_MODE", "files").lower()
@@ -199,16 +292,23 @@ def extract_users() -> pd.DataFrame:
         send_alert(f"Error extrayendo usuarios: {e}")
         raise
 
-def extract_sessions() -> pd.DataFrame:
+def extract_sessions(sketches: dict[str, HeavyHitterSketch] | None = None) -> pd.DataFrame:
+    sketches = sketches or {}
     try:
         mode = os.getenv("SOURCE_MODE", "files").lower()
         if mode == "database":
             with _pg_conn() as conn:
                 query = os.getenv("POSTGRES_SESSIONS_QUERY", "SELECT * FROM viewing_sessions;")
                 sessions = pd.read_sql_query(query, conn)
+            for column, sketch in sketches.items():
+                sketch.update(sessions[column])
         else:
-            chunks = pd.read_csv(RAW_PATH / "viewing_sessions.csv", chunksize=50000)
-            sessions = pd.concat(chunks, ignore_index=True)
+            frames = []
+            for chunk in pd.read_csv(RAW_PATH / "viewing_sessions.csv", chunksize=CHUNK_ROWS):
+                for column, sketch in sketches.items():
+                    sketch.update(chunk[column])
+                frames.append(chunk)
+            sessions = pd.concat(frames, ignore_index=True)
         logging.info("Sessions extracted: %s", len(sessions))
         return sessions
     except Exception as e:  # noqa: BLE001
@@ -259,23 +359,113 @@ def transform(users: pd.DataFrame, sessions: pd.DataFrame, content: pd.DataFrame
         send_alert(f"Error en transformación: {e}")
         raise
 
+# ---- Phase 2: Sampled profiling ------------------
+# Exploratory runs may profile a reproducible (optionally stratified) sample
+# instead of the full frame. Counts are scaled back to the population and
+# means/counts carry 95% confidence intervals.
+PROFILE_Z = 1.96
+
+@dataclass
+class ProfileSample:
+    frame: pd.DataFrame
+    strata_codes: np.ndarray      # stratum of each sampled row
+    population_sizes: np.ndarray  # N_h per stratum
+    sample_sizes: np.ndarray      # n_h per stratum
+    strata: list[str]
+
+    @property
+    def population_rows(self) -> int:
+        return int(self.population_sizes.sum())
+
+    @property
+    def sample_rows(self) -> int:
+        return len(self.frame)
+
+def profile_settings() -> tuple[int, list[str], int]:
+    size = int(os.getenv("PROFILE_SAMPLE_SIZE", "0") or 0)
+    strata = [c.strip() for c in os.getenv("PROFILE_STRATA", "country,subscription_type").split(",") if c.strip()]
+    seed = int(os.getenv("PROFILE_SEED", "42"))
+    return size, strata, seed
+
+def draw_profile_sample(df: pd.DataFrame, sample_size: int, strata: list[str] | None = None, seed: int = 42) -> ProfileSample | None:
+    n_rows = len(df)
+    if sample_size <= 0 or sample_size >= n_rows:
+        return None
+    keys = [c for c in (strata or []) if c in df.columns]
+    if keys:
+        codes = df.groupby(keys, sort=False, dropna=False).ngroup().to_numpy()
+    else:
+        codes = np.zeros(n_rows, dtype=np.int64)
+    pop = np.bincount(codes)
+    # Proportional allocation, at least one row per stratum
+    alloc = np.clip(np.round(sample_size * pop / n_rows).astype(np.int64), 1, pop)
+    rng = np.random.default_rng(seed)
+    order = np.lexsort((rng.random(n_rows), codes))
+    starts = np.concatenate(([0], np.cumsum(pop)[:-1]))
+    rank = np.arange(n_rows) - starts[codes[order]]
+    chosen = np.sort(order[rank < alloc[codes[order]]])
+    logging.info("Profile sample: %s of %s rows (strata=%s)", len(chosen), n_rows, keys or "uniform")
+    return ProfileSample(
+        frame=df.iloc[chosen],
+        strata_codes=codes[chosen],
+        population_sizes=pop,
+        sample_sizes=alloc,
+        strata=keys,
+    )
+
+def _stratified_mean(values: pd.DataFrame, sample: ProfileSample) -> tuple[pd.Series, pd.Series]:
+    """Stratified estimate of each column's population mean and its standard error."""
+    grouped = values.groupby(sample.strata_codes)
+    n_h = grouped.count()
+    mean_h = grouped.mean()
+    var_h = grouped.var(ddof=1).fillna(0.0)
+    pop_h = pd.Series(sample.population_sizes, dtype=float).reindex(n_h.index)
+    # Strata without observed values drop out and the remaining weights are renormalised
+    w_h = mean_h.notna().mul(pop_h, axis=0)
+    w_h = w_h / w_h.sum().replace(0, np.nan)
+    fpc = (1 - n_h.div(pop_h, axis=0)).clip(lower=0)
+    mean = (mean_h * w_h).sum(min_count=1)
+    se = np.sqrt((var_h * w_h**2 * fpc / n_h.where(n_h > 0)).sum(min_count=1))
+    return mean, se
+
+def _estimated_totals(flags: pd.DataFrame, sample: ProfileSample) -> pd.DataFrame:
+    share, se = _stratified_mean(flags.astype(float), sample)
+    total = share * sample.population_rows
+    half = PROFILE_Z * se * sample.population_rows
+    return pd.DataFrame({
+        "estimate": total.round().astype("Int64"),
+        "ci_lower": (total - half).clip(lower=0).round().astype("Int64"),
+        "ci_upper": (total + half).clip(upper=sample.population_rows).round().astype("Int64"),
+    })
+
 # ---- Phase 2: Descriptives, DQ, Outliers --------
 
 def _numeric_columns(df: pd.DataFrame) -> list[str]:
     return [c for c in df.columns if pd.api.types.is_numeric_dtype(df[c])]
 
-def generate_descriptive_stats(df: pd.DataFrame, name: str) -> Path:
+def generate_descriptive_stats(df: pd.DataFrame, name: str, sample: ProfileSample | None = None) -> Path:
     out = PROCESSED_PATH / f"{name}_descriptive_stats.csv"
-    cols = _numeric_columns(df)
-    (df[cols].describe() if cols else df.describe(include='all')).to_csv(out)
+    frame = sample.frame if sample is not None else df
+    cols = _numeric_columns(frame)
+    stats = frame[cols].describe() if cols else frame.describe(include='all')
+    if sample is not None and cols:
+        mean, se = _stratified_mean(frame[cols], sample)
+        counts = _estimated_totals(frame[cols].notna(), sample)
+        stats.loc["sample_count"] = stats.loc["count"]
+        stats.loc["count"] = counts["estimate"].astype(float)
+        stats.loc["mean"] = mean
+        stats.loc["mean_ci_lower"] = mean - PROFILE_Z * se
+        stats.loc["mean_ci_upper"] = mean + PROFILE_Z * se
+    stats.to_csv(out)
     logging.info("Descriptive stats saved: %s", out)
     return out
 
-def generate_data_quality_report(df: pd.DataFrame, name: str) -> Path:
+def generate_data_quality_report(df: pd.DataFrame, name: str, sample: ProfileSample | None = None) -> Path:
     out = PROCESSED_PATH / f"{name}_data_quality.csv"
+    frame = sample.frame if sample is not None else df
     rows = []
-    for col in df.columns:
-        s = df[col]
+    for col in frame.columns:
+        s = frame[col]
         try:
             unique_count = int(s.nunique(dropna=True))
         except TypeError:
@@ -287,27 +477,478 @@ def generate_data_quality_report(df: pd.DataFrame, name: str) -> Path:
             "null_pct": round(float(s.isna().mean())*100, 2),
             "unique_count": unique_count,
         })
-    pd.DataFrame(rows).to_csv(out, index=False)
+    report = pd.DataFrame(rows)
+    if sample is not None and not report.empty:
+        # unique_count stays a sample figure: distinct counts do not scale linearly
+        nulls = _estimated_totals(frame.isna(), sample)
+        report["null_count"] = nulls["estimate"].to_numpy()
+        report["null_count_ci_lower"] = nulls["ci_lower"].to_numpy()
+        report["null_count_ci_upper"] = nulls["ci_upper"].to_numpy()
+        report["null_pct"] = (report["null_count"].astype(float) / sample.population_rows * 100).round(2)
+        report["sample_rows"] = sample.sample_rows
+        report["population_rows"] = sample.population_rows
+    report.to_csv(out, index=False)
     logging.info("Data quality saved: %s", out)
     return out
 
-def detect_outliers_iqr(df: pd.DataFrame, name: str) -> Path:
-    out = PROCESSED_PATH / f"{name}_outliers_iqr.csv"
-    cols = _numeric_columns(df)
-    rows = []
-    for col in cols:
-        s = df[col].dropna()
-        if s.empty:
-            continue
-        q1, q3 = np.percentile(s, [25, 75])
+def _float_block(df: pd.DataFrame, cols: list[str]) -> np.ndarray:
+    return df[cols].to_numpy(dtype=float, na_value=np.nan)
+
+def iqr_outlier_kernel(values: np.ndarray, k: float = 1.5) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Column-wise IQR bounds and outlier mask for a 2-D float block (NaN = missing)."""
+    lower = np.full(values.shape[1], np.nan)
+    upper = np.full(values.shape[1], np.nan)
+    valid = ~np.isnan(values).all(axis=0)
+    if valid.any():
+        q1, q3 = np.nanpercentile(values[:, valid], [25, 75], axis=0)
         iqr = q3 - q1
-        lower, upper = q1 - 1.5*iqr, q3 + 1.5*iqr
-        rows.append({"column": col, "lower": lower, "upper": upper, "outliers_count": int(((df[col] < lower) | (df[col] > upper)).sum())})
-    pd.DataFrame(rows).to_csv(out, index=False)
+        lower[valid] = q1 - k*iqr
+        upper[valid] = q3 + k*iqr
+    mask = (values < lower) | (values > upper)
+    return lower, upper, mask
+
+def detect_outliers_iqr(df: pd.DataFrame, name: str, sample: ProfileSample | None = None) -> Path:
+    out = PROCESSED_PATH / f"{name}_outliers_iqr.csv"
+    frame = sample.frame if sample is not None else df
+    cols = [c for c in _numeric_columns(frame) if c != OUTLIER_FLAGS_COLUMN]
+    lower, upper, mask = iqr_outlier_kernel(_float_block(frame, cols))
+    keep = ~np.isnan(lower)
+    report = pd.DataFrame({
+        "column": np.array(cols, dtype=object)[keep],
+        "lower": lower[keep],
+        "upper": upper[keep],
+        "outliers_count": mask[:, keep].sum(axis=0).astype(int),
+    })
+    if sample is not None and not report.empty:
+        totals = _estimated_totals(pd.DataFrame(mask[:, keep], columns=report["column"].tolist()), sample)
+        report["outliers_count"] = totals["estimate"].to_numpy()
+        report["outliers_count_ci_lower"] = totals["ci_lower"].to_numpy()
+        report["outliers_count_ci_upper"] = totals["ci_upper"].to_numpy()
+        report["sample_rows"] = sample.sample_rows
+        report["population_rows"] = sample.population_rows
+    report.to_csv(out, index=False)
     logging.info("Outliers report saved: %s", out)
     return out
 
+# ---- Row-level outlier flags ---------------------
+# Bit i of OUTLIER_FLAGS_COLUMN is set when the row is an IQR outlier in the
+# i-th column listed in outlier_flags_columns.json. The list only grows, so
+# bits keep their meaning across incremental loads.
+OUTLIER_FLAGS_COLUMN = "outlier_flags"
+OUTLIER_BITS_FILE = "outlier_flags_columns.json"
+MAX_OUTLIER_BITS = 64
+
+def outlier_bit_columns(cols: list[str]) -> list[str]:
+    path = PROCESSED_PATH / OUTLIER_BITS_FILE
+    bit_columns = json.loads(path.read_text(encoding="utf-8")) if path.exists() else []
+    added = [c for c in cols if c not in bit_columns]
+    if added:
+        room = MAX_OUTLIER_BITS - len(bit_columns)
+        if len(added) > room:
+            logging.warning("Outlier flags limited to %s columns; skipped %s", MAX_OUTLIER_BITS, added[room:])
+        bit_columns += added[:room]
+        path.write_text(json.dumps(bit_columns, indent=2), encoding="utf-8")
+    return bit_columns
+
+def pack_outlier_bits(mask: np.ndarray) -> np.ndarray:
+    n_bits = mask.shape[1]
+    dtype = np.uint8 if n_bits <= 8 else np.uint16 if n_bits <= 16 else np.uint32 if n_bits <= 32 else np.uint64
+    if n_bits == 0:
+        return np.zeros(len(mask), dtype=dtype)
+    shifted = mask.astype(dtype) << np.arange(n_bits, dtype=dtype)
+    return np.bitwise_or.reduce(shifted, axis=1)
+
+def add_outlier_flags(df: pd.DataFrame) -> pd.DataFrame:
+    cols = [c for c in _numeric_columns(df) if c != OUTLIER_FLAGS_COLUMN]
+    bit_columns = outlier_bit_columns(cols)
+    present = [i for i, c in enumerate(bit_columns) if c in df.columns]
+    mask = np.zeros((len(df), len(bit_columns)), dtype=bool)
+    _, _, mask[:, present] = iqr_outlier_kernel(_float_block(df, [bit_columns[i] for i in present]))
+    df = df.copy()
+    df[OUTLIER_FLAGS_COLUMN] = pack_outlier_bits(mask)
+    logging.info("Outlier flags: %s filas marcadas", int((df[OUTLIER_FLAGS_COLUMN] > 0).sum()))
+    return df
+
+# ---- Phase 2: Streaming correlation -------------
+# Mergeable (n, mean, co-moment) accumulators with listwise deletion, as in the
+# notebook's df[vars].dropna().corr(). Session state is persisted so each run
+# only folds the rows appended by load_incremental.
+SESSION_CORR_FEATURES = ["duration_watched", "completion_rate", "age", "release_year", "rating"]
+USER_CORR_FEATURES = ["sessions_count", "avg_duration", "duration_std", "avg_completion", "completion_std", "unique_content", "age", "subscription_numeric"]
+
+def _state_dir() -> Path:
+    path = PROCESSED_PATH / "state"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+# Run marker: the dedup history and every state folded from the new rows are
+# written under PROCESSED_PATH/staging and promoted together at the end of the
+# run. A crash before the promote leaves the committed files untouched (the
+# rows load again as new); a crash during it is rolled forward from the manifest.
+STAGING_DIR = "staging"
+STAGING_MANIFEST = "manifest.json"
+
+def _staging_dir() -> Path:
+    return PROCESSED_PATH / STAGING_DIR
+
+def _staged(path: Path) -> Path:
+    staged = _staging_dir() / Path(path).relative_to(PROCESSED_PATH)
+    staged.parent.mkdir(parents=True, exist_ok=True)
+    return staged
+
+def _current(path: Path) -> Path:
+    staged = _staging_dir() / Path(path).relative_to(PROCESSED_PATH)
+    return staged if staged.exists() else path
+
+def _current_glob(directory: Path, pattern: str) -> list[Path]:
+    staged = _staging_dir() / directory.relative_to(PROCESSED_PATH)
+    names = {p.name for p in directory.glob(pattern)} | {p.name for p in staged.glob(pattern)}
+    return [_current(directory / name) for name in sorted(names)]
+
+def _promote_staged(files: list[str]) -> int:
+    for name in files:
+        source = _staging_dir() / name
+        if source.exists():
+            target = PROCESSED_PATH / name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(source, target)
+    shutil.rmtree(_staging_dir(), ignore_errors=True)
+    return len(files)
+
+def commit_staged_state() -> int:
+    staging = _staging_dir()
+    if not staging.exists():
+        return 0
+    files = sorted(str(p.relative_to(staging)) for p in staging.rglob("*") if p.is_file() and p.name != STAGING_MANIFEST)
+    manifest = staging / STAGING_MANIFEST
+    manifest.with_suffix(".tmp").write_text(json.dumps(files), encoding="utf-8")
+    os.replace(manifest.with_suffix(".tmp"), manifest)
+    promoted = _promote_staged(files)
+    logging.info("Estado de la carga confirmado: %s ficheros", promoted)
+    return promoted
+
+def recover_staged_state() -> str:
+    manifest = _staging_dir() / STAGING_MANIFEST
+    if manifest.exists():
+        promoted = _promote_staged(json.loads(manifest.read_text(encoding="utf-8")))
+        logging.warning("Confirmación interrumpida completada: %s ficheros", promoted)
+        return "rolled_forward"
+    if _staging_dir().exists():
+        shutil.rmtree(_staging_dir())
+        logging.warning("Staging de una ejecución interrumpida descartado; sus filas se recargarán")
+        return "discarded"
+    return "clean"
+
+def _two_sided_p(t: np.ndarray, dof: np.ndarray | float) -> np.ndarray:
+    t = np.abs(np.asarray(t, dtype=float))
+    if scipy_stats is not None:
+        return 2 * scipy_stats.t.sf(t, dof)
+    # Normal approximation when scipy is not installed
+    return np.vectorize(math.erfc)(t / math.sqrt(2))
+
+def _correlation_strength(r: np.ndarray) -> np.ndarray:
+    labels = np.array(["negligible", "weak", "moderate", "strong", "very strong"], dtype=object)
+    return labels[np.searchsorted([0.1, 0.3, 0.5, 0.7], np.abs(r), side="right")]
+
+@dataclass
+class CoMomentAccumulator:
+    columns: list[str]
+    n: int = 0
+    mean: np.ndarray | None = None
+    comoment: np.ndarray | None = None
+
+    def __post_init__(self):
+        k = len(self.columns)
+        if self.mean is None:
+            self.mean = np.zeros(k)
+        if self.comoment is None:
+            self.comoment = np.zeros((k, k))
+
+    def _combine(self, n_b: int, mean_b: np.ndarray, comoment_b: np.ndarray) -> None:
+        if n_b == 0:
+            return
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.comoment = self.comoment + comoment_b + np.outer(delta, delta) * (self.n * n_b / n)
+        self.mean = self.mean + delta * (n_b / n)
+        self.n = n
+
+    def update(self, values: np.ndarray) -> None:
+        values = values[~np.isnan(values).any(axis=1)]
+        if len(values):
+            mean_b = values.mean(axis=0)
+            centered = values - mean_b
+            self._combine(len(values), mean_b, centered.T @ centered)
+
+    def update_frame(self, df: pd.DataFrame, chunk_rows: int = CHUNK_ROWS) -> None:
+        for start in range(0, len(df), chunk_rows):
+            self.update(_float_block(df.iloc[start:start + chunk_rows], self.columns))
+
+    def merge(self, other: "CoMomentAccumulator") -> None:
+        if other.columns != self.columns:
+            raise ValueError("Cannot merge accumulators over different columns")
+        self._combine(other.n, other.mean, other.comoment)
+
+    def correlation(self) -> pd.DataFrame:
+        scale = np.sqrt(np.diag(self.comoment))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = self.comoment / np.outer(scale, scale)
+        return pd.DataFrame(np.clip(r, -1, 1), index=self.columns, columns=self.columns)
+
+    def significance(self) -> pd.DataFrame:
+        r = self.correlation().to_numpy()
+        i, j = np.triu_indices(len(self.columns), k=1)
+        r_ij = r[i, j]
+        dof = max(self.n - 2, 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_stat = r_ij * np.sqrt(dof / (1 - r_ij**2))
+        p_value = _two_sided_p(t_stat, dof)
+        return pd.DataFrame({
+            "var1": np.array(self.columns, dtype=object)[i],
+            "var2": np.array(self.columns, dtype=object)[j],
+            "r": r_ij,
+            "n": self.n,
+            "t_stat": t_stat,
+            "p_value": p_value,
+            "significant": p_value < 0.05,
+            "strength": _correlation_strength(r_ij),
+        })
+
+    def save(self, path: Path) -> None:
+        np.savez(path, columns=np.array(self.columns), n=self.n, mean=self.mean, comoment=self.comoment)
+
+    @classmethod
+    def load(cls, path: Path) -> "CoMomentAccumulator | None":
+        if not path.exists():
+            return None
+        with np.load(path) as state:
+            return cls(columns=state["columns"].tolist(), n=int(state["n"]), mean=state["mean"], comoment=state["comoment"])
+
+def correlations_from_frame(df: pd.DataFrame, features: list[str]) -> CoMomentAccumulator:
+    acc = CoMomentAccumulator([c for c in features if c in df.columns])
+    acc.update_frame(df)
+    return acc
+
+def update_session_correlations(new_rows: pd.DataFrame) -> CoMomentAccumulator:
+    state_file = _state_dir() / "session_comoments.npz"
+    columns = [c for c in SESSION_CORR_FEATURES if c in new_rows.columns]
+    acc = CoMomentAccumulator.load(_current(state_file))
+    if acc is None or acc.columns != columns:
+        # First run or feature set changed: rebuild once from the loaded history
+        history = _current(PROCESSED_PATH / "streaming_data.parquet")
+        acc = CoMomentAccumulator(columns)
+        if history.exists():
+            acc.update_frame(pd.read_parquet(history, columns=columns))
+        logging.info("Session co-moments rebuilt from history: %s filas", acc.n)
+    else:
+        acc.update_frame(new_rows)
+    acc.save(_staged(state_file))
+    return acc
+
+def export_correlations(acc: CoMomentAccumulator, name: str) -> Path:
+    out = PROCESSED_PATH / f"{name}_correlation_matrix.csv"
+    acc.correlation().round(4).to_csv(out)
+    acc.significance().to_csv(PROCESSED_PATH / f"{name}_correlation_tests.csv", index=False)
+    logging.info("Correlation analysis saved: %s (n=%s)", out, acc.n)
+    return out
+
+# ---- Phase 2: Batch hypothesis testing ----------
+# Sufficient statistics (n, mean, M2) come from one groupby at the finest
+# segment grain; every coarser segmentation is rolled up from that table and
+# all segment pairs are tested at once with Welch's t-test.
+HYPOTHESIS_DIMENSIONS = ["country", "subscription_type", "cluster_kmeans"]
+HYPOTHESIS_METRICS = ["duration_watched", "completion_rate"]
+
+def _effect_size_label(d: np.ndarray) -> np.ndarray:
+    labels = np.array(["negligible", "small", "medium", "large"], dtype=object)
+    return labels[np.searchsorted([0.2, 0.5, 0.8], np.abs(d), side="right")]
+
+def holm_adjust(p_values: np.ndarray) -> np.ndarray:
+    p_values = np.asarray(p_values, dtype=float)
+    m = len(p_values)
+    order = np.argsort(p_values)
+    adjusted = np.maximum.accumulate((m - np.arange(m)) * p_values[order])
+    out = np.empty(m)
+    out[order] = np.minimum(adjusted, 1.0)
+    return out
+
+def benjamini_hochberg_adjust(p_values: np.ndarray) -> np.ndarray:
+    p_values = np.asarray(p_values, dtype=float)
+    m = len(p_values)
+    order = np.argsort(p_values)
+    scaled = p_values[order] * m / np.arange(1, m + 1)
+    adjusted = np.minimum.accumulate(scaled[::-1])[::-1]
+    out = np.empty(m)
+    out[order] = np.minimum(adjusted, 1.0)
+    return out
+
+def segment_statistics(df: pd.DataFrame, dimensions: list[str], metric: str) -> pd.DataFrame:
+    stats = df.groupby(dimensions, observed=True)[metric].agg(n="count", mean="mean", var="var").reset_index()
+    stats["m2"] = stats["var"].fillna(0.0) * (stats["n"] - 1)
+    return stats[stats["n"] > 0].drop(columns="var")
+
+def rollup_segment_statistics(fine: pd.DataFrame, keys: list[str]) -> pd.DataFrame:
+    by = [fine[k] for k in keys]
+    n = fine["n"].groupby(by, observed=True).transform("sum")
+    mean = (fine["n"] * fine["mean"]).groupby(by, observed=True).transform("sum") / n
+    parts = fine[keys].assign(n=fine["n"], weighted=fine["n"] * fine["mean"], m2=fine["m2"] + fine["n"] * (fine["mean"] - mean) ** 2)
+    rolled = parts.groupby(keys, observed=True).sum().reset_index()
+    rolled["mean"] = rolled.pop("weighted") / rolled["n"]
+    return rolled
+
+def welch_pairwise_tests(stats: pd.DataFrame, keys: list[str], min_n: int = 2) -> pd.DataFrame:
+    stats = stats[stats["n"] >= min_n].reset_index(drop=True)
+    labels = stats[keys].astype(str).apply(lambda col: col.name + "=" + col).agg("|".join, axis=1) if len(stats) else pd.Series(dtype=object)
+    i, j = np.triu_indices(len(stats), k=1)
+    n = stats["n"].to_numpy(dtype=float)
+    mean = stats["mean"].to_numpy()
+    var = stats["m2"].to_numpy() / (n - 1)
+    se_i, se_j = var[i] / n[i], var[j] / n[j]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_stat = (mean[i] - mean[j]) / np.sqrt(se_i + se_j)
+        dof = (se_i + se_j) ** 2 / (se_i**2 / (n[i] - 1) + se_j**2 / (n[j] - 1))
+        pooled = np.sqrt(((n[i] - 1) * var[i] + (n[j] - 1) * var[j]) / (n[i] + n[j] - 2))
+        cohens_d = (mean[i] - mean[j]) / pooled
+    p_value = _two_sided_p(t_stat, dof)
+    return pd.DataFrame({
+        "dimensions": "+".join(keys),
+        "segment_a": labels.to_numpy()[i],
+        "segment_b": labels.to_numpy()[j],
+        "n_a": n[i].astype(int),
+        "n_b": n[j].astype(int),
+        "mean_a": mean[i],
+        "mean_b": mean[j],
+        "t_stat": t_stat,
+        "dof": dof,
+        "p_value": p_value,
+        "cohens_d": cohens_d,
+        "effect_size": _effect_size_label(cohens_d),
+    })
+
+def run_segment_hypothesis_tests(df: pd.DataFrame, user_clusters: pd.DataFrame, min_n: int = 2, alpha: float = 0.05) -> pd.DataFrame:
+    frame = df[[c for c in ["user_id", *HYPOTHESIS_DIMENSIONS, *HYPOTHESIS_METRICS] if c in df.columns]]
+    if "cluster_kmeans" in user_clusters.columns:
+        frame = frame.assign(cluster_kmeans=frame["user_id"].map(user_clusters.set_index("user_id")["cluster_kmeans"]))
+    dimensions = [d for d in HYPOTHESIS_DIMENSIONS if d in frame.columns]
+    results = []
+    for metric in [m for m in HYPOTHESIS_METRICS if m in frame.columns]:
+        fine = segment_statistics(frame, dimensions, metric)
+        for size in range(1, len(dimensions) + 1):
+            for keys in combinations(dimensions, size):
+                stats = fine if len(keys) == len(dimensions) else rollup_segment_statistics(fine, list(keys))
+                results.append(welch_pairwise_tests(stats, list(keys), min_n).assign(metric=metric))
+    tests = pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+    if tests.empty:
+        return tests
+    valid = tests["p_value"].notna()
+    tests.loc[valid, "p_holm"] = holm_adjust(tests.loc[valid, "p_value"].to_numpy())
+    tests.loc[valid, "p_fdr_bh"] = benjamini_hochberg_adjust(tests.loc[valid, "p_value"].to_numpy())
+    tests["significant"] = tests["p_fdr_bh"] < alpha
+    return tests[["metric", *[c for c in tests.columns if c != "metric"]]]
+
+def export_hypothesis_tests(tests: pd.DataFrame) -> Path:
+    out = PROCESSED_PATH / "hypothesis_tests.csv"
+    tests.to_csv(out, index=False)
+    logging.info("Hypothesis tests saved: %s (%s tests)", out, len(tests))
+    return out
+
+# ---- Phase 2: Time-series rollups ---------------
+# Append-only daily rollup of additive session measures by watch_date (and
+# ROLLUP_DIMENSIONS). Each run folds only the newly loaded sessions, so just
+# the days they touch change; weekly series and the decomposition read the
+# compact rollup instead of the session history.
+DAILY_ROLLUP_FILE = "session_daily_rollup.parquet"
+WEEKLY_ROLLUP_FILE = "session_weekly_rollup.parquet"
+ROLLUP_MEASURES = ["duration_watched", "completion_rate"]
+
+def rollup_dimensions() -> list[str]:
+    return [c.strip() for c in os.getenv("ROLLUP_DIMENSIONS", "country,content_type").split(",") if c.strip()]
+
+def daily_session_rollup(df: pd.DataFrame, dimensions: list[str]) -> pd.DataFrame:
+    keys = pd.DataFrame({"watch_date": pd.to_datetime(df["watch_date"], errors="coerce").dt.normalize()}, index=df.index)
+    for dim in dimensions:
+        keys[dim] = df[dim].astype("string").fillna("Unknown") if dim in df.columns else "Unknown"
+    frame = keys.assign(sessions=1)
+    for col in ROLLUP_MEASURES:
+        if col in df.columns:
+            frame[f"{col}_sum"] = df[col].fillna(0)
+            frame[f"{col}_count"] = df[col].notna().astype(int)
+    return frame.dropna(subset=["watch_date"]).groupby(["watch_date", *dimensions], observed=True).sum().reset_index()
+
+def update_daily_rollup(new_rows: pd.DataFrame, dimensions: list[str] | None = None) -> pd.DataFrame:
+    dimensions = rollup_dimensions() if dimensions is None else dimensions
+    out = PROCESSED_PATH / DAILY_ROLLUP_FILE
+    keys = ["watch_date", *dimensions]
+    existing = pd.read_parquet(_current(out)) if _current(out).exists() else None
+    if existing is None or [c for c in existing.columns if c in keys] != keys:
+        # First run or dimensions changed: rebuild once from the loaded history
+        history = _current(PROCESSED_PATH / "streaming_data.parquet")
+        source = pd.read_parquet(history) if history.exists() else new_rows
+        daily = daily_session_rollup(source, dimensions)
+        logging.info("Daily rollup rebuilt from history: %s filas", len(daily))
+    elif new_rows.empty or "watch_date" not in new_rows.columns:
+        return existing
+    else:
+        delta = daily_session_rollup(new_rows, dimensions)
+        daily = pd.concat([existing, delta], ignore_index=True).groupby(keys, observed=True).sum().reset_index()
+        logging.info("Daily rollup: %s días actualizados", delta["watch_date"].nunique())
+    daily.to_parquet(_staged(out), index=False, engine=PARQUET_ENGINE)
+    return daily
+
+def weekly_session_rollup(daily: pd.DataFrame) -> pd.DataFrame:
+    dimensions = [c for c in daily.columns if c not in ("watch_date", "sessions") and not c.endswith(("_sum", "_count"))]
+    week = daily["watch_date"].dt.to_period("W").dt.start_time.rename("week")
+    measures = daily.drop(columns=["watch_date", *dimensions])
+    return measures.groupby([week, *[daily[d] for d in dimensions]], observed=True).sum().reset_index()
+
+def seasonal_decomposition(series: pd.Series, periods: tuple[int, ...] = (4, 12, 26)) -> pd.DataFrame:
+    """Additive moving-average decomposition (as statsmodels' seasonal_decompose)."""
+    period = next((p for p in periods if len(series) >= 2 * p), None)
+    if period is None:
+        return pd.DataFrame()
+    values = series.to_numpy(dtype=float)
+    if period % 2 == 0:
+        weights = np.r_[0.5, np.ones(period - 1), 0.5] / period
+    else:
+        weights = np.ones(period) / period
+    half = len(weights) // 2
+    trend = np.full(len(values), np.nan)
+    trend[half:len(values) - half] = np.convolve(values, weights, mode="valid")
+    detrended = values - trend
+    phase = np.arange(len(values)) % period
+    phase_means = np.array([np.nanmean(detrended[phase == k]) for k in range(period)])
+    seasonal = (phase_means - phase_means.mean())[phase]
+    return pd.DataFrame({
+        "observed": values,
+        "trend": trend,
+        "seasonal": seasonal,
+        "resid": values - trend - seasonal,
+        "period": period,
+    }, index=series.index).reset_index()
+
+def export_session_rollups(daily: pd.DataFrame) -> pd.DataFrame:
+    weekly = weekly_session_rollup(daily)
+    out = PROCESSED_PATH / WEEKLY_ROLLUP_FILE
+    weekly.to_parquet(out, index=False, engine=PARQUET_ENGINE)
+    logging.info("Session rollups saved: %s (%s filas diarias, %s semanales)", out, len(daily), len(weekly))
+    return weekly
+
+def export_seasonal_decomposition(weekly: pd.DataFrame) -> Path:
+    out = PROCESSED_PATH / "sessions_weekly_decomposition.csv"
+    sessions = weekly.groupby("week")["sessions"].sum()
+    if not sessions.empty:
+        sessions = sessions.asfreq("W-MON", fill_value=0)
+    decomposition = seasonal_decomposition(sessions)
+    if decomposition.empty:
+        logging.warning("Insufficient weeks for seasonal decomposition (%s)", len(sessions))
+    decomposition.to_csv(out, index=False)
+    return out
+
 # ---------------- Aggregate (user level) ----------
+SUBSCRIPTION_MAP = {"Basic": 1, "Standard": 2, "Premium": 3}
+
+def aggregation_mode() -> str:
+    return os.getenv("AGGREGATION_MODE", "pandas").lower()
 
 def aggregate_user_metrics(df: pd.DataFrame) -> pd.DataFrame:
     duration_col = "duration_watched"
@@ -324,19 +965,982 @@ def aggregate_user_metrics(df: pd.DataFrame) -> pd.DataFrame:
         subscription_type=("subscription_type", "first"),
         country=("country", "first"),
     ).reset_index().fillna(0)
-    subscription_map = {"Basic": 1, "Standard": 2, "Premium": 3}
-    user_agg["subscription_numeric"] = user_agg["subscription_type"].map(subscription_map).fillna(1).astype(int)
+    user_agg["subscription_numeric"] = user_agg["subscription_type"].map(SUBSCRIPTION_MAP).fillna(1).astype(int)
+    return user_agg
+
+# Sort-based kernel: factorize user_id once, sort once and compute every
+# aggregate with segment reductions over the sorted rows. Distinct content is
+# counted on sorted (user, content) code pairs instead of a hash nunique.
+def _segment_first(values: pd.Series, rows: np.ndarray, starts: np.ndarray) -> pd.Series:
+    # rows are stably sorted by user, so the first non-null row of a segment is its smallest row number
+    candidates = np.where(values.notna().to_numpy()[rows], rows, len(values))
+    first = np.minimum.reduceat(candidates, starts) if len(starts) else np.array([], dtype=np.int64)
+    found = first < len(values)
+    return values.iloc[np.minimum(first, max(len(values) - 1, 0))].reset_index(drop=True).where(found)
+
+def aggregate_user_metrics_sorted(df: pd.DataFrame) -> pd.DataFrame:
+    codes, users = pd.factorize(df["user_id"])
+    # Order codes like groupby's sorted keys; sorting the uniques is cheaper than factorize(sort=True)
+    order = np.asarray(users.argsort())
+    rank = np.empty(len(users), dtype=np.int64)
+    rank[order] = np.arange(len(users))
+    users = users[order]
+    rows = np.flatnonzero(codes >= 0)
+    codes = rank[codes[rows]]
+    # Unique (code, row) keys make the fast unstable sort equivalent to a stable one
+    sort_order = np.argsort(codes * len(df) + rows)
+    rows, sorted_codes = rows[sort_order], codes[sort_order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(rows) else np.array([], dtype=np.int64)
+    sizes = np.diff(np.r_[starts, len(rows)])
+    user_agg = pd.DataFrame({"user_id": users})
+
+    def reduce(values: np.ndarray) -> np.ndarray:
+        return np.add.reduceat(values, starts) if len(starts) else np.zeros(0, dtype=values.dtype)
+
+    user_agg["sessions_count"] = reduce(df["session_id"].notna().to_numpy()[rows].astype(np.int64))
+    for name, col in USER_MEASURES.items():
+        x = df[col].to_numpy(dtype=float, na_value=np.nan)[rows]
+        present = ~np.isnan(x)
+        n = reduce(present.astype(np.int64))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = reduce(np.where(present, x, 0.0)) / n
+            m2 = reduce(np.where(present, (x - np.repeat(mean, sizes)) ** 2, 0.0))
+            user_agg[f"avg_{name}"] = mean
+            user_agg[f"{name}_std"] = np.where(n > 1, np.sqrt(m2 / (n - 1)), np.nan)
+
+    content_codes, content = pd.factorize(df["content_id"])
+    width = max(len(content), 1)
+    content_codes = content_codes[rows]
+    has_content = content_codes >= 0
+    pairs = np.sort(sorted_codes[has_content].astype(np.int64) * width + content_codes[has_content])
+    distinct = pairs[np.r_[True, pairs[1:] != pairs[:-1]]] if len(pairs) else pairs
+    user_agg["unique_content"] = np.bincount(distinct // width, minlength=len(users))
+
+    for col in USER_ATTRIBUTES:
+        user_agg[col] = _segment_first(df[col], rows, starts) if col in df.columns else np.nan
+    user_agg = user_agg.fillna(0)
+    user_agg["subscription_numeric"] = user_agg["subscription_type"].map(SUBSCRIPTION_MAP).fillna(1).astype(int)
+    return user_agg
+
+# Streaming variant: per-user mergeable state folded chunk by chunk. Means and
+# M2 are combined with Chan's parallel form of Welford's update, distinct
+# content is kept as exact per-user content sets and demographics keep the
+# first non-null value seen, matching groupby "first".
+USER_MEASURES = {"duration": "duration_watched", "completion": "completion_rate"}
+USER_ATTRIBUTES = ["age", "subscription_type", "country"]
+USER_CONTENT_SETS_FILE = "user_content_sets.npz"
+
+def _gather(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    # Positions of the concatenated slices [start, start + length)
+    offsets = np.r_[0, np.cumsum(lengths)[:-1]] if len(lengths) else np.zeros(0, dtype=np.int64)
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum(), dtype=np.int64)
+
+def _id_array(ids) -> np.ndarray:
+    # Numeric ids are saved with their dtype (not as text) so they round-trip
+    # and still match the ids read back from Parquet; anything else as unicode
+    ids = pd.Index(ids)
+    return ids.to_numpy() if ids.dtype.kind in "iuf" else np.asarray(ids, dtype=str)
+
+def _id_index(values: np.ndarray, name: str | None = None) -> pd.Index:
+    return pd.Index(values, name=name)
+
+def _distinct_sorted(keys: np.ndarray) -> np.ndarray:
+    keys = np.sort(keys)
+    return keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) else keys
+
+# Per-user distinct content as sorted int32 code arrays in CSR layout: the
+# codes of users[i] are codes[indptr[i]:indptr[i + 1]] and catalog maps a
+# code back to its content_id. Memory grows with the titles each user
+# watched, not with the catalog, and sets merge by a sort of (user, code) keys.
+@dataclass
+class UserContentSets:
+    users: pd.Index
+    indptr: np.ndarray
+    codes: np.ndarray
+    catalog: pd.Index
+
+    @classmethod
+    def empty(cls) -> "UserContentSets":
+        return cls(pd.Index([], dtype=object, name="user_id"), np.zeros(1, dtype=np.int64),
+                   np.zeros(0, dtype=np.int32), pd.Index([], dtype=object))
+
+    @classmethod
+    def _from_codes(cls, users: pd.Index, positions: np.ndarray, codes: np.ndarray, catalog: pd.Index) -> "UserContentSets":
+        width = max(len(catalog), 1)
+        keys = _distinct_sorted(positions.astype(np.int64) * width + codes)
+        indptr = np.r_[0, np.cumsum(np.bincount(keys // width, minlength=len(users)))].astype(np.int64)
+        return cls(users, indptr, (keys % width).astype(np.int32), catalog)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "UserContentSets":
+        valid = df["user_id"].notna() & df["content_id"].notna()
+        positions, users = pd.factorize(df.loc[valid, "user_id"], sort=True)
+        codes, catalog = pd.factorize(df.loc[valid, "content_id"])
+        return cls._from_codes(pd.Index(users, name="user_id"), positions, codes, pd.Index(catalog))
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.indptr.nbytes + self.codes.nbytes)
+
+    def user_rows(self) -> np.ndarray:
+        return np.repeat(np.arange(len(self.users)), np.diff(self.indptr))
+
+    def merge(self, other: "UserContentSets") -> "UserContentSets":
+        return self.combine([self, other])
+
+    @classmethod
+    def combine(cls, parts: list["UserContentSets"]) -> "UserContentSets":
+        # Catalog codes are append-only, so the first part's codes keep their meaning
+        parts = [part for part in parts if len(part.users)] or [cls.empty()]
+        if len(parts) == 1:
+            return parts[0]
+        catalog = parts[0].catalog.append([part.catalog for part in parts[1:]]).unique()
+        user_codes, users = pd.factorize(parts[0].users.append([part.users for part in parts[1:]]))
+        offsets = np.r_[0, np.cumsum([len(part.users) for part in parts])]
+        positions = np.concatenate([user_codes[offset + part.user_rows()] for part, offset in zip(parts, offsets)])
+        codes = np.concatenate([catalog.get_indexer(part.catalog)[part.codes] for part in parts])
+        return cls._from_codes(pd.Index(users, name="user_id"), positions, codes, catalog)
+
+    def subset(self, users: pd.Index) -> "UserContentSets":
+        return self.take(self.users.get_indexer(users), users)
+
+    def take(self, rows: np.ndarray, users: pd.Index | None = None) -> "UserContentSets":
+        # Sets at positions rows (-1 gives an empty set); users defaults to their ids
+        users = self.users[rows] if users is None else users
+        found = rows >= 0
+        starts = np.where(found, self.indptr[np.maximum(rows, 0)], 0)
+        lengths = np.where(found, self.indptr[np.maximum(rows, 0) + 1] - starts, 0)
+        indptr = np.r_[0, np.cumsum(lengths)].astype(np.int64)
+        return UserContentSets(pd.Index(users, name="user_id"), indptr, self.codes[_gather(starts, lengths)], self.catalog)
+
+    def counts(self) -> pd.Series:
+        return pd.Series(np.diff(self.indptr), index=self.users, name="unique_content")
+
+    def content_codes(self, user_id) -> np.ndarray:
+        i = self.users.get_loc(user_id)
+        return self.codes[self.indptr[i]:self.indptr[i + 1]]
+
+    def contents(self, user_id) -> list:
+        return list(self.catalog[self.content_codes(user_id)])
+
+    def contains(self, rows: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        # Vectorized membership probe of (user row, content code) pairs; -1 never matches
+        width = max(len(self.catalog), 1)
+        keys = self.user_rows().astype(np.int64) * width + self.codes
+        rows, codes = np.broadcast_arrays(np.asarray(rows, dtype=np.int64), np.asarray(codes, dtype=np.int64))
+        valid = (rows >= 0) & (codes >= 0) & (codes < width)
+        probe = np.where(valid, rows * width + codes, -1)
+        if not len(keys):
+            return np.zeros(probe.shape, dtype=bool)
+        found = np.minimum(np.searchsorted(keys, probe), len(keys) - 1)
+        return valid & (keys[found] == probe)
+
+    def overlap(self, a, b) -> int:
+        return len(np.intersect1d(self.content_codes(a), self.content_codes(b), assume_unique=True))
+
+    def overlap_counts(self, user_id) -> pd.Series:
+        # Titles shared with user_id, for every user (co-viewing counts)
+        member = np.zeros(len(self.catalog), dtype=bool)
+        member[self.content_codes(user_id)] = True
+        shared = np.bincount(self.user_rows(), weights=member[self.codes], minlength=len(self.users))
+        return pd.Series(shared.astype(np.int64), index=self.users, name="shared_content")
+
+    def save(self, path: Path) -> None:
+        np.savez(path, users=_id_array(self.users), indptr=self.indptr, codes=self.codes, catalog=_id_array(self.catalog))
+
+    @classmethod
+    def load(cls, path: Path) -> "UserContentSets":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(_id_index(data["users"], "user_id"), data["indptr"], data["codes"], _id_index(data["catalog"]))
+
+def _moment_stats(grouped) -> pd.DataFrame:
+    stats = grouped["session_id"].count().rename("sessions_count").to_frame().astype(float)
+    for name, col in USER_MEASURES.items():
+        moments = grouped[col].agg(["count", "mean", "var"])
+        stats[f"{name}_n"] = moments["count"]
+        stats[f"{name}_mean"] = moments["mean"].fillna(0.0)
+        stats[f"{name}_m2"] = (moments["var"] * (moments["count"] - 1)).fillna(0.0)
+    return stats
+
+def _merge_moment_stats(left: pd.DataFrame, right: pd.DataFrame) -> pd.DataFrame:
+    return _combine_moment_stats([left, right])
+
+def _combine_moment_stats(parts: list[pd.DataFrame]) -> pd.DataFrame:
+    stacked = pd.concat(parts)
+    codes, keys = pd.factorize(stacked.index, sort=True)
+    return _reduce_moment_stats(stacked, codes, pd.Index(keys, name=stacked.index.name))
+
+def _reduce_moment_stats(stacked: pd.DataFrame, codes: np.ndarray, keys: pd.Index) -> pd.DataFrame:
+    # Multi-way Chan merge of partial rows sharing a key code, as bincount sums
+    total = lambda values: np.bincount(codes, weights=values, minlength=len(keys))
+    merged = pd.DataFrame({"sessions_count": total(stacked["sessions_count"].to_numpy(dtype=float))}, index=keys)
+    for name in USER_MEASURES:
+        n_i = stacked[f"{name}_n"].to_numpy(dtype=float)
+        mean_i = stacked[f"{name}_mean"].to_numpy(dtype=float)
+        n = total(n_i)
+        mean = np.divide(total(n_i * mean_i), n, out=np.zeros_like(n), where=n > 0)
+        merged[f"{name}_n"] = n
+        merged[f"{name}_mean"] = mean
+        merged[f"{name}_m2"] = total(stacked[f"{name}_m2"].to_numpy(dtype=float) + n_i * (mean_i - mean[codes]) ** 2)
+    return merged
+
+def _first_rows(codes: np.ndarray, valid: np.ndarray, n_keys: int) -> np.ndarray:
+    # Smallest row number with a valid value per key code (len(codes) when none)
+    first = np.full(n_keys, len(codes), dtype=np.int64)
+    np.minimum.at(first, codes[valid], np.flatnonzero(valid))
+    return first
+
+def _take_first(values: pd.Series, first: np.ndarray) -> pd.Series:
+    found = first < len(values)
+    taken = values.iloc[np.minimum(first, max(len(values) - 1, 0))] if len(values) else pd.Series(np.nan, index=range(len(first)))
+    return taken.reset_index(drop=True).where(found)
+
+@dataclass
+class UserAggregateState:
+    stats: pd.DataFrame | None = None
+    content: UserContentSets | None = None
+    attributes: pd.DataFrame | None = None
+
+    def __post_init__(self):
+        if self.stats is None:
+            columns = ["sessions_count"] + [f"{m}_{s}" for m in USER_MEASURES for s in ("n", "mean", "m2")]
+            self.stats = pd.DataFrame(columns=columns, dtype=float, index=pd.Index([], name="user_id"))
+        if self.content is None:
+            self.content = UserContentSets.empty()
+        if self.attributes is None:
+            self.attributes = pd.DataFrame(columns=USER_ATTRIBUTES, index=pd.Index([], name="user_id"))
+
+    @staticmethod
+    def chunk_state(chunk: pd.DataFrame) -> "UserAggregateState":
+        # One factorize of user_id, then bincount reductions (same numerics as the sorted kernel)
+        chunk = chunk[chunk["user_id"].notna()]
+        codes, users = pd.factorize(chunk["user_id"])
+        users = pd.Index(users, name="user_id")
+        total = lambda values: np.bincount(codes, weights=values, minlength=len(users))
+        stats = pd.DataFrame({"sessions_count": total(chunk["session_id"].notna().to_numpy(dtype=float))}, index=users)
+        for name, col in USER_MEASURES.items():
+            x = chunk[col].to_numpy(dtype=float, na_value=np.nan)
+            present = ~np.isnan(x)
+            n = total(present.astype(float))
+            mean = np.divide(total(np.where(present, x, 0.0)), n, out=np.zeros_like(n), where=n > 0)
+            stats[f"{name}_n"] = n
+            stats[f"{name}_mean"] = mean
+            stats[f"{name}_m2"] = total(np.where(present, (x - mean[codes]) ** 2, 0.0))
+        attributes = pd.DataFrame(index=users, columns=USER_ATTRIBUTES)
+        for col in USER_ATTRIBUTES:
+            if col in chunk.columns:
+                attributes[col] = _take_first(chunk[col], _first_rows(codes, chunk[col].notna().to_numpy(), len(users))).to_numpy()
+        has_content = chunk["content_id"].notna().to_numpy()
+        content_codes, catalog = pd.factorize(chunk["content_id"].to_numpy()[has_content])
+        content = UserContentSets._from_codes(users, codes[has_content], content_codes, pd.Index(catalog))
+        return UserAggregateState(stats, content, attributes.infer_objects())
+
+    def merge(self, other: "UserAggregateState") -> None:
+        merged = self.combine([self, other])
+        self.stats, self.content, self.attributes = merged.stats, merged.content, merged.attributes
+
+    def fold(self, chunk: pd.DataFrame) -> None:
+        self.merge(self.chunk_state(chunk))
+
+    @classmethod
+    def combine(cls, parts: list["UserAggregateState"]) -> "UserAggregateState":
+        # stats, content sets and attributes share one row order per state, so
+        # one factorize of the stacked user keys drives all three merges
+        parts = [part for part in parts if not part.stats.empty]
+        if not parts:
+            return cls()
+        stacked = pd.concat([part.stats for part in parts])
+        codes, keys = pd.factorize(stacked.index)
+        keys = pd.Index(keys, name="user_id")
+        stats = _reduce_moment_stats(stacked, codes, keys)
+        # groupby "first": the first non-null value in part order
+        stacked_attributes = pd.concat([part.attributes.reindex(columns=USER_ATTRIBUTES) for part in parts])
+        attributes = pd.DataFrame(index=keys, columns=USER_ATTRIBUTES)
+        for col in USER_ATTRIBUTES:
+            first = _first_rows(codes, stacked_attributes[col].notna().to_numpy(), len(keys))
+            attributes[col] = _take_first(stacked_attributes[col], first).to_numpy()
+        catalog = parts[0].content.catalog.append([part.content.catalog for part in parts[1:]]).unique()
+        offsets = np.r_[0, np.cumsum([len(part.stats) for part in parts])]
+        positions, content_codes = [], []
+        for part, offset in zip(parts, offsets):
+            content = part.content if part.content.users.equals(part.stats.index) else part.content.subset(part.stats.index)
+            positions.append(codes[offset + content.user_rows()])
+            content_codes.append(catalog.get_indexer(content.catalog)[content.codes])
+        content = UserContentSets._from_codes(keys, np.concatenate(positions), np.concatenate(content_codes), catalog)
+        return cls(stats, content, attributes.infer_objects())
+
+    @classmethod
+    def from_chunks(cls, chunks) -> "UserAggregateState":
+        # Chunk states are buffered and combined once the buffer outgrows the
+        # combined state, so each chunk is merged O(1) times on average instead
+        # of re-merging the whole state per chunk; memory stays under ~2x state
+        state, buffer, buffered = cls(), [], 0
+        for chunk in chunks:
+            buffer.append(cls.chunk_state(chunk))
+            buffered += len(buffer[-1].stats)
+            if buffered >= max(len(state.stats), CHUNK_ROWS):
+                state, buffer, buffered = cls.combine([state, *buffer]), [], 0
+        return cls.combine([state, *buffer]) if buffer else state
+
+    def unique_content(self) -> pd.Series:
+        return self.content.counts().reindex(self.stats.index, fill_value=0)
+
+    def subset(self, users: pd.Index) -> "UserAggregateState":
+        return UserAggregateState(
+            self.stats.loc[users],
+            self.content.subset(users),
+            self.attributes.reindex(users),
+        )
+
+    def take(self, rows: np.ndarray) -> "UserAggregateState":
+        # Positional subset of a state whose content rows follow stats (as combine returns)
+        return UserAggregateState(self.stats.iloc[rows], self.content.take(rows), self.attributes.iloc[rows])
+
+    def to_frame(self) -> pd.DataFrame:
+        return _user_agg_frame(self.stats, self.unique_content(), self.attributes)
+
+def _user_agg_frame(stats: pd.DataFrame, unique_content: pd.Series, attributes: pd.DataFrame) -> pd.DataFrame:
+    stats = stats.sort_index()
+    user_agg = pd.DataFrame({"sessions_count": stats["sessions_count"].astype(int)}, index=stats.index)
+    for name in USER_MEASURES:
+        n = stats[f"{name}_n"]
+        user_agg[f"avg_{name}"] = stats[f"{name}_mean"].where(n > 0)
+        user_agg[f"{name}_std"] = np.sqrt(stats[f"{name}_m2"] / (n - 1)).where(n > 1)
+    user_agg["unique_content"] = unique_content.reindex(stats.index, fill_value=0).astype(int)
+    # reindex skips the lookup when the store passes one sorted table for all three
+    user_agg = pd.concat([user_agg, attributes[USER_ATTRIBUTES].reindex(stats.index)], axis=1).reset_index().fillna(0)
+    user_agg["subscription_numeric"] = user_agg["subscription_type"].map(SUBSCRIPTION_MAP).fillna(1).astype(int)
     return user_agg
 
+def aggregate_user_metrics_streaming(chunks, state: UserAggregateState | None = None) -> pd.DataFrame:
+    folded = UserAggregateState.from_chunks(chunks)
+    if state is not None:
+        state.merge(folded)
+        folded = state
+    return folded.to_frame()
+
+def iter_chunks(df: pd.DataFrame, chunk_rows: int = CHUNK_ROWS):
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+# Persistent store of the mergeable per-user state: a compacted base,
+# hash-partitioned by user_id into files of ~USER_STORE_PARTITION_USERS users,
+# plus one append-only delta file per run holding the state of the newly
+# loaded sessions. Reads merge the deltas into the base rows of the users they
+# touch; once the deltas outgrow USER_STORE_COMPACT_RATIO of the base (or
+# USER_STORE_MAX_DELTAS files) they are compacted into a new base generation.
+# store.json lists the live files and is staged with the run like every state.
+USER_STORE_DIR = "user_aggregate_store"
+USER_STORE_MANIFEST = "store.json"
+USER_STORE_PARTITION_USERS = 100_000
+USER_STORE_COMPACT_RATIO = 1.0
+USER_STORE_MAX_DELTAS = 16
+
+def _user_store_dir() -> Path:
+    path = PROCESSED_PATH / USER_STORE_DIR
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+def user_partition(user_ids: pd.Series, partitions: int) -> np.ndarray:
+    hashed = pd.util.hash_pandas_object(user_ids.astype(str), index=False).to_numpy()
+    return (hashed % np.uint64(partitions)).astype(np.int64)
+
+def _store_table(state: UserAggregateState) -> pd.DataFrame:
+    return state.stats.join(state.attributes).assign(unique_content=state.unique_content())
+
+def _store_state(table: pd.DataFrame, content: UserContentSets) -> UserAggregateState:
+    return UserAggregateState(table.drop(columns=[*USER_ATTRIBUTES, "unique_content"]), content, table[USER_ATTRIBUTES])
+
+def _read_store_table(name: str) -> pd.DataFrame:
+    return pd.read_parquet(_current(_user_store_dir() / f"{name}.parquet")).set_index("user_id")
+
+def _read_store_content(name: str) -> UserContentSets:
+    return UserContentSets.load(_current(_user_store_dir() / f"{name}.npz"))
+
+def _write_store_file(name: str, state: UserAggregateState) -> None:
+    _store_table(state).reset_index().to_parquet(_staged(_user_store_dir() / f"{name}.parquet"), index=False, engine=PARQUET_ENGINE)
+    state.content.save(_staged(_user_store_dir() / f"{name}.npz"))
+
+def _read_store_manifest() -> dict | None:
+    path = _current(_user_store_dir() / USER_STORE_MANIFEST)
+    return json.loads(path.read_text(encoding="utf-8")) if path.exists() else None
+
+def _prune_user_store(manifest: dict | None) -> None:
+    # Files replaced by a compaction (or a store without manifest) are only
+    # removed once the manifest that dropped them has been committed
+    if (_staging_dir() / USER_STORE_DIR / USER_STORE_MANIFEST).exists():
+        return
+    names = (manifest["base"] + manifest["deltas"]) if manifest else []
+    keep = {USER_STORE_MANIFEST} | {f"{name}{ext}" for name in names for ext in (".parquet", ".npz")}
+    for path in _user_store_dir().iterdir():
+        if path.is_file() and path.name not in keep:
+            path.unlink()
+
+def _compact_user_store(manifest: dict, delta: UserAggregateState) -> dict:
+    parts = [_store_state(_read_store_table(name), _read_store_content(name)) for name in manifest["base"] + manifest["deltas"]]
+    state = UserAggregateState.combine([*parts, delta])
+    partitions = math.ceil(len(state.stats) / USER_STORE_PARTITION_USERS)
+    owner = user_partition(state.stats.index.to_series(), max(partitions, 1))
+    generation = manifest["generation"] + 1
+    base = [f"base-{generation:04d}-{part:03d}" for part in range(partitions)]
+    for part, name in enumerate(base):
+        _write_store_file(name, state.take(np.flatnonzero(owner == part)))
+    logging.info("User aggregate store compactado: %s usuarios en %s particiones", len(state.stats), partitions)
+    return {**manifest, "generation": generation, "base": base, "base_users": len(state.stats), "deltas": [], "delta_users": 0}
+
+def update_user_aggregate_store(new_rows: pd.DataFrame) -> int:
+    manifest = _read_store_manifest()
+    _prune_user_store(manifest)
+    rebuild = manifest is None
+    if rebuild:
+        # First run: build the store once from the loaded history
+        history = _current(PROCESSED_PATH / "streaming_data.parquet")
+        if history.exists():
+            new_rows = pd.read_parquet(history)
+        manifest = {"generation": 0, "base": [], "base_users": 0, "deltas": [], "delta_users": 0, "next_delta": 0}
+        logging.info("User aggregate store rebuilt from %s sesiones", len(new_rows))
+    delta = UserAggregateState.from_chunks(iter_chunks(new_rows))
+    if delta.stats.empty and not rebuild:
+        return 0
+    delta_users = manifest["delta_users"] + len(delta.stats)
+    if rebuild or len(manifest["deltas"]) >= USER_STORE_MAX_DELTAS or delta_users > USER_STORE_COMPACT_RATIO * manifest["base_users"]:
+        manifest = _compact_user_store(manifest, delta)
+    else:
+        name = f"delta-{manifest['next_delta']:06d}"
+        _write_store_file(name, delta)
+        manifest = {**manifest, "deltas": manifest["deltas"] + [name], "delta_users": delta_users, "next_delta": manifest["next_delta"] + 1}
+        logging.info("User aggregate store: %s usuarios en %s", len(delta.stats), name)
+    _staged(_user_store_dir() / USER_STORE_MANIFEST).write_text(json.dumps(manifest), encoding="utf-8")
+    return len(delta.stats)
+
+def load_user_aggregates() -> pd.DataFrame:
+    manifest = _read_store_manifest()
+    if manifest is None or not manifest["base"]:
+        return aggregate_user_metrics_streaming([])
+    tables = {name: _read_store_table(name) for name in manifest["base"]}
+    if manifest["deltas"]:
+        # Only the users in a delta are merged; the other base rows are final
+        deltas = [_store_state(_read_store_table(name), _read_store_content(name)) for name in manifest["deltas"]]
+        touched = pd.Index(np.concatenate([delta.stats.index.to_numpy() for delta in deltas])).unique()
+        parts = []
+        for name, table in tables.items():
+            hit = touched.get_indexer(table.index) >= 0
+            parts.append(_store_state(table[hit], _read_store_content(name).subset(table.index[hit])))
+            tables[name] = table[~hit]
+        tables["deltas"] = _store_table(UserAggregateState.combine([*parts, *deltas]))
+    table = pd.concat(tables.values()).sort_index()
+    return _user_agg_frame(table, table["unique_content"], table)
+
+def load_user_content_sets() -> UserContentSets:
+    manifest = _read_store_manifest()
+    names = (manifest["base"] + manifest["deltas"]) if manifest else []
+    return UserContentSets.combine([_read_store_content(name) for name in names])
+
+def aggregate_users(df: pd.DataFrame, new_rows: pd.DataFrame, heavy_keys: list | None = None) -> tuple[pd.DataFrame, int]:
+    # The store folds every loaded batch whatever the mode: rows enter the
+    # dedup history once, so a batch skipped here would never come back
+    touched = update_user_aggregate_store(new_rows)
+    mode = aggregation_mode()
+    if mode == "incremental":
+        return load_user_aggregates(), touched
+    if mode == "streaming":
+        return aggregate_user_metrics_streaming(iter_chunks(df)), touched
+    if mode == "sorted":
+        return aggregate_user_metrics_sorted(df), touched
+    if mode == "parallel":
+        return aggregate_user_metrics_parallel(df, heavy_keys=heavy_keys), touched
+    return aggregate_user_metrics(df), touched
+
+def export_user_content_sets(content: UserContentSets) -> Path:
+    out = PROCESSED_PATH / USER_CONTENT_SETS_FILE
+    content.save(out)
+    logging.info("User content sets exportado: %s (%s usuarios, %s bytes)", out, len(content.users), content.nbytes)
+    return out
+
+# Parallel variant: the parent factorizes user_id and content_id once and
+# shares only numeric columns (codes, measures, null masks) with the workers
+# as .npy files in /dev/shm, memory-mapped read-only as in select_n_clusters.
+# Users go to shard code % workers, so shards are disjoint. The parent sorts
+# the rows by shard once and writes the columns in that order, so each worker
+# reads one contiguous slice, reduces it with the sorted segment kernel and
+# returns per-user partials keyed by user code. Heavy users are salted
+# round-robin over all shards and their partials Chan-merged in the parent,
+# which then only gathers attributes and maps codes back.
+# Experimental: no speedup over the sorted kernel has been measured yet.
+def aggregation_workers() -> int:
+    return int(os.getenv("AGGREGATION_WORKERS", "0")) or os.cpu_count() or 1
+
+def partition_sessions(codes: np.ndarray, workers: int, heavy_codes: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+    # Rows grouped by shard: shard s owns order[offsets[s]:offsets[s + 1]],
+    # kept in row order. Rows without a user code (-1) belong to no shard.
+    shards = (codes % workers).astype(np.int16)
+    if heavy_codes is not None and len(heavy_codes):
+        # Salt heavy users round-robin over every shard
+        salted = np.isin(codes, heavy_codes)
+        shards[salted] = np.arange(salted.sum()) % workers
+    rows = np.flatnonzero(codes >= 0)
+    shards = shards[rows]
+    order = rows[np.argsort(shards, kind="stable")]
+    offsets = np.r_[0, np.cumsum(np.bincount(shards, minlength=workers))]
+    return order, offsets
+
+def _aggregate_shard(directory: str, lo: int, hi: int, heavy_codes: np.ndarray, width: int) -> dict:
+    # Columns are stored in shard order, so the shard is the slice [lo, hi)
+    load = lambda name: np.load(Path(directory) / f"{name}.npy", mmap_mode="r")[lo:hi]
+    codes = np.asarray(load("user"))
+    local = np.argsort(codes, kind="stable")
+    rows, codes = load("row")[local], codes[local]
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(rows) else np.zeros(0, dtype=np.int64)
+    sizes = np.diff(np.r_[starts, len(rows)])
+
+    def reduce(values: np.ndarray, ufunc=np.add) -> np.ndarray:
+        return ufunc.reduceat(values, starts) if len(starts) else np.zeros(0, dtype=values.dtype)
+
+    part = {"user": codes[starts], "sessions_count": reduce(load("session")[local].astype(np.int64))}
+    for name in USER_MEASURES:
+        x = load(name)[local]
+        present = ~np.isnan(x)
+        n = reduce(present.astype(np.int64))
+        mean = np.divide(reduce(np.where(present, x, 0.0)), n, out=np.zeros(len(n)), where=n > 0)
+        part[f"{name}_n"] = n
+        part[f"{name}_mean"] = mean
+        part[f"{name}_m2"] = reduce(np.where(present, (x - np.repeat(mean, sizes)) ** 2, 0.0))
+    for col in USER_ATTRIBUTES:
+        # Global row number of the first non-null value (rows are stable within a user)
+        part[f"{col}_first"] = reduce(np.where(load(col)[local], rows, np.iinfo(np.int64).max), np.minimum)
+    content = load("content")[local]
+    has_content = content >= 0
+    pairs = _distinct_sorted(codes[has_content] * width + content[has_content])
+    salted = np.isin(pairs // width, heavy_codes)
+    part["unique_content"] = np.bincount(np.searchsorted(part["user"], pairs[~salted] // width), minlength=len(starts))
+    part["salted_pairs"] = pairs[salted]
+    return part
+
+def aggregate_user_metrics_parallel(df: pd.DataFrame, workers: int | None = None, heavy_keys: list | None = None) -> pd.DataFrame:
+    workers = workers or aggregation_workers()
+    if workers <= 1 or len(df) < workers:
+        return aggregate_user_metrics(df)
+    codes, users = pd.factorize(df["user_id"])
+    # Rank codes in sorted user order so the result comes out in groupby order
+    order = np.asarray(users.argsort())
+    rank = np.empty(len(users) + 1, dtype=np.int64)
+    rank[order] = np.arange(len(users))
+    rank[-1] = -1
+    users = pd.Index(users[order], name="user_id")
+    codes = rank[codes]
+    heavy_codes = np.flatnonzero(users.isin(list(heavy_keys or [])))
+    order, offsets = partition_sessions(codes, workers, heavy_codes)
+    content_codes, catalog = pd.factorize(df["content_id"])
+    columns = {"row": order, "user": codes, "session": df["session_id"].notna().to_numpy(), "content": content_codes}
+    for name, col in USER_MEASURES.items():
+        columns[name] = df[col].to_numpy(dtype=float, na_value=np.nan)
+    for col in USER_ATTRIBUTES:
+        columns[col] = df[col].notna().to_numpy() if col in df.columns else np.zeros(len(df), dtype=bool)
+    width = max(len(catalog), 1)
+    shm = Path("/dev/shm")
+    with tempfile.TemporaryDirectory(dir=shm if shm.is_dir() else None) as tmp:
+        for name, values in columns.items():
+            np.save(Path(tmp) / f"{name}.npy", values if name == "row" else values[order])
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(_aggregate_shard, [tmp] * workers, offsets[:-1], offsets[1:], [heavy_codes] * workers, [width] * workers))
+    merged = {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+    # Salted users have partials in several shards: Chan-merge by user code
+    stats = _reduce_moment_stats(pd.DataFrame({k: v for k, v in merged.items() if k == "sessions_count" or k.endswith(("_n", "_mean", "_m2"))}),
+                                 merged["user"], users)
+    user_agg = pd.DataFrame({"user_id": users, "sessions_count": stats["sessions_count"].to_numpy().astype(np.int64)})
+    for name in USER_MEASURES:
+        n = stats[f"{name}_n"].to_numpy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            user_agg[f"avg_{name}"] = np.where(n > 0, stats[f"{name}_mean"].to_numpy(), np.nan)
+            user_agg[f"{name}_std"] = np.where(n > 1, np.sqrt(stats[f"{name}_m2"].to_numpy() / (n - 1)), np.nan)
+    salted_pairs = _distinct_sorted(merged["salted_pairs"])
+    user_agg["unique_content"] = (np.bincount(merged["user"], weights=merged["unique_content"], minlength=len(users))
+                                  + np.bincount(salted_pairs // width, minlength=len(users))).astype(np.int64)
+    for col in USER_ATTRIBUTES:
+        if col in df.columns:
+            first = np.full(len(users), np.iinfo(np.int64).max)
+            np.minimum.at(first, merged["user"], merged[f"{col}_first"])
+            user_agg[col] = _take_first(df[col], first)
+        else:
+            user_agg[col] = np.nan
+    user_agg = user_agg.fillna(0)
+    user_agg["subscription_numeric"] = user_agg["subscription_type"].map(SUBSCRIPTION_MAP).fillna(1).astype(int)
+    loads = np.diff(offsets)
+    logging.info("Agregación paralela: %s shards, %s usuarios, %s salados, desbalance %.2f",
+                 workers, len(user_agg), len(heavy_codes), loads.max() / max(loads.mean(), 1))
+    return user_agg
+
+# ---------------- Aggregate (content level) -------
+# Per-title popularity and engagement in one groupby over the sessions. The
+# per-title moments are mergeable (same Welford/Chan state as the user
+# aggregates) and persisted, so runs only fold the newly loaded sessions;
+# distinct viewers come from the per-user content sets.
+CONTENT_STATS_FILE = "content_statistics.parquet"
+CONTENT_AGG_FILE = "content_aggregation.parquet"
+GENRE_AGG_FILE = "genre_aggregation.parquet"
+CONTENT_ATTRIBUTES = ["title", "genre", "content_type"]
+
+def content_statistics(df: pd.DataFrame) -> pd.DataFrame:
+    return _moment_stats(df[df["content_id"].notna()].groupby("content_id"))
+
+def update_content_statistics(new_rows: pd.DataFrame) -> pd.DataFrame:
+    state_file = _state_dir() / CONTENT_STATS_FILE
+    if not _current(state_file).exists():
+        # First run: build once from the loaded history
+        history = _current(PROCESSED_PATH / "streaming_data.parquet")
+        stats = content_statistics(pd.read_parquet(history) if history.exists() else new_rows)
+        logging.info("Content statistics rebuilt from history: %s títulos", len(stats))
+    else:
+        stats = pd.read_parquet(_current(state_file)).set_index("content_id")
+        if not new_rows.empty:
+            stats = _merge_moment_stats(stats, content_statistics(new_rows))
+    stats.rename_axis("content_id").reset_index().to_parquet(_staged(state_file), index=False, engine=PARQUET_ENGINE)
+    return stats
+
+def content_viewers(content_sets: UserContentSets) -> pd.Series:
+    return pd.Series(np.bincount(content_sets.codes, minlength=len(content_sets.catalog)), index=content_sets.catalog)
+
+def title_genres(genres: pd.Series) -> pd.Series:
+    # content.json may carry a list of genres per title: one row per (title, genre),
+    # so a title counts in each of its genres; missing or empty lists are "Unknown"
+    exploded = genres.explode()
+    return exploded.where(exploded.notna(), "Unknown")
+
+def _genre_label(value):
+    return "|".join(map(str, value)) if isinstance(value, (list, tuple, np.ndarray)) else value
+
+def genre_viewers(content_sets: UserContentSets, genres: pd.Series) -> pd.Series:
+    # Distinct (user, genre) pairs from the per-user content code sets
+    exploded = title_genres(genres.reindex(content_sets.catalog))
+    genre_codes, genre_names = pd.factorize(exploded)
+    per_title = np.bincount(content_sets.catalog.get_indexer(exploded.index), minlength=len(content_sets.catalog))
+    starts = np.r_[0, np.cumsum(per_title)[:-1]].astype(np.int64)
+    lengths = per_title[content_sets.codes]
+    width = max(len(genre_names), 1)
+    users = np.repeat(content_sets.user_rows().astype(np.int64), lengths)
+    pairs = _distinct_sorted(users * width + genre_codes[_gather(starts[content_sets.codes], lengths)])
+    return pd.Series(np.bincount(pairs % width, minlength=len(genre_names)), index=genre_names)
+
+def aggregate_content_metrics(stats: pd.DataFrame, content: pd.DataFrame, content_sets: UserContentSets) -> tuple[pd.DataFrame, pd.DataFrame]:
+    catalog = content.drop_duplicates("content_id").set_index("content_id").reindex(columns=CONTENT_ATTRIBUTES)
+    by_title = pd.DataFrame({"sessions_count": stats["sessions_count"].astype(int)}, index=stats.index)
+    by_title["unique_viewers"] = content_viewers(content_sets).reindex(stats.index, fill_value=0).astype(int)
+    for name in USER_MEASURES:
+        n = stats[f"{name}_n"]
+        by_title[f"total_{name}"] = stats[f"{name}_mean"] * n
+        by_title[f"avg_{name}"] = stats[f"{name}_mean"].where(n > 0)
+        by_title[f"{name}_std"] = np.sqrt(stats[f"{name}_m2"] / (n - 1)).where(n > 1)
+    by_title = by_title.join(catalog).rename_axis("content_id")
+    by_title["genre"] = by_title["genre"].map(_genre_label).fillna("Unknown")
+    by_title["popularity_rank"] = by_title["sessions_count"].rank(method="min", ascending=False).astype(int)
+    by_title = by_title.sort_values(["popularity_rank", "content_id"]).reset_index()
+
+    # Genre level from additive sums; completion is session-weighted
+    counts = {f"{name}_n": stats[f"{name}_n"] for name in USER_MEASURES}
+    sums = by_title.set_index("content_id")[[f"total_{name}" for name in USER_MEASURES]]
+    additive = pd.concat([by_title.set_index("content_id")[["sessions_count"]], sums, pd.DataFrame(counts)], axis=1)
+    additive = additive.join(title_genres(catalog["genre"].reindex(stats.index)).rename("genre"))
+    by_genre = additive.groupby("genre").agg(
+        titles=("sessions_count", "size"),
+        sessions_count=("sessions_count", "sum"),
+        **{f"total_{name}": (f"total_{name}", "sum") for name in USER_MEASURES},
+        **{f"{name}_n": (f"{name}_n", "sum") for name in USER_MEASURES},
+    )
+    for name in USER_MEASURES:
+        by_genre[f"avg_{name}"] = by_genre[f"total_{name}"] / by_genre[f"{name}_n"].where(by_genre[f"{name}_n"] > 0)
+    by_genre["unique_viewers"] = genre_viewers(content_sets, catalog["genre"]).reindex(by_genre.index, fill_value=0).astype(int)
+    by_genre = by_genre.drop(columns=[f"{name}_n" for name in USER_MEASURES]).sort_values("sessions_count", ascending=False)
+    return by_title, by_genre.reset_index()
+
+def export_content_aggregation(by_title: pd.DataFrame, by_genre: pd.DataFrame) -> Path:
+    out = PROCESSED_PATH / CONTENT_AGG_FILE
+    by_title.to_parquet(out, index=False, engine=PARQUET_ENGINE)
+    by_genre.to_parquet(PROCESSED_PATH / GENRE_AGG_FILE, index=False, engine=PARQUET_ENGINE)
+    logging.info("Content aggregation exportado: %s (%s títulos, %s géneros)", out, len(by_title), len(by_genre))
+    return out
+
+# ---------------- Content co-viewing ---------------
+# Sessions become a CSR user x content matrix (summed watch time or mean
+# completion per pair). Item-item cosine similarity and co-viewer counts are
+# sparse products X^T X computed for blocks of titles at a time, so only a
+# catalog x block slice is ever dense; the top SIMILAR_CONTENT_K neighbours of
+# every title are kept for recommendations and the content dashboards.
+CONTENT_SIMILARITY_FILE = "content_similarity.parquet"
+SIMILARITY_BLOCK_CELLS = 4_000_000
+
+def interaction_settings() -> tuple[str, int]:
+    return os.getenv("INTERACTION_VALUE", "duration").lower(), int(os.getenv("SIMILAR_CONTENT_K", "10"))
+
+def user_content_matrix(df: pd.DataFrame, value: str = "duration"):
+    column = USER_MEASURES.get(value, value)
+    pairs = df.loc[df["user_id"].notna() & df["content_id"].notna(), ["user_id", "content_id", column]]
+    user_codes, users = pd.factorize(pairs["user_id"], sort=True)
+    content_codes, contents = pd.factorize(pairs["content_id"], sort=True)
+    # Summed watch time per pair; rates such as completion are averaged
+    values = pairs[column].astype(float).fillna(0.0).groupby([user_codes, content_codes])
+    values = values.sum() if column == USER_MEASURES["duration"] else values.mean()
+    rows, cols = (values.index.get_level_values(i).to_numpy() for i in (0, 1))
+    matrix = scipy_sparse.csr_matrix((values.to_numpy(), (rows, cols)), shape=(len(users), len(contents)))
+    return matrix, pd.Index(users, name="user_id"), pd.Index(contents, name="content_id")
+
+def content_similarity(matrix, contents: pd.Index, k: int = 10, block_cells: int = SIMILARITY_BLOCK_CELLS) -> pd.DataFrame:
+    n_items = matrix.shape[1]
+    X = matrix.tocsc()
+    viewed = X.copy()
+    viewed.data = np.ones_like(viewed.data)
+    XT, viewed_T = X.T.tocsr(), viewed.T.tocsr()
+    norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=0)).ravel())
+    norms[norms == 0] = 1.0
+    block = max(1, block_cells // max(n_items, 1))
+    k = min(k, max(n_items - 1, 0))
+    frames = []
+    for start in range(0, n_items, block):
+        cols = np.arange(start, min(start + block, n_items))
+        co_viewers = (viewed_T @ viewed[:, cols]).toarray()
+        sim = (XT @ X[:, cols]).toarray() / norms[:, None] / norms[None, cols]
+        sim[co_viewers == 0] = -np.inf
+        sim[cols, np.arange(len(cols))] = -np.inf
+        if k == 0:
+            continue
+        top = np.argpartition(-sim, k - 1, axis=0)[:k]
+        top_sim = np.take_along_axis(sim, top, axis=0)
+        # Order each column by similarity, ties by catalog position
+        order = np.lexsort((top, -top_sim), axis=0)
+        top, top_sim = np.take_along_axis(top, order, axis=0), np.take_along_axis(top_sim, order, axis=0)
+        keep = np.isfinite(top_sim)
+        item = np.broadcast_to(cols, top.shape)
+        frames.append(pd.DataFrame({
+            "content_id": contents[item.T[keep.T]],
+            "similar_content_id": contents[top.T[keep.T]],
+            "rank": np.broadcast_to(np.arange(1, k + 1)[:, None], top.shape).T[keep.T],
+            "similarity": top_sim.T[keep.T],
+            "co_viewers": np.take_along_axis(co_viewers, top, axis=0).T[keep.T].astype(int),
+        }))
+    columns = ["content_id", "similar_content_id", "rank", "similarity", "co_viewers"]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+def export_content_similarity(similar: pd.DataFrame) -> Path:
+    out = PROCESSED_PATH / CONTENT_SIMILARITY_FILE
+    similar.to_parquet(out, index=False, engine=PARQUET_ENGINE)
+    logging.info("Content similarity exportado: %s (%s pares)", out, len(similar))
+    return out
+
+# ---------------- Sliding windows (user level) ----
+# Per-user daily partitions (sessions and watch minutes per user and day) are
+# kept in the state directory and only the newly loaded sessions are added.
+# Days older than the longest window are dropped, so the table behaves like a
+# ring buffer and the 7/30/90-day windows never rescan the session history.
+ENGAGEMENT_WINDOWS = (7, 30, 90)
+USER_ACTIVITY_FILE = "user_daily_activity.parquet"
+
+def window_features() -> list[str]:
+    return [f"{measure}_{days}d" for days in ENGAGEMENT_WINDOWS for measure in ("sessions", "minutes")]
+
+def user_daily_activity(df: pd.DataFrame) -> pd.DataFrame:
+    frame = pd.DataFrame({
+        "user_id": df["user_id"],
+        "watch_date": pd.to_datetime(df["watch_date"], errors="coerce").dt.normalize(),
+        # Counted like sessions_count in the user aggregates
+        "sessions": df["session_id"].notna().astype(int) if "session_id" in df.columns else 1,
+        "minutes": df["duration_watched"].fillna(0).astype(float),
+    })
+    return frame.dropna(subset=["user_id", "watch_date"]).groupby(["user_id", "watch_date"]).sum().reset_index()
+
+def update_user_activity(new_rows: pd.DataFrame) -> pd.DataFrame:
+    state_file = _state_dir() / USER_ACTIVITY_FILE
+    if not _current(state_file).exists():
+        # First run: build once from the loaded history
+        history = _current(PROCESSED_PATH / "streaming_data.parquet")
+        activity = user_daily_activity(pd.read_parquet(history) if history.exists() else new_rows)
+        logging.info("User daily activity rebuilt from history: %s filas", len(activity))
+    else:
+        activity = pd.read_parquet(_current(state_file))
+        if not new_rows.empty and "watch_date" in new_rows.columns:
+            activity = pd.concat([activity, user_daily_activity(new_rows)], ignore_index=True)
+            activity = activity.groupby(["user_id", "watch_date"]).sum().reset_index()
+    if not activity.empty:
+        horizon = activity["watch_date"].max() - pd.Timedelta(days=max(ENGAGEMENT_WINDOWS))
+        activity = activity[activity["watch_date"] > horizon]
+    activity.to_parquet(_staged(state_file), index=False, engine=PARQUET_ENGINE)
+    return activity
+
+def engagement_activity(new_rows: pd.DataFrame, df: pd.DataFrame) -> pd.DataFrame:
+    # The persisted activity folds every loaded batch whatever the mode, as the
+    # user store does. The windows are joined onto user_agg, so they cover the
+    # same sessions: that history when user_agg comes from the incremental
+    # store, the current batch for the modes that aggregate the batch
+    activity = update_user_activity(new_rows)
+    return activity if aggregation_mode() == "incremental" else user_daily_activity(df)
+
+def sliding_window_metrics(activity: pd.DataFrame, as_of: pd.Timestamp | None = None) -> pd.DataFrame:
+    codes, users = pd.factorize(activity["user_id"])
+    windows = pd.DataFrame(index=pd.Index(users, name="user_id"))
+    if activity.empty:
+        return windows.reindex(columns=window_features())
+    as_of = activity["watch_date"].max() if as_of is None else pd.Timestamp(as_of)
+    age = (as_of - activity["watch_date"]).dt.days.to_numpy()
+    for days in ENGAGEMENT_WINDOWS:
+        inside = (age >= 0) & (age < days)
+        for measure in ("sessions", "minutes"):
+            totals = np.bincount(codes, weights=np.where(inside, activity[measure].to_numpy(dtype=float), 0.0), minlength=len(users))
+            windows[f"{measure}_{days}d"] = totals.astype(int) if measure == "sessions" else totals
+    return windows
+
+def add_window_metrics(user_agg: pd.DataFrame, windows: pd.DataFrame) -> pd.DataFrame:
+    user_agg = user_agg.drop(columns=[c for c in window_features() if c in user_agg.columns])
+    user_agg = user_agg.merge(windows, left_on="user_id", right_index=True, how="left")
+    user_agg[window_features()] = user_agg[window_features()].fillna(0)
+    sessions = [c for c in window_features() if c.startswith("sessions_")]
+    user_agg[sessions] = user_agg[sessions].astype(int)
+    return user_agg
+
+# ---------------- Cohort retention ----------------
+# Distinct (user, active week) pairs are the incremental state: new sessions
+# only add pairs. Each user's cohort is the week of registration_date (or of
+# the first session), and the cohort x week-since-signup matrix is a single
+# groupby on integer week offsets over those pairs.
+USER_WEEKS_FILE = "user_active_weeks.parquet"
+COHORT_MATRIX_FILE = "cohort_retention_matrix.csv"
+
+def retention_week() -> int:
+    return int(os.getenv("RETENTION_WEEK", "4"))
+
+def _week_start(dates: pd.Series) -> pd.Series:
+    return pd.to_datetime(dates, errors="coerce").dt.to_period("W").dt.start_time
+
+def user_active_weeks(df: pd.DataFrame) -> pd.DataFrame:
+    weeks = pd.DataFrame({"user_id": df["user_id"], "week": _week_start(df["watch_date"])})
+    return weeks.dropna().drop_duplicates(ignore_index=True)
+
+def update_user_active_weeks(new_rows: pd.DataFrame) -> pd.DataFrame:
+    state_file = _state_dir() / USER_WEEKS_FILE
+    if not _current(state_file).exists():
+        # First run: build once from the loaded history
+        history = _current(PROCESSED_PATH / "streaming_data.parquet")
+        weeks = user_active_weeks(pd.read_parquet(history) if history.exists() else new_rows)
+        logging.info("User active weeks rebuilt from history: %s filas", len(weeks))
+    else:
+        weeks = pd.read_parquet(_current(state_file))
+        if not new_rows.empty and "watch_date" in new_rows.columns:
+            weeks = pd.concat([weeks, user_active_weeks(new_rows)], ignore_index=True).drop_duplicates(ignore_index=True)
+    weeks.to_parquet(_staged(state_file), index=False, engine=PARQUET_ENGINE)
+    return weeks
+
+def assign_cohorts(users: pd.DataFrame, active_weeks: pd.DataFrame) -> pd.Series:
+    first_week = active_weeks.groupby("user_id")["week"].min()
+    registered = pd.Series(dtype="datetime64[ns]")
+    if "registration_date" in users.columns:
+        registered = _week_start(users["registration_date"]).set_axis(users["user_id"]).dropna()
+        registered = registered[~registered.index.duplicated()]
+    return registered.combine_first(first_week).rename("cohort_week").rename_axis("user_id")
+
+def cohort_retention(active_weeks: pd.DataFrame, cohorts: pd.Series, min_weeks: int | None = None) -> tuple[pd.DataFrame, pd.Series]:
+    min_weeks = retention_week() if min_weeks is None else min_weeks
+    cohort_week = cohorts.reindex(active_weeks["user_id"]).to_numpy()
+    offset = (active_weeks["week"].to_numpy() - cohort_week) // np.timedelta64(7, "D")
+    # Activity before the cohort week (dirty registration dates) is ignored
+    valid = ~np.isnat(cohort_week) & (offset >= 0)
+    frame = pd.DataFrame({"cohort_week": cohort_week[valid], "week_offset": offset[valid].astype(int)})
+    matrix = frame.groupby(["cohort_week", "week_offset"]).size().rename("active_users").reset_index()
+    sizes = cohorts.value_counts().rename("cohort_size")
+    matrix = matrix.merge(sizes, left_on="cohort_week", right_index=True, how="left")
+    matrix["retention_rate"] = matrix["active_users"] / matrix["cohort_size"]
+    late = active_weeks.loc[valid & (offset >= min_weeks), "user_id"]
+    retained = pd.Series(cohorts.index.isin(late).astype(int), index=cohorts.index, name="retained")
+    return matrix, retained
+
+def export_cohort_retention(matrix: pd.DataFrame) -> Path:
+    out = PROCESSED_PATH / COHORT_MATRIX_FILE
+    wide = matrix.pivot(index="cohort_week", columns="week_offset", values="retention_rate").round(4)
+    wide.columns = [f"week_{w}" for w in wide.columns]
+    sizes = matrix.drop_duplicates("cohort_week").set_index("cohort_week")["cohort_size"]
+    wide.insert(0, "cohort_size", sizes.reindex(wide.index))
+    wide.reset_index().to_csv(out, index=False)
+    logging.info("Cohort retention exportado: %s (%s cohortes)", out, len(wide))
+    return out
+
+# ---------------- OLAP cube -----------------------
+# Additive measures over country x subscription x cluster x week, with every
+# rollup level materialized (SQL CUBE). Rolled-up dimensions are null and
+# grouping_id has bit i set when CUBE_DIMENSIONS[i] is rolled up, so a
+# dashboard filter is answered by summing the cells of one level. users and
+# premium_users are distinct counts: additive across country, subscription and
+# cluster, but not across weeks (use the week-rolled-up level for totals).
+CUBE_FILE = "olap_cube.parquet"
+CUBE_DIMENSIONS = ["country", "subscription_type", "cluster_kmeans", "week"]
+CUBE_MEASURES = ["users", "premium_users", "sessions", "duration_sum", "duration_count", "completion_sum", "completion_count"]
+# Missing demographics are 0 in the user aggregates (fillna(0)), which the
+# dashboard reads back from the CSV as "0"; the cube uses the same label
+CUBE_MISSING_LABEL = "0"
+
+def build_olap_cube(df: pd.DataFrame, user_clusters: pd.DataFrame) -> pd.DataFrame:
+    users = user_clusters.drop_duplicates("user_id").set_index("user_id")
+    sessions = df[df["user_id"].isin(users.index)]
+    watch_date = sessions["watch_date"] if "watch_date" in sessions.columns else pd.Series(pd.NaT, index=sessions.index)
+    fine = pd.DataFrame({
+        "user_id": sessions["user_id"],
+        "week": pd.to_datetime(watch_date, errors="coerce").dt.to_period("W").dt.start_time,
+        # Counted like sessions_count in the user aggregates: rows with a session_id
+        "sessions": sessions["session_id"].notna().astype(int) if "session_id" in sessions.columns else 1,
+    })
+    for name, col in USER_MEASURES.items():
+        fine[f"{name}_sum"] = sessions[col].fillna(0)
+        fine[f"{name}_count"] = sessions[col].notna().astype(int)
+    # Sessions -> (user, week) once; every level is then grouped from this table
+    fine = fine.groupby(["user_id", "week"], dropna=False).sum().reset_index()
+    attributes = users.reindex(fine["user_id"])
+    for dim in ("country", "subscription_type"):
+        fine[dim] = attributes[dim].astype("string").fillna(CUBE_MISSING_LABEL).to_numpy() if dim in users.columns else CUBE_MISSING_LABEL
+    fine["cluster_kmeans"] = attributes["cluster_kmeans"].astype("Int64").to_numpy() if "cluster_kmeans" in users.columns else pd.NA
+    fine["premium_user"] = fine["user_id"].where(fine["subscription_type"] == "Premium")
+
+    aggregations = {
+        "users": ("user_id", "nunique"),
+        "premium_users": ("premium_user", "nunique"),
+        **{m: (m, "sum") for m in CUBE_MEASURES if m not in ("users", "premium_users")},
+    }
+    levels = []
+    for grouping_id in range(2 ** len(CUBE_DIMENSIONS)):
+        dims = [d for i, d in enumerate(CUBE_DIMENSIONS) if not grouping_id >> i & 1]
+        keys = dims or np.zeros(len(fine), dtype=int)
+        cells = fine.groupby(keys, dropna=False, observed=True).agg(**aggregations)
+        cells = cells.reset_index() if dims else cells.reset_index(drop=True)
+        levels.append(cells.assign(grouping_id=grouping_id))
+    cube = pd.concat(levels, ignore_index=True)
+    cube["cluster_kmeans"] = cube["cluster_kmeans"].astype("Int64")
+    return cube[["grouping_id", *CUBE_DIMENSIONS, *CUBE_MEASURES]]
+
+def query_olap_cube(cube: pd.DataFrame, **filters) -> pd.Series:
+    grouping_id = sum(1 << i for i, d in enumerate(CUBE_DIMENSIONS) if d not in filters)
+    cells = cube[cube["grouping_id"] == grouping_id]
+    for dim, values in filters.items():
+        cells = cells[cells[dim].isin(values if isinstance(values, (list, tuple, set)) else [values])]
+    return cells[CUBE_MEASURES].sum()
+
+def export_olap_cube(cube: pd.DataFrame) -> Path:
+    out = PROCESSED_PATH / CUBE_FILE
+    cube.to_parquet(out, index=False, engine=PARQUET_ENGINE)
+    logging.info("OLAP cube exportado: %s (%s celdas)", out, len(cube))
+    return out
+
 # ---------------- Clustering ----------------------
 
+CLUSTER_BATCH_ROWS = 10000
+
+def clustering_mode() -> str:
+    return os.getenv("CLUSTERING_MODE", "full").lower()
+
+def cluster_features(user_agg: pd.DataFrame) -> list[str]:
+    features = ["sessions_count", "avg_duration", "duration_std", "avg_completion", "completion_std", "unique_content", "subscription_numeric"]
+    return features + [c for c in window_features() if c in user_agg.columns]
+
 def cluster_users(user_agg: pd.DataFrame, n_clusters: int = 3):
     if StandardScaler is None or KMeans is None:
         logging.warning("sklearn no disponible; se omite clustering")
         user_agg = user_agg.copy()
         user_agg["cluster_kmeans"] = 0
         return user_agg, pd.DataFrame()
-    features = ["sessions_count", "avg_duration", "duration_std", "avg_completion", "completion_std", "unique_content", "subscription_numeric"]
+    features = cluster_features(user_agg)
     X = user_agg[features].astype(float).values
     scaler = StandardScaler()
     X_scaled = scaler.fit_transform(X)
@@ -347,18 +1951,774 @@ def cluster_users(user_agg: pd.DataFrame, n_clusters: int = 3):
     cluster_profiles = user_agg.groupby("cluster_kmeans")[features].mean().round(2).reset_index()
     return user_agg, cluster_profiles
 
+# Optional model selection: every k in CLUSTER_K_RANGE is fitted in its own
+# worker process on the standardized matrix (shared as a memory-mapped .npy
+# in /dev/shm) and scored by inertia and by silhouette on one fixed random
+# sample of SILHOUETTE_SAMPLE users, which bounds the O(n^2) silhouette cost.
+K_SELECTION_FILE = "cluster_k_selection.csv"
+
+def cluster_k_range() -> list[int]:
+    spec = os.getenv("CLUSTER_K_RANGE", "").strip()
+    if not spec:
+        return []
+    low, _, high = spec.partition("-")
+    return list(range(int(low), int(high or low) + 1))
+
+def silhouette_sample_size() -> int:
+    return int(os.getenv("SILHOUETTE_SAMPLE", "10000"))
+
+def cluster_workers() -> int:
+    return int(os.getenv("CLUSTER_WORKERS", "0")) or os.cpu_count() or 1
+
+def _score_k(path: str, k: int, sample: np.ndarray, limit_threads: bool) -> dict:
+    from sklearn.metrics import silhouette_score
+    X = np.load(path, mmap_mode="r")
+    if limit_threads:
+        # One process per k: keep BLAS/OpenMP from oversubscribing the cores
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+    kmeans = KMeans(n_clusters=k, n_init=10, random_state=42).fit(X)
+    labels = kmeans.labels_[sample]
+    silhouette = silhouette_score(X[sample], labels) if len(np.unique(labels)) > 1 else np.nan
+    return {"k": k, "inertia": float(kmeans.inertia_), "silhouette": float(silhouette)}
+
+def select_n_clusters(user_agg: pd.DataFrame, k_values: list[int], sample_size: int | None = None,
+                      workers: int | None = None, seed: int = 42) -> tuple[int, pd.DataFrame]:
+    sample_size = silhouette_sample_size() if sample_size is None else sample_size
+    workers = min(workers or cluster_workers(), len(k_values))
+    features = cluster_features(user_agg)
+    X = StandardScaler().fit_transform(user_agg[features].astype(float).values)
+    k_values = [k for k in k_values if 2 <= k < len(X)]
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(len(X), size=min(sample_size, len(X)), replace=False))
+    shm = Path("/dev/shm")
+    with tempfile.TemporaryDirectory(dir=shm if shm.is_dir() else None) as tmp:
+        path = str(Path(tmp) / "features.npy")
+        np.save(path, X)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                rows = list(pool.map(_score_k, [path] * len(k_values), k_values, [sample] * len(k_values), [True] * len(k_values)))
+        else:
+            rows = [_score_k(path, k, sample, False) for k in k_values]
+    scores = pd.DataFrame(rows, columns=["k", "inertia", "silhouette"])
+    scores["sample_rows"] = len(sample)
+    best_k = int(scores.loc[scores["silhouette"].idxmax(), "k"]) if scores["silhouette"].notna().any() else 3
+    scores["selected"] = scores["k"] == best_k
+    logging.info("Selección de k: %s (silhouette muestral sobre %s usuarios)", best_k, len(sample))
+    return best_k, scores
+
+def export_k_selection(scores: pd.DataFrame) -> Path:
+    out = PROCESSED_PATH / K_SELECTION_FILE
+    scores.to_csv(out, index=False)
+    return out
+
+# Streaming variant: the scaler keeps a running mean/variance
+# (StandardScaler.partial_fit) and MiniBatchKMeans is fitted and applied batch
+# by batch, so only one batch of standardized features is materialized. Fit
+# batches visit users in a seeded random order: the first batch seeds the
+# centroids and users arrive sorted by id (or by store partition).
+def _shuffled_batches(frame: pd.DataFrame, batch_rows: int, seed: int = 42):
+    order = np.random.default_rng(seed).permutation(len(frame))
+    for start in range(0, len(frame), batch_rows):
+        yield frame.iloc[order[start:start + batch_rows]]
+
+def cluster_users_streaming(user_agg: pd.DataFrame, n_clusters: int = 3, batch_rows: int = CLUSTER_BATCH_ROWS, epochs: int = 3):
+    if StandardScaler is None or MiniBatchKMeans is None:
+        logging.warning("sklearn no disponible; se omite clustering")
+        user_agg = user_agg.copy()
+        user_agg["cluster_kmeans"] = 0
+        return user_agg, pd.DataFrame()
+    features = cluster_features(user_agg)
+    scaler = StandardScaler()
+    for batch in iter_chunks(user_agg[features], batch_rows):
+        scaler.partial_fit(batch.astype(float).values)
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=min(batch_rows, 1024), random_state=42)
+    for epoch in range(epochs):
+        for batch in _shuffled_batches(user_agg[features], batch_rows, seed=42 + epoch):
+            if len(batch) >= n_clusters:
+                kmeans.partial_fit(scaler.transform(batch.astype(float).values))
+    labels = [kmeans.predict(scaler.transform(batch.astype(float).values)) for batch in iter_chunks(user_agg[features], batch_rows)]
+    user_agg = user_agg.copy()
+    user_agg["cluster_kmeans"] = np.concatenate(labels) if labels else np.zeros(0, dtype=np.int32)
+    cluster_profiles = user_agg.groupby("cluster_kmeans")[features].mean().round(2).reset_index()
+    return user_agg, cluster_profiles
+
+# Persisted model: the fitted scaler, centroids and fit-time drift baselines
+# are kept in the state directory together with the last assignment of every
+# user. Runs only predict users that are new or whose features changed, and
+# refit when the mean squared distance to the centroids or the cluster shares
+# drift past CLUSTER_DRIFT_INERTIA / CLUSTER_DRIFT_SHIFT. Refitted centroids
+# are matched to the previous ones so cluster ids stay stable.
+CLUSTER_MODEL_FILE = "cluster_model.npz"
+CLUSTER_ASSIGNMENTS_FILE = "cluster_assignments.parquet"
+
+def cluster_drift_thresholds() -> tuple[float, float]:
+    return float(os.getenv("CLUSTER_DRIFT_INERTIA", "1.2")), float(os.getenv("CLUSTER_DRIFT_SHIFT", "0.1"))
+
+@dataclass
+class ClusterModel:
+    features: list[str]
+    mean: np.ndarray
+    scale: np.ndarray
+    centroids: np.ndarray
+    fit_inertia: float = 0.0
+    fit_shares: np.ndarray | None = None
+
+    @classmethod
+    def fit(cls, user_agg: pd.DataFrame, n_clusters: int = 3) -> "ClusterModel":
+        features = cluster_features(user_agg)
+        scaler = StandardScaler().fit(user_agg[features].astype(float).values)
+        kmeans = KMeans(n_clusters=n_clusters, n_init=10, random_state=42).fit(scaler.transform(user_agg[features].astype(float).values))
+        return cls(features, scaler.mean_, scaler.scale_, kmeans.cluster_centers_)
+
+    @classmethod
+    def from_labels(cls, user_agg: pd.DataFrame, labels: np.ndarray) -> "ClusterModel":
+        # Nearest-centroid model of existing labels (KMeans centroids at convergence)
+        features = cluster_features(user_agg)
+        X = user_agg[features].to_numpy(dtype=float)
+        mean, scale = X.mean(axis=0), X.std(axis=0)
+        scale[scale == 0] = 1.0
+        labels = np.asarray(labels, dtype=int)
+        sums = np.zeros((labels.max() + 1 if len(labels) else 0, len(features)))
+        np.add.at(sums, labels, (X - mean) / scale)
+        counts = np.maximum(np.bincount(labels, minlength=len(sums)), 1)
+        return cls(features, mean, scale, sums / counts[:, None])
+
+    @property
+    def n_clusters(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def version(self) -> str:
+        payload = json.dumps(self.features).encode() + np.round(np.concatenate([self.mean, self.scale, self.centroids.ravel()]), 8).tobytes()
+        return hashlib.sha1(payload).hexdigest()[:12]
+
+    def predict(self, frame: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+        X = (frame[self.features].to_numpy(dtype=float) - self.mean) / self.scale
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, one matrix product per call
+        distances = (X**2).sum(axis=1)[:, None] - 2 * X @ self.centroids.T + (self.centroids**2).sum(axis=1)
+        labels = distances.argmin(axis=1)
+        return labels, np.maximum(distances[np.arange(len(X)), labels], 0.0)
+
+    def set_baseline(self, labels: np.ndarray, sq_distances: np.ndarray) -> None:
+        self.fit_inertia = float(sq_distances.mean()) if len(sq_distances) else 0.0
+        self.fit_shares = np.bincount(labels, minlength=self.n_clusters) / max(len(labels), 1)
+
+    def align_to(self, previous: "ClusterModel") -> None:
+        if previous.n_clusters != self.n_clusters:
+            return
+        # Previous centroids in this model's standardized space
+        old = (previous.centroids * previous.scale + previous.mean - self.mean) / self.scale
+        cost = ((self.centroids[:, None, :] - old[None, :, :]) ** 2).sum(axis=2)
+        if scipy_stats is not None:
+            from scipy.optimize import linear_sum_assignment
+            rows, cols = linear_sum_assignment(cost)
+        else:
+            rows, cols = [], []
+            for flat in np.argsort(cost, axis=None):
+                i, j = divmod(int(flat), self.n_clusters)
+                if i not in rows and j not in cols:
+                    rows.append(i)
+                    cols.append(j)
+        order = np.empty(self.n_clusters, dtype=int)
+        order[np.asarray(cols)] = np.asarray(rows)
+        self.centroids = self.centroids[order]
+
+    def save(self, path: Path) -> None:
+        np.savez(path, features=np.array(self.features), mean=self.mean, scale=self.scale, centroids=self.centroids,
+                 fit_inertia=self.fit_inertia, fit_shares=self.fit_shares)
+
+    @classmethod
+    def load(cls, path: Path) -> "ClusterModel | None":
+        if not path.exists():
+            return None
+        with np.load(path) as state:
+            return cls(state["features"].tolist(), state["mean"], state["scale"], state["centroids"],
+                       float(state["fit_inertia"]), state["fit_shares"])
+
+def cluster_users_incremental(user_agg: pd.DataFrame, n_clusters: int = 3):
+    if StandardScaler is None or KMeans is None:
+        logging.warning("sklearn no disponible; se omite clustering")
+        user_agg = user_agg.copy()
+        user_agg["cluster_kmeans"] = 0
+        return user_agg, pd.DataFrame(), {}
+    model_file, assignments_file = _state_dir() / CLUSTER_MODEL_FILE, _state_dir() / CLUSTER_ASSIGNMENTS_FILE
+    model = ClusterModel.load(model_file)
+    features = cluster_features(user_agg)
+    hashes = pd.util.hash_pandas_object(user_agg[features], index=False).to_numpy()
+    info = {"predicted_users": len(user_agg), "refit": "initial"}
+    labels = sq_distances = None
+    unchanged = False
+    if model is not None and model.features == features and model.n_clusters == n_clusters and assignments_file.exists():
+        stored = pd.read_parquet(assignments_file)
+        previous = stored.set_index("user_id").reindex(user_agg["user_id"])
+        changed = (previous["feature_hash"].to_numpy() != hashes) | previous["cluster_kmeans"].isna().to_numpy()
+        labels = previous["cluster_kmeans"].fillna(0).to_numpy(dtype=int, copy=True)
+        sq_distances = previous["sq_distance"].fillna(0).to_numpy(dtype=float, copy=True)
+        if changed.any():
+            labels[changed], sq_distances[changed] = model.predict(user_agg[changed])
+        unchanged = not changed.any() and len(stored) == len(user_agg)
+        inertia_max, shift_max = cluster_drift_thresholds()
+        inertia_ratio = float(sq_distances.mean()) / model.fit_inertia if model.fit_inertia > 0 else 1.0
+        shares = np.bincount(labels, minlength=model.n_clusters) / max(len(labels), 1)
+        population_shift = 0.5 * float(np.abs(shares - model.fit_shares).sum())
+        info = {"predicted_users": int(changed.sum()), "inertia_ratio": round(inertia_ratio, 4),
+                "population_shift": round(population_shift, 4), "refit": ""}
+        if inertia_ratio > inertia_max:
+            info["refit"] = "inertia"
+        elif population_shift > shift_max:
+            info["refit"] = "population_shift"
+    if info["refit"]:
+        refitted = ClusterModel.fit(user_agg, n_clusters)
+        if model is not None:
+            refitted.align_to(model)
+        model = refitted
+        labels, sq_distances = model.predict(user_agg)
+        model.set_baseline(labels, sq_distances)
+        model.save(model_file)
+        logging.info("Clustering reajustado (%s)", info["refit"])
+    if info["refit"] or not unchanged:
+        pd.DataFrame({"user_id": user_agg["user_id"].to_numpy(), "cluster_kmeans": labels, "sq_distance": sq_distances,
+                      "feature_hash": hashes}).to_parquet(assignments_file, index=False, engine=PARQUET_ENGINE)
+    user_agg = user_agg.copy()
+    user_agg["cluster_kmeans"] = labels
+    cluster_profiles = user_agg.groupby("cluster_kmeans")[features].mean().round(2).reset_index()
+    return user_agg, cluster_profiles, info
+
+# Sample-fit / full-assign: the scaler and KMeans are fitted on a reproducible
+# stratified sample of CLUSTER_SAMPLE_SIZE users, then every user is assigned
+# to its nearest centroid chunk by chunk. Profiles are accumulated in the same
+# pass, so fit cost does not grow with the user base. The metrics compare the
+# mean squared distance of all users with that of the fitted sample.
+def cluster_sample_settings() -> tuple[int, list[str]]:
+    size = int(os.getenv("CLUSTER_SAMPLE_SIZE", "100000"))
+    strata = [c.strip() for c in os.getenv("CLUSTER_SAMPLE_STRATA", "subscription_type,country").split(",") if c.strip()]
+    return size, strata
+
+def cluster_users_sampled(user_agg: pd.DataFrame, n_clusters: int = 3, sample_size: int | None = None,
+                          strata: list[str] | None = None, chunk_rows: int = CLUSTER_BATCH_ROWS, seed: int = 42):
+    if StandardScaler is None or KMeans is None:
+        logging.warning("sklearn no disponible; se omite clustering")
+        user_agg = user_agg.copy()
+        user_agg["cluster_kmeans"] = 0
+        return user_agg, pd.DataFrame(), {}
+    default_size, default_strata = cluster_sample_settings()
+    sample_size = default_size if sample_size is None else sample_size
+    sample = draw_profile_sample(user_agg, sample_size, default_strata if strata is None else strata, seed)
+    fit_frame = user_agg if sample is None else sample.frame
+    model = ClusterModel.fit(fit_frame, n_clusters)
+    _, fit_distances = model.predict(fit_frame)
+
+    features = model.features
+    sums = np.zeros((n_clusters, len(features)))
+    counts = np.zeros(n_clusters, dtype=np.int64)
+    labels, total_distance = [], 0.0
+    for chunk in iter_chunks(user_agg, chunk_rows):
+        chunk_labels, distances = model.predict(chunk)
+        np.add.at(sums, chunk_labels, chunk[features].to_numpy(dtype=float))
+        counts += np.bincount(chunk_labels, minlength=n_clusters)
+        total_distance += distances.sum()
+        labels.append(chunk_labels)
+    user_agg = user_agg.copy()
+    user_agg["cluster_kmeans"] = np.concatenate(labels) if labels else np.zeros(0, dtype=np.int64)
+    present = counts > 0
+    cluster_profiles = pd.DataFrame(sums[present] / counts[present, None], columns=features).round(2)
+    cluster_profiles.insert(0, "cluster_kmeans", np.flatnonzero(present))
+    inertia_full = float(total_distance) / max(len(user_agg), 1)
+    inertia_sample = float(fit_distances.mean()) if len(fit_distances) else 0.0
+    info = {
+        "sample_rows": len(fit_frame),
+        "inertia_sample": round(inertia_sample, 4),
+        "inertia_full": round(inertia_full, 4),
+        "inertia_gap": round(inertia_full / inertia_sample - 1, 4) if inertia_sample > 0 else 0.0,
+    }
+    logging.info("Clustering por muestra: %s de %s usuarios, inercia %.4f (muestra %.4f)",
+                 len(fit_frame), len(user_agg), inertia_full, inertia_sample)
+    return user_agg, cluster_profiles, info
+
+# ---------------- Hierarchical segmentation -------
+# BIRCH summarizes the standardized users into a CF-tree built batch by batch
+# (partial_fit), and Ward agglomeration runs on the leaf subcluster centroids
+# only, so memory grows with the number of subclusters instead of n^2. The
+# linkage is exported in scipy format (leaves = subclusters) for dendrograms.
+HIERARCHICAL_LINKAGE_FILE = "hierarchical_linkage.csv"
+HIERARCHICAL_LEAVES_FILE = "hierarchical_leaves.csv"
+
+def hierarchical_settings() -> tuple[int, float]:
+    return int(os.getenv("HIERARCHICAL_SEGMENTS", "0")), float(os.getenv("BIRCH_THRESHOLD", "1.0"))
+
+def hierarchical_segmentation(user_agg: pd.DataFrame, n_segments: int, threshold: float = 1.0,
+                              batch_rows: int = CLUSTER_BATCH_ROWS) -> tuple[pd.Series, np.ndarray, pd.DataFrame]:
+    features = cluster_features(user_agg)
+    scaler = StandardScaler()
+    for batch in iter_chunks(user_agg[features], batch_rows):
+        scaler.partial_fit(batch.astype(float).values)
+    birch = Birch(threshold=threshold, n_clusters=None)
+    for batch in iter_chunks(user_agg[features], batch_rows):
+        birch.partial_fit(scaler.transform(batch.astype(float).values))
+    centers = birch.subcluster_centers_
+    leaves = np.concatenate([birch.predict(scaler.transform(batch.astype(float).values))
+                             for batch in iter_chunks(user_agg[features], batch_rows)])
+    if len(centers) > 1:
+        linkage = scipy_hierarchy.linkage(centers, method="ward")
+        leaf_segments = scipy_hierarchy.fcluster(linkage, t=n_segments, criterion="maxclust") - 1
+    else:
+        linkage = np.zeros((0, 4))
+        leaf_segments = np.zeros(len(centers), dtype=int)
+    leaf_table = pd.DataFrame({
+        "subcluster": np.arange(len(centers)),
+        "users": np.bincount(leaves, minlength=len(centers)),
+        "cluster_hierarchical": leaf_segments,
+    })
+    labels = pd.Series(leaf_segments[leaves], index=user_agg.index, name="cluster_hierarchical")
+    logging.info("Segmentación jerárquica: %s subclusters BIRCH, %s segmentos", len(centers), len(np.unique(leaf_segments)))
+    return labels, linkage, leaf_table
+
+def export_hierarchical_segmentation(linkage: np.ndarray, leaf_table: pd.DataFrame) -> Path:
+    out = PROCESSED_PATH / HIERARCHICAL_LINKAGE_FILE
+    pd.DataFrame(linkage, columns=["left", "right", "distance", "size"]).astype({"left": int, "right": int, "size": int}).to_csv(out, index=False)
+    leaf_table.to_csv(PROCESSED_PATH / HIERARCHICAL_LEAVES_FILE, index=False)
+    return out
+
+# ---------------- Similar users index --------------
+# Euclidean LSH over the standardized clustering features: each of
+# SIMILAR_USERS_TABLES tables keys a user by SIMILAR_USERS_HASHES quantized
+# random projections, floor((a.x + b) / w), with the width w tuned on a sample
+# so a bucket holds about SIMILAR_USERS_BUCKET users. Buckets are ranges of the
+# sorted keys (binary search); a query re-ranks the union of its buckets by
+# exact distance and falls back to a full scan when they hold fewer than k
+# users. The index is persisted in the state directory and only users that are
+# new or whose features changed are re-projected on later runs.
+SIMILAR_USERS_FILE = "similar_users_index.npz"
+SIMILAR_USERS_HASHES = 6
+# Updates keep the fitted mean/scale/width; once the bucket occupancy drifts
+# past this factor of the SIMILAR_USERS_BUCKET target the index is rebuilt
+SIMILAR_USERS_MAX_DRIFT = 2.0
+_LSH_KEY_MULTIPLIERS = np.array([1, 1000003, 998244353, 2305843009213693951, 7919, 104729, 15485863, 32452843], dtype=np.int64)
+
+def similar_users_settings() -> tuple[int, int]:
+    return int(os.getenv("SIMILAR_USERS_TABLES", "8")), int(os.getenv("SIMILAR_USERS_BUCKET", "512"))
+
+def _lsh_keys(vectors: np.ndarray, projections: np.ndarray, offsets: np.ndarray, width: float) -> np.ndarray:
+    hashes = np.floor(np.einsum("nd,thd->nth", vectors, projections) / width + offsets).astype(np.int64)
+    # Integer overflow wraps, which is fine for a bucket key
+    return (hashes * _LSH_KEY_MULTIPLIERS[: projections.shape[1]]).sum(axis=2)
+
+def _tune_lsh_width(vectors: np.ndarray, projections: np.ndarray, offsets: np.ndarray, bucket: int, population: int) -> float:
+    # Mean bucket occupancy seen by a query grows with w; bisect on log w
+    low, high = -8.0, 8.0
+    for _ in range(24):
+        width = 2.0 ** ((low + high) / 2)
+        _, counts = np.unique(_lsh_keys(vectors, projections[:1], offsets[:1], width), return_counts=True)
+        occupancy = (counts.astype(float) ** 2).sum() / len(vectors) * population / len(vectors)
+        low, high = (low, (low + high) / 2) if occupancy > bucket else ((low + high) / 2, high)
+    return 2.0 ** ((low + high) / 2)
+
+@dataclass
+class SimilarUsersIndex:
+    features: list[str]
+    mean: np.ndarray
+    scale: np.ndarray
+    projections: np.ndarray
+    offsets: np.ndarray
+    width: float
+    users: np.ndarray
+    vectors: np.ndarray
+    feature_hash: np.ndarray
+    keys: np.ndarray | None = None
+    order: np.ndarray | None = None
+
+    def __post_init__(self):
+        if self.keys is None:
+            self.keys = _lsh_keys(self.vectors, self.projections, self.offsets, self.width)
+        self._reindex(sort=self.order is None)
+
+    @classmethod
+    def build(cls, user_agg: pd.DataFrame, tables: int | None = None, bucket: int | None = None,
+              sample_size: int = 20000, seed: int = 42) -> "SimilarUsersIndex":
+        default_tables, default_bucket = similar_users_settings()
+        tables, bucket = tables or default_tables, bucket or default_bucket
+        features = cluster_features(user_agg)
+        X = _model_matrix(user_agg, features)
+        mean, scale = X.mean(axis=0), X.std(axis=0)
+        scale[scale == 0] = 1.0
+        vectors = ((X - mean) / scale).astype(np.float32)
+        rng = np.random.default_rng(seed)
+        projections = rng.standard_normal((tables, SIMILAR_USERS_HASHES, len(features)))
+        offsets = rng.uniform(0.0, 1.0, (tables, SIMILAR_USERS_HASHES))
+        sample = vectors[rng.choice(len(vectors), size=min(sample_size, len(vectors)), replace=False)]
+        width = _tune_lsh_width(sample, projections, offsets, bucket, len(vectors)) if len(sample) else 1.0
+        return cls(features, mean, scale, projections, offsets, width, _id_array(user_agg["user_id"]), vectors,
+                   pd.util.hash_pandas_object(user_agg[features], index=False).to_numpy())
+
+    def _reindex(self, sort: bool) -> None:
+        if sort:
+            self.order = np.ascontiguousarray(np.argsort(self.keys, axis=0, kind="stable").T)
+        self._sorted = np.take_along_axis(self.keys.T, self.order, axis=1)
+        self._rows = pd.Index(self.users)
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def occupancy(self) -> float:
+        # Mean bucket size seen by a query of an indexed user (what _tune_lsh_width targets)
+        if not len(self.users):
+            return 0.0
+        sizes = [np.diff(np.r_[np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]), len(keys)]) for keys in self._sorted]
+        return float(np.mean([(size.astype(float) ** 2).sum() / len(self.users) for size in sizes]))
+
+    def update(self, user_agg: pd.DataFrame) -> int:
+        hashes = pd.util.hash_pandas_object(user_agg[self.features], index=False).to_numpy()
+        previous = self._rows.get_indexer(user_agg["user_id"])
+        changed = (previous < 0) | (self.feature_hash[previous] != hashes)
+        vectors = self.vectors[previous].copy()
+        keys = self.keys[previous].copy()
+        if changed.any():
+            fresh = ((_model_matrix(user_agg[changed], self.features) - self.mean) / self.scale).astype(np.float32)
+            vectors[changed], keys[changed] = fresh, _lsh_keys(fresh, self.projections, self.offsets, self.width)
+        # Users missing from user_agg are dropped
+        self.users, self.vectors, self.keys, self.feature_hash = _id_array(user_agg["user_id"]), vectors, keys, hashes
+        self._reindex(sort=True)
+        return int(changed.sum())
+
+    def query_vector(self, vector: np.ndarray, k: int = 10, exclude: int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        vector = np.asarray(vector, dtype=np.float32)
+        key = _lsh_keys(vector[None, :], self.projections, self.offsets, self.width)[0]
+        buckets = []
+        for t, sorted_keys in enumerate(self._sorted):
+            lo, hi = np.searchsorted(sorted_keys, key[t], "left"), np.searchsorted(sorted_keys, key[t], "right")
+            buckets.append(self.order[t, lo:hi])
+        candidates = np.sort(np.concatenate(buckets))
+        candidates = candidates[np.r_[True, candidates[1:] != candidates[:-1]]]
+        if exclude is not None:
+            candidates = candidates[candidates != exclude]
+        if len(candidates) < k:
+            candidates = np.arange(len(self.users))
+            candidates = candidates[candidates != exclude] if exclude is not None else candidates
+        distances = ((self.vectors[candidates] - vector) ** 2).sum(axis=1)
+        if len(candidates) > k:
+            top = np.argpartition(distances, k - 1)[:k]
+            candidates, distances = candidates[top], distances[top]
+        order = np.lexsort((candidates, distances))
+        return candidates[order], np.sqrt(distances[order])
+
+    def query(self, user_id, k: int = 10) -> pd.DataFrame:
+        row = self._rows.get_loc(user_id)
+        rows, distances = self.query_vector(self.vectors[row], k, exclude=row)
+        return pd.DataFrame({"user_id": self.users[rows], "distance": distances})
+
+    def save(self, path: Path) -> None:
+        np.savez(path, features=np.asarray(self.features, dtype=str), mean=self.mean, scale=self.scale,
+                 projections=self.projections, offsets=self.offsets, width=self.width, users=self.users,
+                 vectors=self.vectors, feature_hash=self.feature_hash, keys=self.keys, order=self.order)
+
+    @classmethod
+    def load(cls, path: Path) -> "SimilarUsersIndex | None":
+        if not path.exists():
+            return None
+        with np.load(path, allow_pickle=False) as state:
+            return cls(state["features"].tolist(), state["mean"], state["scale"], state["projections"], state["offsets"],
+                       float(state["width"]), state["users"], state["vectors"], state["feature_hash"], state["keys"], state["order"])
+
+def update_similar_users_index(user_agg: pd.DataFrame) -> tuple[SimilarUsersIndex, dict]:
+    index_file = _state_dir() / SIMILAR_USERS_FILE
+    index = SimilarUsersIndex.load(index_file)
+    tables, bucket = similar_users_settings()
+    reusable = index is not None and len(index) and index.features == cluster_features(user_agg) and len(index.projections) == tables
+    info = {"rebuilt": not reusable}
+    if reusable:
+        previous_users = index._rows
+        info["updated_users"] = index.update(user_agg)
+        info["dropped_users"] = int((~previous_users.isin(index._rows)).sum())
+        # Feature drift shows up as buckets filling up or emptying out
+        info["drift"] = round(index.occupancy() / max(min(bucket, len(index)), 1), 2)
+        if len(index) and not 1 / SIMILAR_USERS_MAX_DRIFT <= info["drift"] <= SIMILAR_USERS_MAX_DRIFT:
+            logging.warning("Similar users index: ocupación %.2fx del objetivo, reconstruyendo", info["drift"])
+            info["rebuilt"] = True
+    if info["rebuilt"]:
+        index = SimilarUsersIndex.build(user_agg)
+        info["updated_users"] = len(index)
+    if info["rebuilt"] or info["updated_users"] or info.get("dropped_users"):
+        index.save(index_file)
+    info["bucket_width"] = round(index.width, 4)
+    return index, info
+
+# ---------------- Retention prediction ------------
+# The Random Forest from the Phase 2 notebook, trained on the cohort `retained`
+# flag only when no model is stored, its features changed or RETENTION_RETRAIN
+# is set (trees are built on all cores). The fitted model is pickled in the
+# state directory with a content hash as its version, so regular runs only pay
+# for predict_proba, scored in RETENTION_BATCH_ROWS chunks.
+RETENTION_MODEL_FILE = "retention_model.pkl"
+RETENTION_FEATURES = ["sessions_count", "avg_duration", "avg_completion", "unique_content", "age",
+                      "duration_std", "completion_std", "subscription_numeric", "cluster_kmeans"]
+
+def retention_settings() -> tuple[bool, int]:
+    retrain = os.getenv("RETENTION_RETRAIN", "0").lower() in ("1", "true", "yes")
+    return retrain, int(os.getenv("RETENTION_BATCH_ROWS", str(CHUNK_ROWS)))
+
+def _model_matrix(frame: pd.DataFrame, features: list[str]) -> np.ndarray:
+    X = frame.reindex(columns=features).to_numpy(dtype=float, copy=True)
+    X[~np.isfinite(X)] = 0.0
+    return X
+
+@dataclass
+class RetentionModel:
+    features: list[str]
+    estimator: object
+    version: str = ""
+    train_rows: int = 0
+
+    @classmethod
+    def fit(cls, user_agg: pd.DataFrame, features: list[str] | None = None, n_jobs: int = -1) -> "RetentionModel":
+        features = [c for c in (features or RETENTION_FEATURES) if c in user_agg.columns]
+        estimator = RandomForestClassifier(n_estimators=200, max_depth=10, min_samples_split=5, min_samples_leaf=2,
+                                           class_weight="balanced", random_state=42, n_jobs=n_jobs)
+        estimator.fit(_model_matrix(user_agg, features), user_agg["retained"].to_numpy(dtype=int))
+        model = cls(features, estimator, train_rows=len(user_agg))
+        model.version = hashlib.sha1(pickle.dumps((features, estimator))).hexdigest()[:12]
+        return model
+
+    def churn_probability(self, frame: pd.DataFrame, batch_rows: int = CHUNK_ROWS) -> np.ndarray:
+        classes = list(self.estimator.classes_)
+        if 1 not in classes:
+            return np.ones(len(frame))
+        retained_col = classes.index(1)
+        scores = [1.0 - self.estimator.predict_proba(_model_matrix(chunk, self.features))[:, retained_col]
+                  for chunk in iter_chunks(frame, batch_rows)]
+        return np.concatenate(scores) if scores else np.zeros(0)
+
+    def save(self, path: Path) -> None:
+        # Plain dict so the file loads whether the module runs as a script or a package
+        with open(path, "wb") as fh:
+            pickle.dump({"features": self.features, "estimator": self.estimator, "version": self.version,
+                         "train_rows": self.train_rows}, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path: Path) -> "RetentionModel | None":
+        if not path.exists():
+            return None
+        with open(path, "rb") as fh:
+            return cls(**pickle.load(fh))
+
+def predict_retention(user_agg: pd.DataFrame, retrain: bool | None = None, batch_rows: int | None = None):
+    default_retrain, default_batch = retention_settings()
+    retrain = default_retrain if retrain is None else retrain
+    batch_rows = default_batch if batch_rows is None else batch_rows
+    model_file = _state_dir() / RETENTION_MODEL_FILE
+    model = None if retrain else RetentionModel.load(model_file)
+    features = [c for c in RETENTION_FEATURES if c in user_agg.columns]
+    info = {"trained": False}
+    if model is None or model.features != features:
+        model = RetentionModel.fit(user_agg, features)
+        model.save(model_file)
+        info = {"trained": True, "train_rows": model.train_rows, "retained_rate": round(float(user_agg["retained"].mean()), 4)}
+        logging.info("Modelo de retención entrenado (version %s, %s usuarios)", model.version, model.train_rows)
+    info["model_version"] = model.version
+    user_agg = user_agg.copy()
+    churn = model.churn_probability(user_agg, batch_rows)
+    # Written right after the cluster labels
+    position = user_agg.columns.get_loc("cluster_kmeans") + 1 if "cluster_kmeans" in user_agg.columns else len(user_agg.columns)
+    user_agg.insert(position, "churn_probability", churn.round(4))
+    return user_agg, model, info
+
+# ---------------- Permutation importance ----------
+# Drop in score when one feature column is shuffled: ROC AUC of the retention
+# model and label agreement of the cluster model. The feature matrix of a
+# reproducible PERMUTATION_SAMPLE of users is written once as a memory-mapped
+# .npy in /dev/shm; each worker process takes one feature, copies only row
+# chunks while scoring, and runs every repeat. Results are cached against the
+# model version in the state directory and recomputed only when it changes.
+FEATURE_IMPORTANCE_FILE = "feature_importance.csv"
+CLUSTER_IMPORTANCE_FILE = "cluster_feature_importance.csv"
+IMPORTANCE_CACHE_FILE = "feature_importance_cache.json"
+
+def importance_settings() -> tuple[int, int, int]:
+    repeats = int(os.getenv("PERMUTATION_REPEATS", "5"))
+    sample = int(os.getenv("PERMUTATION_SAMPLE", "50000"))
+    workers = int(os.getenv("IMPORTANCE_WORKERS", "0")) or os.cpu_count() or 1
+    return repeats, sample, workers
+
+def _model_predictions(model, X: np.ndarray, column: int | None = None, values: np.ndarray | None = None,
+                       chunk_rows: int = CHUNK_ROWS) -> np.ndarray:
+    out = []
+    for start in range(0, len(X), chunk_rows):
+        block = np.array(X[start:start + chunk_rows], dtype=float)
+        if column is not None:
+            block[:, column] = values[start:start + chunk_rows]
+        if isinstance(model, ClusterModel):
+            out.append(model.predict(pd.DataFrame(block, columns=model.features))[0])
+        else:
+            classes = list(model.estimator.classes_)
+            proba = model.estimator.predict_proba(block)
+            out.append(proba[:, classes.index(1)] if 1 in classes else np.zeros(len(block)))
+    return np.concatenate(out) if out else np.zeros(0)
+
+def _importance_score(model, target: np.ndarray, predictions: np.ndarray) -> float:
+    if isinstance(model, ClusterModel):
+        return float((predictions == target).mean())
+    if len(np.unique(target)) > 1:
+        from sklearn.metrics import roc_auc_score
+        return float(roc_auc_score(target, predictions))
+    return float(((predictions >= 0.5).astype(int) == target).mean())
+
+def _permutation_drops(matrix_path: str, target_path: str, model_path: str, column: int, repeats: int,
+                       seed: int, baseline: float, limit_threads: bool) -> np.ndarray:
+    X = np.load(matrix_path, mmap_mode="r")
+    target = np.load(target_path)
+    with open(model_path, "rb") as fh:
+        model = pickle.load(fh)
+    if limit_threads:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(1)
+        if isinstance(model, RetentionModel):
+            model.estimator.n_jobs = 1
+    rng = np.random.default_rng([seed, column])
+    drops = np.empty(repeats)
+    for r in range(repeats):
+        shuffled = rng.permutation(np.asarray(X[:, column]))
+        drops[r] = baseline - _importance_score(model, target, _model_predictions(model, X, column, shuffled))
+    return drops
+
+def permutation_importance(model, user_agg: pd.DataFrame, target: np.ndarray, repeats: int | None = None,
+                           sample_size: int | None = None, workers: int | None = None, seed: int = 42) -> pd.DataFrame:
+    default_repeats, default_sample, default_workers = importance_settings()
+    repeats = default_repeats if repeats is None else repeats
+    sample_size = default_sample if sample_size is None else sample_size
+    workers = min(workers or default_workers, len(model.features))
+    rows = np.arange(len(user_agg))
+    if sample_size and len(rows) > sample_size:
+        rows = np.sort(np.random.default_rng(seed).choice(len(rows), size=sample_size, replace=False))
+    X = _model_matrix(user_agg.iloc[rows], model.features)
+    target = np.asarray(target)[rows]
+    baseline = _importance_score(model, target, _model_predictions(model, X))
+    shm = Path("/dev/shm")
+    with tempfile.TemporaryDirectory(dir=shm if shm.is_dir() else None) as tmp:
+        matrix_path, target_path, model_path = (str(Path(tmp) / name) for name in ("features.npy", "target.npy", "model.pkl"))
+        np.save(matrix_path, X)
+        np.save(target_path, target)
+        with open(model_path, "wb") as fh:
+            pickle.dump(model, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        columns = list(range(len(model.features)))
+        args = ([matrix_path] * len(columns), [target_path] * len(columns), [model_path] * len(columns), columns,
+                [repeats] * len(columns), [seed] * len(columns), [baseline] * len(columns))
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                drops = list(pool.map(_permutation_drops, *args, [True] * len(columns)))
+        else:
+            drops = [_permutation_drops(*task, False) for task in zip(*args)]
+    drops = np.vstack(drops)
+    return pd.DataFrame({"importance_mean": drops.mean(axis=1), "importance_std": drops.std(axis=1)},
+                        index=pd.Index(model.features, name="feature")).sort_values("importance_mean", ascending=False)
+
+def labels_version(user_ids: pd.Series, labels: np.ndarray, features: list[str]) -> str:
+    # A labeling refitted every run (ClusterModel.from_labels) gets new centroids
+    # whenever the aggregates move; keyed on the assignments instead, the
+    # importance is only recomputed when some user changes cluster
+    frame = pd.DataFrame({"user_id": np.asarray(user_ids), "label": np.asarray(labels)}).sort_values("user_id")
+    payload = json.dumps(features).encode() + pd.util.hash_pandas_object(frame, index=False).to_numpy().tobytes()
+    return hashlib.sha1(payload).hexdigest()[:12]
+
+def cached_permutation_importance(name: str, model, user_agg: pd.DataFrame, target: np.ndarray, out: Path,
+                                  version: str | None = None) -> tuple[pd.DataFrame | None, bool]:
+    cache_file = _state_dir() / IMPORTANCE_CACHE_FILE
+    cache = json.loads(cache_file.read_text()) if cache_file.exists() else {}
+    version = version or model.version
+    key = {"version": version, "settings": list(importance_settings()[:2])}
+    if cache.get(name) == key and out.exists():
+        return None, True
+    importance = permutation_importance(model, user_agg, target)
+    # Same layout as notebooks/output/feature_importance.csv: feature index, one value column
+    importance["importance_mean"].rename(0).rename_axis(None).to_csv(out)
+    cache[name] = key
+    cache_file.write_text(json.dumps(cache, indent=2))
+    logging.info("Permutation importance %s (modelo %s) exportado: %s", name, version, out)
+    return importance, False
+
+# ---------------- Cluster recommendations ---------
+# Every session votes for its title within the viewer's cluster, weighted by
+# completion and halved every RECOMMENDATION_HALF_LIFE_DAYS before the latest
+# watch_date; one groupby ranks titles per cluster. Users get their cluster's
+# list minus the titles they already watched, probed as (user, code) pairs
+# against the per-user content sets for all users at once; users who watched
+# most of the head of the list are retried with a longer prefix.
+RECOMMENDATIONS_FILE = "user_recommendations.parquet"
+CLUSTER_TOP_CONTENT_FILE = "cluster_top_content.parquet"
+
+def recommendation_settings() -> tuple[int, float]:
+    return int(os.getenv("RECOMMENDATIONS_TOP_N", "10")), float(os.getenv("RECOMMENDATION_HALF_LIFE_DAYS", "30"))
+
+def cluster_content_scores(df: pd.DataFrame, user_clusters: pd.DataFrame, half_life_days: float = 30.0) -> pd.DataFrame:
+    labels = user_clusters.drop_duplicates("user_id").set_index("user_id")["cluster_kmeans"]
+    cluster = labels.reindex(df["user_id"]).to_numpy()
+    weight = pd.to_numeric(df["completion_rate"], errors="coerce").fillna(0).clip(0, 100).to_numpy() / 100
+    if "watch_date" in df.columns:
+        dates = pd.to_datetime(df["watch_date"], errors="coerce")
+        age_days = ((dates.max() - dates) / pd.Timedelta(days=1)).to_numpy(dtype=float)
+        weight = weight * np.where(np.isnan(age_days), 1.0, 0.5 ** (age_days / half_life_days))
+    votes = pd.DataFrame({"cluster_kmeans": cluster, "content_id": df["content_id"].to_numpy(), "score": weight})
+    votes = votes[votes["cluster_kmeans"].notna() & votes["content_id"].notna()]
+    scores = votes.groupby(["cluster_kmeans", "content_id"], sort=False)["score"].sum().reset_index()
+    scores["cluster_kmeans"] = scores["cluster_kmeans"].astype(int)
+    scores = scores.sort_values(["cluster_kmeans", "score", "content_id"], ascending=[True, False, True], ignore_index=True)
+    scores["rank"] = scores.groupby("cluster_kmeans").cumcount() + 1
+    return scores
+
+def recommend_for_users(scores: pd.DataFrame, user_clusters: pd.DataFrame, content_sets: UserContentSets,
+                        top_n: int = 10) -> pd.DataFrame:
+    titles = content_sets.catalog.append(pd.Index(scores["content_id"].unique()).difference(content_sets.catalog))
+    # Clusters whose users have no scored sessions keep an empty (all -1) list
+    n_clusters = int(max(scores["cluster_kmeans"].max() if len(scores) else -1,
+                         user_clusters["cluster_kmeans"].max() if len(user_clusters) else -1)) + 1
+    longest = int(scores["rank"].max()) if len(scores) else 0
+    # Cluster x rank matrix of title codes, -1 past the end of a cluster's list
+    ranked = np.full((max(n_clusters, 1), max(longest, 1)), -1, dtype=np.int64)
+    ranked[scores["cluster_kmeans"].to_numpy(), scores["rank"].to_numpy() - 1] = titles.get_indexer(scores["content_id"])
+    users = user_clusters["user_id"].to_numpy()
+    labels = user_clusters["cluster_kmeans"].to_numpy(dtype=int)
+    rows = content_sets.users.get_indexer(users)
+    pending, width, parts = np.arange(len(users)), min(2 * top_n, longest), []
+    while len(pending) and width > 0:
+        candidates = ranked[labels[pending], :width]
+        fresh = (candidates >= 0) & ~content_sets.contains(rows[pending, None], candidates)
+        position = np.cumsum(fresh, axis=1)
+        done = (position[:, -1] >= top_n) | (width >= longest)
+        take = fresh & (position <= top_n) & done[:, None]
+        user_pos, column = np.nonzero(take)
+        parts.append((pending[user_pos], position[user_pos, column], candidates[user_pos, column]))
+        pending, width = pending[~done], min(2 * width, longest)
+    if parts:
+        user_idx, rank, code = (np.concatenate(p) for p in zip(*parts))
+    else:
+        user_idx = rank = code = np.zeros(0, dtype=np.int64)
+    order = np.lexsort((rank, user_idx))
+    return pd.DataFrame({
+        "user_id": users[user_idx[order]],
+        "rank": rank[order].astype(np.int16),
+        "content_id": pd.Categorical.from_codes(code[order], categories=titles),
+    })
+
+def export_recommendations(scores: pd.DataFrame, recommendations: pd.DataFrame, top_n: int) -> Path:
+    out = PROCESSED_PATH / RECOMMENDATIONS_FILE
+    recommendations.to_parquet(out, index=False, engine=PARQUET_ENGINE)
+    scores[scores["rank"] <= top_n].to_parquet(PROCESSED_PATH / CLUSTER_TOP_CONTENT_FILE, index=False, engine=PARQUET_ENGINE)
+    logging.info("Recomendaciones exportadas: %s (%s filas)", out, len(recommendations))
+    return out
+
 # ---------------- Load & Exports ------------------
 
-def load_incremental(df: pd.DataFrame) -> None:
+def load_incremental(df: pd.DataFrame) -> pd.DataFrame:
     output_file = PROCESSED_PATH / "streaming_data.parquet"
-    if output_file.exists():
-        existing = pd.read_parquet(output_file)
+    if _current(output_file).exists():
+        existing = pd.read_parquet(_current(output_file))
         if "session_id" in df.columns and "session_id" in existing.columns:
             new_data = df[~df["session_id"].isin(existing["session_id"])]
             final = pd.concat([existing, new_data], ignore_index=True)
         else:
+            new_data = df
             final = pd.concat([existing, df], ignore_index=True)
     else:
+        new_data = df
         final = df
     
     # Convert date columns to datetime before saving to parquet
@@ -367,8 +2727,10 @@ def load_incremental(df: pd.DataFrame) -> None:
         if col in final.columns:
             final[col] = pd.to_datetime(final[col], errors='coerce')
     
-    final.to_parquet(output_file, index=False, engine='fastparquet')
+    # Staged: promoted together with the incremental states by commit_staged_state
+    final.to_parquet(_staged(output_file), index=False, engine=PARQUET_ENGINE)
     logging.info("Datos cargados en %s, total %s registros", output_file, len(final))
+    return new_data
 
 
 def export_analysis_outputs(user_agg: pd.DataFrame, cluster_profiles: pd.DataFrame) -> None:
@@ -387,8 +2749,11 @@ def etl_pipeline(dataset_label: str = "real") -> None:
         users = extract_users()
         m["rows"] = len(users)
     with track("extract_sessions") as m:
-        sessions = extract_sessions()
+        sketches = {column: HeavyHitterSketch() for column in SKEW_COLUMNS}
+        sessions = extract_sessions(sketches)
         m["rows"] = len(sessions)
+        m.update(skew_metrics(sketches, skew_threshold()))
+        heavy_users = sketches["user_id"].heavy_keys(skew_threshold())
     with track("extract_content") as m:
         content = extract_content()
         m["rows"] = len(content)
@@ -397,40 +2762,159 @@ def etl_pipeline(dataset_label: str = "real") -> None:
         df = transform(users, sessions, content)
         m["rows"] = len(df)
 
-    # Phase 2 reports
-    with track("descriptive_stats_users"):
-        generate_descriptive_stats(users, "users")
-    with track("dq_users"):
-        generate_data_quality_report(users, "users")
-    with track("outliers_users"):
-        detect_outliers_iqr(users, "users")
-
-    with track("descriptive_stats_sessions"):
-        generate_descriptive_stats(sessions, "sessions")
-    with track("dq_sessions"):
-        generate_data_quality_report(sessions, "sessions")
-    with track("outliers_sessions"):
-        detect_outliers_iqr(sessions, "sessions")
-
-    with track("descriptive_stats_content"):
-        generate_descriptive_stats(content, "content")
-    with track("dq_content"):
-        generate_data_quality_report(content, "content")
-    with track("outliers_content"):
-        detect_outliers_iqr(content, "content")
-
-    with track("aggregate_user_metrics") as m:
-        user_agg = aggregate_user_metrics(df)
+    # Phase 2 reports (PROFILE_SAMPLE_SIZE > 0 profiles a sample instead)
+    sample_size, strata, seed = profile_settings()
+    for name, frame in (("users", users), ("sessions", sessions), ("content", content)):
+        sample = draw_profile_sample(frame, sample_size, strata, seed) if sample_size else None
+        extra = {"sample_rows": sample.sample_rows} if sample is not None else None
+        with track(f"descriptive_stats_{name}", extra):
+            generate_descriptive_stats(frame, name, sample)
+        with track(f"dq_{name}", extra):
+            generate_data_quality_report(frame, name, sample)
+        with track(f"outliers_{name}", extra):
+            detect_outliers_iqr(frame, name, sample)
+
+    with track("outlier_flags") as m:
+        df = add_outlier_flags(df)
+        m["flagged_rows"] = int((df[OUTLIER_FLAGS_COLUMN] > 0).sum())
+
+    with track("load_incremental") as m:
+        m["recovery"] = recover_staged_state()
+        new_rows = load_incremental(df)
+        m["rows"] = len(df)
+        m["new_rows"] = len(new_rows)
+
+    with track("aggregate_user_metrics", {"mode": aggregation_mode()}) as m:
+        user_agg, m["touched_users"] = aggregate_users(df, new_rows, heavy_users)
+        if aggregation_mode() == "parallel":
+            m["workers"] = aggregation_workers()
+            m["salted_users"] = len(heavy_users)
         m["rows"] = len(user_agg)
-    with track("cluster_users") as m:
-        user_agg_with_clusters, cluster_profiles = cluster_users(user_agg)
+    with track("engagement_windows") as m:
+        activity = engagement_activity(new_rows, df)
+        user_agg = add_window_metrics(user_agg, sliding_window_metrics(activity))
+        m["rows"] = len(activity)
+        m["new_rows"] = len(new_rows)
+    with track("cohort_retention") as m:
+        active_weeks = update_user_active_weeks(new_rows)
+        matrix, retained = cohort_retention(active_weeks, assign_cohorts(users, active_weeks))
+        export_cohort_retention(matrix)
+        user_agg["retained"] = retained.reindex(user_agg["user_id"], fill_value=0).to_numpy()
+        m["rows"] = len(matrix)
+        m["retained_users"] = int(user_agg["retained"].sum())
+    with track("user_content_sets") as m:
+        content_sets = load_user_content_sets()
+        export_user_content_sets(content_sets)
+        m["rows"] = len(content_sets.users)
+        m["bytes"] = content_sets.nbytes
+    with track("content_aggregation") as m:
+        by_title, by_genre = aggregate_content_metrics(update_content_statistics(new_rows), content, content_sets)
+        export_content_aggregation(by_title, by_genre)
+        m["rows"] = len(by_title)
+        m["new_rows"] = len(new_rows)
+    if scipy_sparse is not None:
+        with track("content_similarity") as m:
+            interaction_value, similar_k = interaction_settings()
+            interactions, _, catalog = user_content_matrix(df, interaction_value)
+            similar_content = content_similarity(interactions, catalog, similar_k)
+            export_content_similarity(similar_content)
+            m["rows"] = len(similar_content)
+            m["nnz"] = interactions.nnz
+            m["density"] = round(interactions.nnz / max(interactions.shape[0] * interactions.shape[1], 1), 6)
+    n_clusters = 3
+    if cluster_k_range() and StandardScaler is not None:
+        with track("select_n_clusters") as m:
+            n_clusters, k_scores = select_n_clusters(user_agg, cluster_k_range())
+            export_k_selection(k_scores)
+            m["rows"] = len(user_agg)
+            m["selected_k"] = n_clusters
+    with track("cluster_users", {"mode": clustering_mode()}) as m:
+        if clustering_mode() == "incremental":
+            user_agg_with_clusters, cluster_profiles, info = cluster_users_incremental(user_agg, n_clusters)
+            m.update(info)
+        elif clustering_mode() == "sample":
+            user_agg_with_clusters, cluster_profiles, info = cluster_users_sampled(user_agg, n_clusters)
+            m.update(info)
+        elif clustering_mode() == "streaming":
+            user_agg_with_clusters, cluster_profiles = cluster_users_streaming(user_agg, n_clusters)
+        else:
+            user_agg_with_clusters, cluster_profiles = cluster_users(user_agg, n_clusters)
+        m["n_clusters"] = n_clusters
         m["rows"] = len(user_agg_with_clusters)
+    n_segments, birch_threshold = hierarchical_settings()
+    if n_segments and Birch is not None and scipy_hierarchy is not None:
+        with track("hierarchical_segmentation") as m:
+            segments, linkage, leaf_table = hierarchical_segmentation(user_agg_with_clusters, n_segments, birch_threshold)
+            user_agg_with_clusters["cluster_hierarchical"] = segments
+            export_hierarchical_segmentation(linkage, leaf_table)
+            m["rows"] = len(user_agg_with_clusters)
+            m["subclusters"] = len(leaf_table)
+    with track("similar_users_index") as m:
+        similar_users, info = update_similar_users_index(user_agg_with_clusters)
+        m.update(info)
+        m["rows"] = len(similar_users)
+        probes = similar_users.users[:: max(len(similar_users) // 100, 1)][:100]
+        started = time.perf_counter()
+        for user_id in probes:
+            similar_users.query(user_id, 10)
+        m["query_ms"] = round((time.perf_counter() - started) * 1000 / max(len(probes), 1), 4)
+    if RandomForestClassifier is not None and "retained" in user_agg_with_clusters.columns:
+        with track("retention_prediction") as m:
+            user_agg_with_clusters, retention_model, info = predict_retention(user_agg_with_clusters)
+            m.update(info)
+            m["rows"] = len(user_agg_with_clusters)
     with track("export_analysis_outputs"):
         export_analysis_outputs(user_agg_with_clusters, cluster_profiles)
+    if StandardScaler is not None:
+        with track("feature_importance") as m:
+            labels = user_agg_with_clusters["cluster_kmeans"].to_numpy()
+            cluster_model = ClusterModel.load(_state_dir() / CLUSTER_MODEL_FILE) if clustering_mode() == "incremental" else None
+            if cluster_model is None:
+                cluster_model = ClusterModel.from_labels(user_agg_with_clusters, labels)
+                cluster_version = labels_version(user_agg_with_clusters["user_id"], labels, cluster_model.features)
+            else:
+                cluster_version = cluster_model.version
+            importance_models = [("cluster", cluster_model, cluster_version, labels, PROCESSED_PATH / CLUSTER_IMPORTANCE_FILE)]
+            if "churn_probability" in user_agg_with_clusters.columns:
+                importance_models.append(("retention", retention_model, retention_model.version,
+                                          user_agg_with_clusters["retained"].to_numpy(), PROCESSED_PATH / FEATURE_IMPORTANCE_FILE))
+            for name, model, version, target, out in importance_models:
+                _, cached = cached_permutation_importance(name, model, user_agg_with_clusters, target, out, version)
+                m[f"{name}_cached"] = cached
+                m[f"{name}_model_version"] = version
+            m["rows"] = len(user_agg_with_clusters)
+    with track("cluster_recommendations") as m:
+        top_n, half_life = recommendation_settings()
+        title_scores = cluster_content_scores(df, user_agg_with_clusters, half_life)
+        recommendations = recommend_for_users(title_scores, user_agg_with_clusters, content_sets, top_n)
+        export_recommendations(title_scores, recommendations, top_n)
+        m["rows"] = len(recommendations)
+        m["users"] = len(user_agg_with_clusters)
+        m["short_users"] = len(user_agg_with_clusters) - int((recommendations.groupby("user_id", sort=False).size() >= top_n).sum())
+    with track("olap_cube") as m:
+        cube = build_olap_cube(df, user_agg_with_clusters)
+        export_olap_cube(cube)
+        m["rows"] = len(cube)
+    with track("hypothesis_tests") as m:
+        tests = run_segment_hypothesis_tests(df, user_agg_with_clusters)
+        export_hypothesis_tests(tests)
+        m["rows"] = len(tests)
 
-    with track("load_incremental") as m:
-        load_incremental(df)
-        m["rows"] = len(df)
+    with track("session_rollups") as m:
+        weekly = export_session_rollups(update_daily_rollup(new_rows))
+        m["rows"] = len(new_rows)
+    with track("seasonal_decomposition") as m:
+        export_seasonal_decomposition(weekly)
+        m["rows"] = len(weekly)
+
+    with track("correlation_sessions") as m:
+        export_correlations(update_session_correlations(new_rows), "sessions")
+        m["rows"] = len(new_rows)
+    with track("commit_load") as m:
+        m["files"] = commit_staged_state()
+    with track("correlation_users") as m:
+        export_correlations(correlations_from_frame(user_agg_with_clusters, USER_CORR_FEATURES), "users")
+        m["rows"] = len(user_agg_with_clusters)
 
     export_metrics(dataset_label)
 
@@ -1,4 +1,6 @@
 
+from pathlib import Path
+
 import streamlit as st
 import pandas as pd
 import plotly.express as px
@@ -18,7 +20,24 @@ st.set_page_config(
 def load_data():
     return pd.read_csv('output/user_aggregation_with_clusters.csv')
 
+@st.cache_data
+def load_cube():
+    # Precomputed by the ETL olap_cube stage; None falls back to scanning users
+    path = Path(__file__).resolve().parent.parent / 'etl' / 'data' / 'processed' / 'olap_cube.parquet'
+    return pd.read_parquet(path) if path.exists() else None
+
+def cube_totals(cube, countries, subscriptions, clusters):
+    # Level grouped by country, subscription and cluster with week rolled up (grouping_id bit 3)
+    cells = cube[
+        (cube['grouping_id'] == 8) &
+        (cube['country'].isin(countries)) &
+        (cube['subscription_type'].isin(subscriptions)) &
+        (cube['cluster_kmeans'].isin(clusters))
+    ]
+    return cells[['users', 'sessions']].sum()
+
 df = load_data()
+cube = load_cube()
 
 # Sidebar filters
 st.sidebar.header(" Filters")
@@ -47,6 +66,13 @@ filtered_df = df[
     (df['cluster_kmeans'].isin(selected_clusters))
 ]
 
+if cube is not None:
+    totals = cube_totals(cube, selected_countries, selected_subscriptions, selected_clusters)
+    all_totals = cube[cube['grouping_id'] == 15][['users', 'sessions']].sum()
+else:
+    totals = pd.Series({'users': len(filtered_df), 'sessions': filtered_df['sessions_count'].sum()})
+    all_totals = pd.Series({'users': len(df), 'sessions': df['sessions_count'].sum()})
+
 # Main dashboard
 st.title(" Streaming Platform Analytics Dashboard")
 st.markdown("Real-time insights into user behavior, content performance, and business metrics")
@@ -57,16 +83,15 @@ col1, col2, col3, col4 = st.columns(4)
 with col1:
     st.metric(
         label="Total Users",
-        value=f"{len(filtered_df):,}",
-        delta=f"{len(filtered_df) - len(df):,}"
+        value=f"{int(totals['users']):,}",
+        delta=f"{int(totals['users'] - all_totals['users']):,}"
     )
 
 with col2:
-    total_sessions = filtered_df['sessions_count'].sum()
     st.metric(
         label="Total Sessions",
-        value=f"{total_sessions:,}",
-        delta=f"{total_sessions - df['sessions_count'].sum():,}"
+        value=f"{int(totals['sessions']):,}",
+        delta=f"{int(totals['sessions'] - all_totals['sessions']):,}"
     )
 
 with col3:
@@ -23,7 +23,21 @@ from etl.etl_pipeline_enhanced import (
     extract_users, extract_sessions, extract_content,
     validate_users, validate_sessions, validate_content,
     aggregate_user_metrics, cluster_users, load_incremental,
-    transform
+    transform, draw_profile_sample, detect_outliers_iqr,
+    generate_data_quality_report, iqr_outlier_kernel, add_outlier_flags,
+    OUTLIER_FLAGS_COLUMN, CoMomentAccumulator, run_segment_hypothesis_tests,
+    update_daily_rollup, daily_session_rollup, seasonal_decomposition,
+    aggregate_user_metrics_streaming, iter_chunks, UserAggregateState,
+    aggregate_user_metrics_sorted, update_user_aggregate_store, load_user_aggregates,
+    aggregate_user_metrics_parallel, UserContentSets, update_content_statistics,
+    aggregate_content_metrics, build_olap_cube, query_olap_cube, HeavyHitterSketch,
+    partition_sessions, update_user_activity, sliding_window_metrics, add_window_metrics,
+    update_user_active_weeks, assign_cohorts, cohort_retention, cluster_users_streaming,
+    cluster_users_incremental, select_n_clusters, cluster_users_sampled, hierarchical_segmentation,
+    predict_retention, permutation_importance, cached_permutation_importance, ClusterModel,
+    user_content_matrix, content_similarity, SimilarUsersIndex, update_similar_users_index,
+    cluster_content_scores, recommend_for_users, commit_staged_state, recover_staged_state,
+    load_user_content_sets, engagement_activity, aggregate_users, labels_version
 )
 
 class TestDataExtraction(unittest.TestCase):
@@ -211,6 +225,264 @@ class TestDataTransformation(unittest.TestCase):
         for col in expected_columns:
             self.assertIn(col, result.columns)
 
+class TestProfileSampling(unittest.TestCase):
+    """Test sampled Phase 2 profiling"""
+    
+    def setUp(self):
+        """Set up a population with known outliers and nulls"""
+        rng = np.random.default_rng(0)
+        n = 20000
+        values = rng.normal(50, 5, n)
+        values[:1000] = 500  # 5% outliers
+        age = rng.integers(18, 80, n).astype(float)
+        age[::10] = np.nan  # 10% nulls
+        self.population = pd.DataFrame({
+            'value': values,
+            'age': age,
+            'country': rng.choice(['Argentina', 'Mexico', 'Brazil'], n, p=[0.6, 0.3, 0.1]),
+        })
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        """Clean up test data"""
+        import shutil
+        shutil.rmtree(self.temp_dir)
+    
+    def test_sample_is_reproducible_and_stratified(self):
+        """Test that the same seed draws the same proportional sample"""
+        a = draw_profile_sample(self.population, 2000, ['country'], seed=7)
+        b = draw_profile_sample(self.population, 2000, ['country'], seed=7)
+        
+        self.assertTrue(a.frame.index.equals(b.frame.index))
+        self.assertAlmostEqual(a.sample_rows, 2000, delta=3)
+        self.assertEqual(a.population_rows, len(self.population))
+        shares = a.frame['country'].value_counts(normalize=True)
+        expected = self.population['country'].value_counts(normalize=True)
+        for country in expected.index:
+            self.assertAlmostEqual(shares[country], expected[country], places=2)
+        self.assertIsNone(draw_profile_sample(self.population, len(self.population), ['country']))
+    
+    def test_counts_scaled_to_population(self):
+        """Test that sampled counts are scaled back with confidence intervals"""
+        sample = draw_profile_sample(self.population, 4000, ['country'], seed=1)
+        
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            outliers = pd.read_csv(detect_outliers_iqr(self.population, 'test', sample))
+            quality = pd.read_csv(generate_data_quality_report(self.population, 'test', sample))
+        
+        row = outliers.set_index('column').loc['value']
+        self.assertLessEqual(row['outliers_count_ci_lower'], 1000)
+        self.assertGreaterEqual(row['outliers_count_ci_upper'], 1000)
+        self.assertEqual(row['population_rows'], len(self.population))
+        nulls = quality.set_index('column').loc['age']
+        self.assertLessEqual(nulls['null_count_ci_lower'], 2000)
+        self.assertGreaterEqual(nulls['null_count_ci_upper'], 2000)
+
+class TestOutlierFlags(unittest.TestCase):
+    """Test the vectorized IQR kernel and row-level outlier bitmask"""
+    
+    def setUp(self):
+        """Set up data with outliers in two columns"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.data = pd.DataFrame({
+            'user_id': ['U001', 'U002', 'U003', 'U004', 'U005', 'U006'],
+            'duration_watched': [60, 62, 58, 61, 900, np.nan],
+            'completion_rate': [80.0, 82.0, 79.0, 1.0, 81.0, 80.0],
+        })
+    
+    def tearDown(self):
+        """Clean up test data"""
+        import shutil
+        shutil.rmtree(self.temp_dir)
+    
+    def test_kernel_matches_per_column_percentiles(self):
+        """Test that the 2-D kernel reproduces per-column IQR bounds"""
+        cols = ['duration_watched', 'completion_rate']
+        lower, upper, mask = iqr_outlier_kernel(self.data[cols].to_numpy(dtype=float))
+        
+        for i, col in enumerate(cols):
+            q1, q3 = np.percentile(self.data[col].dropna(), [25, 75])
+            self.assertAlmostEqual(lower[i], q1 - 1.5 * (q3 - q1))
+            self.assertAlmostEqual(upper[i], q3 + 1.5 * (q3 - q1))
+        self.assertEqual(mask.sum(axis=0).tolist(), [1, 1])
+    
+    def test_row_bitmask(self):
+        """Test that each row carries one bit per outlier column"""
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            result = add_outlier_flags(self.data)
+            bit_columns = json.loads((Path(self.temp_dir) / 'outlier_flags_columns.json').read_text())
+        
+        flags = result[OUTLIER_FLAGS_COLUMN].tolist()
+        self.assertEqual(bit_columns, ['duration_watched', 'completion_rate'])
+        self.assertEqual(flags, [0, 0, 0, 2, 1, 0])
+
+class TestStreamingCorrelation(unittest.TestCase):
+    """Test mergeable co-moment accumulators"""
+    
+    def setUp(self):
+        """Set up correlated data with missing values"""
+        rng = np.random.default_rng(3)
+        x = rng.normal(size=500)
+        self.data = pd.DataFrame({
+            'duration_watched': x,
+            'completion_rate': 2 * x + rng.normal(size=500),
+            'age': rng.normal(size=500),
+        })
+        self.data.iloc[::25, 2] = np.nan
+        self.columns = list(self.data.columns)
+    
+    def test_chunked_merge_matches_pandas(self):
+        """Test that chunk updates and merges reproduce DataFrame.corr()"""
+        left = CoMomentAccumulator(self.columns)
+        left.update_frame(self.data.iloc[:200], chunk_rows=64)
+        right = CoMomentAccumulator(self.columns)
+        right.update_frame(self.data.iloc[200:], chunk_rows=64)
+        left.merge(right)
+        
+        expected = self.data.dropna().corr()
+        self.assertEqual(left.n, len(self.data.dropna()))
+        np.testing.assert_allclose(left.correlation().to_numpy(), expected.to_numpy(), atol=1e-10)
+    
+    def test_significance(self):
+        """Test pairwise Pearson significance against scipy"""
+        from scipy import stats
+        acc = CoMomentAccumulator(self.columns)
+        acc.update_frame(self.data)
+        tests = acc.significance().set_index(['var1', 'var2'])
+        
+        clean = self.data.dropna()
+        r, p_value = stats.pearsonr(clean['duration_watched'], clean['age'])
+        row = tests.loc[('duration_watched', 'age')]
+        self.assertAlmostEqual(row['r'], r, places=10)
+        self.assertAlmostEqual(row['p_value'], p_value, places=8)
+        self.assertTrue(tests.loc[('duration_watched', 'completion_rate'), 'significant'])
+
+class TestSegmentHypothesisTests(unittest.TestCase):
+    """Test batch Welch t-tests over segment pairs"""
+    
+    def setUp(self):
+        """Set up sessions for two countries and two subscription types"""
+        rng = np.random.default_rng(5)
+        n = 400
+        self.sessions = pd.DataFrame({
+            'user_id': [f'U{i % 40:03d}' for i in range(n)],
+            'country': np.where(np.arange(n) % 2 == 0, 'Mexico', 'Brazil'),
+            'subscription_type': np.where(np.arange(n) % 3 == 0, 'Premium', 'Basic'),
+            'duration_watched': rng.normal(60, 10, n),
+            'completion_rate': rng.uniform(0, 100, n),
+        })
+        self.sessions.loc[self.sessions['subscription_type'] == 'Premium', 'duration_watched'] += 15
+        self.clusters = pd.DataFrame({
+            'user_id': [f'U{i:03d}' for i in range(40)],
+            'cluster_kmeans': [(i // 2) % 2 for i in range(40)],
+        })
+    
+    def test_matches_scipy_welch(self):
+        """Test rolled-up segments against scipy's Welch t-test"""
+        from scipy import stats
+        tests = run_segment_hypothesis_tests(self.sessions, self.clusters)
+        row = tests[(tests['metric'] == 'duration_watched') & (tests['dimensions'] == 'subscription_type')].iloc[0]
+        
+        premium = self.sessions.loc[self.sessions['subscription_type'] == 'Premium', 'duration_watched']
+        basic = self.sessions.loc[self.sessions['subscription_type'] == 'Basic', 'duration_watched']
+        t_stat, p_value = stats.ttest_ind(basic, premium, equal_var=False)
+        self.assertAlmostEqual(row['t_stat'], t_stat, places=8)
+        self.assertAlmostEqual(row['p_value'], p_value, places=10)
+        self.assertEqual(row['effect_size'], 'large')
+        self.assertTrue(row['significant'])
+    
+    def test_all_pairs_and_corrections(self):
+        """Test that every segment pair is tested and p-values are adjusted"""
+        tests = run_segment_hypothesis_tests(self.sessions, self.clusters)
+        full = tests[(tests['metric'] == 'completion_rate') & (tests['dimensions'] == 'country+subscription_type+cluster_kmeans')]
+        
+        self.assertEqual(len(full), 28)  # 8 segments -> 8 * 7 / 2 pairs
+        self.assertTrue((tests['p_holm'] >= tests['p_value']).all())
+        self.assertTrue((tests['p_fdr_bh'] >= tests['p_value']).all())
+        self.assertTrue((tests['p_holm'] >= tests['p_fdr_bh']).all())
+
+class TestSessionRollups(unittest.TestCase):
+    """Test incremental daily rollups and seasonal decomposition"""
+    
+    def setUp(self):
+        """Set up two batches of sessions"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.sessions = pd.DataFrame({
+            'session_id': ['S001', 'S002', 'S003', 'S004', 'S005'],
+            'watch_date': ['2023-01-02', '2023-01-02', '2023-01-03', '2023-01-03', '2023-01-10'],
+            'country': ['Mexico', 'Brazil', 'Mexico', 'Mexico', None],
+            'duration_watched': [60, 90, 30, np.nan, 45],
+            'completion_rate': [80.0, 90.0, 50.0, 70.0, 60.0],
+        })
+    
+    def tearDown(self):
+        """Clean up test data"""
+        import shutil
+        shutil.rmtree(self.temp_dir)
+    
+    def test_incremental_matches_full_rollup(self):
+        """Test that folding batches gives the same rollup as one pass"""
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            update_daily_rollup(self.sessions.iloc[:3], ['country'])
+            result = update_daily_rollup(self.sessions.iloc[3:], ['country'])
+        
+        expected = daily_session_rollup(self.sessions, ['country'])
+        pd.testing.assert_frame_equal(
+            result.sort_values(['watch_date', 'country']).reset_index(drop=True),
+            expected.sort_values(['watch_date', 'country']).reset_index(drop=True),
+            check_dtype=False,
+        )
+        mexico = result[(result['country'] == 'Mexico') & (result['watch_date'] == '2023-01-03')].iloc[0]
+        self.assertEqual(mexico['sessions'], 2)
+        self.assertEqual(mexico['duration_watched_count'], 1)
+    
+    def test_seasonal_decomposition(self):
+        """Test that a periodic weekly series is split into trend and season"""
+        pattern = np.array([10.0, -5.0, 0.0, -5.0])
+        weeks = pd.date_range('2023-01-02', periods=24, freq='W-MON')
+        series = pd.Series(100 + np.arange(24) + np.tile(pattern, 6), index=weeks)
+        result = seasonal_decomposition(series)
+        
+        self.assertEqual(result['period'].iloc[0], 4)
+        np.testing.assert_allclose(result['seasonal'].to_numpy()[:4], pattern)
+        np.testing.assert_allclose(result['resid'].dropna().to_numpy(), 0, atol=1e-9)
+
+class TestSkewDetection(unittest.TestCase):
+    """Test heavy-hitter sketches and salted partitioning"""
+    
+    def setUp(self):
+        """Set up a skewed key stream"""
+        rng = np.random.default_rng(7)
+        self.keys = pd.Series([f"U{x:04d}" for x in np.minimum(rng.zipf(1.5, 20000), 5000)])
+    
+    def test_sketch_bounds_true_counts(self):
+        """Test that chunked updates bracket the exact top-k counts"""
+        sketch = HeavyHitterSketch(k=16, width=512)
+        for start in range(0, len(self.keys), 3000):
+            sketch.update(self.keys.iloc[start:start + 3000])
+        
+        exact = self.keys.value_counts()
+        top = sketch.top(3).set_index('key')
+        self.assertEqual(list(top.index), list(exact.index[:3]))
+        self.assertTrue((top['count_lower'] <= exact[top.index]).all())
+        self.assertTrue((top['count_upper'] >= exact[top.index]).all())
+        self.assertIn('U0001', sketch.heavy_keys(0.1))
+    
+    def test_salted_partitions_are_balanced(self):
+        """Test that salting heavy keys evens out shard loads"""
+        sketch = HeavyHitterSketch()
+        sketch.update(self.keys)
+        codes, users = pd.factorize(self.keys)
+        heavy_codes = np.flatnonzero(pd.Index(users).isin(sketch.heavy_keys(0.01)))
+        order, offsets = partition_sessions(codes, 4, heavy_codes)
+        plain = np.diff(partition_sessions(codes, 4)[1])
+        salted = np.diff(offsets)
+        np.testing.assert_array_equal(np.sort(order), np.arange(len(codes)))
+        # Each shard is a contiguous slice of rows in their original order
+        self.assertTrue(all((np.diff(order[lo:hi]) > 0).all() for lo, hi in zip(offsets[:-1], offsets[1:])))
+        self.assertLess(salted.max() / salted.mean(), plain.max() / plain.mean())
+        self.assertLess(salted.max() / salted.mean(), 1.1)
+
 class TestDataAggregation(unittest.TestCase):
     """Test data aggregation functions"""
     
@@ -246,6 +518,438 @@ class TestDataAggregation(unittest.TestCase):
         user_001 = result[result['user_id'] == 'U001'].iloc[0]
         self.assertEqual(user_001['sessions_count'], 2)
         self.assertEqual(user_001['unique_content'], 2)
+    
+    def test_streaming_aggregation_matches_groupby(self):
+        """Test that chunked mergeable state reproduces the groupby output"""
+        data = self.test_data.copy()
+        data.loc[1, 'duration_watched'] = np.nan
+        data.loc[0, 'age'] = np.nan
+        expected = aggregate_user_metrics(data)
+        
+        result = aggregate_user_metrics_streaming(iter_chunks(data, chunk_rows=2))
+        pd.testing.assert_frame_equal(result, expected)
+        
+        left, right = UserAggregateState(), UserAggregateState()
+        left.fold(data.iloc[:3])
+        right.fold(data.iloc[3:])
+        left.merge(right)
+        pd.testing.assert_frame_equal(left.to_frame(), expected)
+    
+    def test_sorted_kernel_matches_groupby(self):
+        """Test that the sort-based kernel reproduces the groupby output"""
+        data = self.test_data.sample(frac=1, random_state=1).reset_index(drop=True)
+        data.loc[0, 'completion_rate'] = np.nan
+        data.loc[1, 'content_id'] = None
+        data.loc[2, 'subscription_type'] = None
+        
+        result = aggregate_user_metrics_sorted(data)
+        pd.testing.assert_frame_equal(result, aggregate_user_metrics(data))
+    
+    def test_incremental_store_updates_touched_users(self):
+        """Test that the persisted store merges new sessions per user"""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(temp_dir)):
+                update_user_aggregate_store(self.test_data.iloc[:3])
+                touched = update_user_aggregate_store(self.test_data.iloc[3:])
+                result = load_user_aggregates()
+        finally:
+            import shutil
+            shutil.rmtree(temp_dir)
+        
+        self.assertEqual(touched, 2)  # U002 and U003
+        pd.testing.assert_frame_equal(result, aggregate_user_metrics(self.test_data), check_dtype=False)
+    
+    def test_store_deltas_merge_and_compact(self):
+        """Test that per-run delta files read like the compacted base and are compacted after USER_STORE_MAX_DELTAS"""
+        temp_dir = tempfile.mkdtemp()
+        store = Path(temp_dir) / 'user_aggregate_store'
+        try:
+            with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(temp_dir)), \
+                 patch('etl.etl_pipeline_enhanced.USER_STORE_COMPACT_RATIO', 10.0), \
+                 patch('etl.etl_pipeline_enhanced.USER_STORE_MAX_DELTAS', 2):
+                deltas = []
+                for end in range(1, len(self.test_data) + 1):
+                    update_user_aggregate_store(self.test_data.iloc[end - 1:end])
+                    commit_staged_state()
+                    deltas.append(len(json.loads((store / 'store.json').read_text())['deltas']))
+                    pd.testing.assert_frame_equal(load_user_aggregates(), aggregate_user_metrics(self.test_data.iloc[:end]),
+                                                  check_dtype=False)
+                    self.assertEqual(load_user_content_sets().counts().sum(),
+                                     self.test_data.iloc[:end].drop_duplicates(['user_id', 'content_id']).shape[0])
+                # The next update prunes the files the last compaction replaced
+                update_user_aggregate_store(self.test_data.iloc[:0])
+                stored = {p.stem for p in store.glob('*.parquet')}
+        finally:
+            import shutil
+            shutil.rmtree(temp_dir)
+        
+        self.assertEqual(deltas, [0, 1, 2, 0, 1])
+        self.assertEqual(stored, {'base-0002-000', 'delta-000002'})
+    
+    def test_store_follows_batches_loaded_in_other_modes(self):
+        """Test that switching AGGREGATION_MODE between runs does not drop rows from the store"""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(temp_dir)):
+                for mode, batch in (('incremental', self.test_data.iloc[:2]), ('pandas', self.test_data.iloc[2:4]),
+                                    ('incremental', self.test_data.iloc[4:])):
+                    with patch.dict(os.environ, {'AGGREGATION_MODE': mode}):
+                        user_agg, _ = aggregate_users(batch, load_incremental(batch))
+                    commit_staged_state()
+        finally:
+            import shutil
+            shutil.rmtree(temp_dir)
+        
+        pd.testing.assert_frame_equal(user_agg, aggregate_user_metrics(self.test_data), check_dtype=False)
+    
+    def test_interrupted_load_is_not_lost(self):
+        """Test that the dedup history and the store are committed together"""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(temp_dir)):
+                update_user_aggregate_store(load_incremental(self.test_data.iloc[:3]))
+                commit_staged_state()
+                # Crash after the load, before the commit: rows must come back as new
+                update_user_aggregate_store(load_incremental(self.test_data.iloc[3:]))
+                self.assertEqual(recover_staged_state(), "discarded")
+                new_rows = load_incremental(self.test_data)
+                self.assertEqual(len(new_rows), 2)
+                update_user_aggregate_store(new_rows)
+                # Crash during the commit: the manifest rolls it forward
+                with patch('etl.etl_pipeline_enhanced._promote_staged', side_effect=OSError):
+                    with self.assertRaises(OSError):
+                        commit_staged_state()
+                self.assertEqual(recover_staged_state(), "rolled_forward")
+                result = load_user_aggregates()
+                history = pd.read_parquet(Path(temp_dir) / "streaming_data.parquet")
+        finally:
+            import shutil
+            shutil.rmtree(temp_dir)
+        
+        self.assertEqual(len(history), 5)
+        pd.testing.assert_frame_equal(result, aggregate_user_metrics(self.test_data), check_dtype=False)
+    
+    def test_user_content_sets(self):
+        """Test per-user content sets: distinct counts, merge, membership and overlaps"""
+        sets = UserContentSets.from_frame(self.test_data)
+        expected = aggregate_user_metrics(self.test_data).set_index('user_id')['unique_content']
+        pd.testing.assert_series_equal(sets.counts(), expected, check_names=False, check_dtype=False)
+        
+        merged = UserContentSets.from_frame(self.test_data.iloc[3:]).merge(UserContentSets.from_frame(self.test_data.iloc[:3]))
+        self.assertEqual(sorted(merged.contents('U001')), ['C001', 'C002'])
+        self.assertEqual(merged.overlap('U001', 'U002'), 1)  # C001
+        self.assertEqual(merged.overlap_counts('U003').to_dict(), {'U001': 1, 'U002': 0, 'U003': 1})
+        self.assertEqual(merged.subset(pd.Index(['U003', 'U009'])).counts().tolist(), [1, 0])
+    
+    def test_content_sets_keep_integer_ids(self):
+        """Test that integer user/content ids survive the saved sets and the store"""
+        data = self.test_data.assign(user_id=[1, 1, 2, 2, 3], content_id=[10, 20, 10, 30, 20])
+        temp_dir = tempfile.mkdtemp()
+        try:
+            UserContentSets.from_frame(data).save(Path(temp_dir) / 'sets.npz')
+            loaded = UserContentSets.load(Path(temp_dir) / 'sets.npz')
+            with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(temp_dir)):
+                update_user_aggregate_store(data.iloc[:3])
+                update_user_aggregate_store(data.iloc[3:])
+                result = load_user_aggregates()
+                stored = load_user_content_sets()
+        finally:
+            import shutil
+            shutil.rmtree(temp_dir)
+        
+        self.assertEqual(loaded.users.tolist(), [1, 2, 3])
+        self.assertEqual(sorted(loaded.contents(1)), [10, 20])
+        pd.testing.assert_frame_equal(result, aggregate_user_metrics(data), check_dtype=False)
+        self.assertEqual(stored.counts().sort_index().tolist(), [2, 2, 1])
+    
+    def test_parallel_shards_match_groupby(self):
+        """Test that hash-partitioned worker shards concatenate to the groupby output"""
+        data = self.test_data.copy()
+        data.loc[4, 'completion_rate'] = np.nan
+        
+        result = aggregate_user_metrics_parallel(data, workers=2)
+        pd.testing.assert_frame_equal(result, aggregate_user_metrics(data))
+        
+        salted = aggregate_user_metrics_parallel(data, workers=2, heavy_keys=['U001'])
+        pd.testing.assert_frame_equal(salted, aggregate_user_metrics(data))
+
+class TestEngagementWindows(unittest.TestCase):
+    """Test incremental 7/30/90-day per-user windows"""
+    
+    def setUp(self):
+        """Set up two batches of sessions"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.sessions = pd.DataFrame({
+            'session_id': ['S001', 'S002', 'S003', 'S004', 'S005', 'S006'],
+            'user_id': ['U001', 'U001', 'U002', 'U001', 'U002', 'U003'],
+            'watch_date': ['2023-01-01', '2023-03-20', '2023-03-25', '2023-04-10', '2023-04-12', '2023-04-15'],
+            'duration_watched': [100, 60, 30, 45, np.nan, 20],
+        })
+    
+    def tearDown(self):
+        """Clean up test data"""
+        import shutil
+        shutil.rmtree(self.temp_dir)
+    
+    def test_incremental_windows(self):
+        """Test that folded batches give windows as of the latest day and drop expired days"""
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            update_user_activity(self.sessions.iloc[:3])
+            activity = update_user_activity(self.sessions.iloc[3:])
+        windows = sliding_window_metrics(activity)
+        
+        self.assertNotIn(pd.Timestamp('2023-01-01'), set(activity['watch_date']))  # older than 90 days
+        u001 = windows.loc['U001']
+        self.assertEqual((u001['sessions_7d'], u001['sessions_30d'], u001['sessions_90d']), (1, 2, 2))
+        self.assertEqual(u001['minutes_30d'], 105)
+        self.assertEqual(windows.loc['U002', 'sessions_7d'], 1)
+        self.assertEqual(windows.loc['U002', 'minutes_7d'], 0)
+        
+        user_agg = add_window_metrics(pd.DataFrame({'user_id': ['U001', 'U004']}), windows)
+        self.assertEqual(user_agg['sessions_90d'].tolist(), [2, 0])
+    
+    def test_windows_match_aggregated_sessions(self):
+        """Test that windows come from the same sessions as the user aggregates"""
+        batch = self.sessions.iloc[3:].assign(content_id='C001', completion_rate=50.0, age=30, subscription_type='Basic', country='Mexico')
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            update_user_activity(self.sessions.iloc[:3])
+            with patch.dict(os.environ, {'AGGREGATION_MODE': 'pandas'}):
+                windows = sliding_window_metrics(engagement_activity(batch, batch))
+        
+        user_agg = add_window_metrics(aggregate_user_metrics(batch), windows).set_index('user_id')
+        self.assertTrue((user_agg['sessions_90d'] <= user_agg['sessions_count']).all())
+        self.assertEqual(user_agg.loc['U001', 'sessions_90d'], 1)  # S002 belongs to an earlier batch
+
+    def test_activity_follows_batches_loaded_in_other_modes(self):
+        """Test that batches loaded with another AGGREGATION_MODE still reach the persisted activity"""
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            for mode, batch in (('incremental', self.sessions.iloc[:3]), ('pandas', self.sessions.iloc[3:]),
+                                ('incremental', self.sessions.iloc[:0])):
+                with patch.dict(os.environ, {'AGGREGATION_MODE': mode}):
+                    activity = engagement_activity(batch, batch)
+        windows = sliding_window_metrics(activity)
+        
+        u001 = windows.loc['U001']
+        self.assertEqual((u001['sessions_7d'], u001['sessions_30d'], u001['sessions_90d']), (1, 2, 2))
+        self.assertEqual(u001['minutes_30d'], 105)
+
+class TestCohortRetention(unittest.TestCase):
+    """Test cohort assignment, retention matrix and retained flag"""
+    
+    def setUp(self):
+        """Set up users and two batches of sessions"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.users = pd.DataFrame({
+            'user_id': ['U001', 'U002', 'U003', 'U004'],
+            'registration_date': ['2023-01-02', '2023-01-04', None, '2023-01-09'],
+        })
+        self.sessions = pd.DataFrame({
+            'session_id': ['S001', 'S002', 'S003', 'S004', 'S005', 'S006', 'S007'],
+            'user_id': ['U001', 'U001', 'U002', 'U003', 'U001', 'U003', 'U003'],
+            'watch_date': ['2023-01-03', '2023-01-05', '2023-01-10', '2023-01-11', '2023-02-01', '2023-02-08', '2023-02-09'],
+        })
+    
+    def tearDown(self):
+        """Clean up test data"""
+        import shutil
+        shutil.rmtree(self.temp_dir)
+    
+    def test_incremental_matrix_and_retained_flag(self):
+        """Test that new weeks extend the matrix and set the retained flag"""
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            update_user_active_weeks(self.sessions.iloc[:4])
+            weeks = update_user_active_weeks(self.sessions.iloc[4:])
+        cohorts = assign_cohorts(self.users, weeks)
+        matrix, retained = cohort_retention(weeks, cohorts, min_weeks=4)
+        
+        self.assertEqual(cohorts['U003'], pd.Timestamp('2023-01-09'))  # first session week
+        cells = matrix.set_index(['cohort_week', 'week_offset'])
+        jan2 = pd.Timestamp('2023-01-02')
+        self.assertEqual(cells.loc[(jan2, 0), 'active_users'], 1)  # U001
+        self.assertEqual(cells.loc[(jan2, 1), 'active_users'], 1)  # U002
+        self.assertEqual(cells.loc[(jan2, 0), 'cohort_size'], 2)
+        self.assertAlmostEqual(cells.loc[(pd.Timestamp('2023-01-09'), 4), 'retention_rate'], 0.5)  # U003 of U003, U004
+        self.assertEqual(retained.to_dict(), {'U001': 1, 'U002': 0, 'U004': 0, 'U003': 1})
+
+class TestContentAggregation(unittest.TestCase):
+    """Test the content-level aggregate tables"""
+    
+    def setUp(self):
+        """Set up sessions and catalog"""
+        self.temp_dir = tempfile.mkdtemp()
+        self.sessions = pd.DataFrame({
+            'session_id': ['S001', 'S002', 'S003', 'S004', 'S005', 'S006'],
+            'user_id': ['U001', 'U001', 'U002', 'U002', 'U003', 'U001'],
+            'content_id': ['C001', 'C002', 'C001', 'C003', 'C002', 'C001'],
+            'duration_watched': [60, 90, 45, 120, np.nan, 30],
+            'completion_rate': [80.0, 90.0, 60.0, 100.0, 85.0, 40.0],
+        })
+        self.content = pd.DataFrame({
+            'content_id': ['C001', 'C002', 'C003'],
+            'title': ['Movie A', 'Series B', 'Movie C'],
+            'genre': ['Drama', 'Comedy', 'Drama'],
+            'content_type': ['Movie', 'Series', 'Movie'],
+        })
+    
+    def tearDown(self):
+        """Clean up test data"""
+        import shutil
+        shutil.rmtree(self.temp_dir)
+    
+    def test_incremental_title_and_genre_metrics(self):
+        """Test that folded batches give per-title and per-genre metrics"""
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            update_content_statistics(self.sessions.iloc[:4])
+            stats = update_content_statistics(self.sessions.iloc[4:])
+        by_title, by_genre = aggregate_content_metrics(stats, self.content, UserContentSets.from_frame(self.sessions))
+        
+        expected = self.sessions.groupby('content_id').agg(
+            sessions_count=('session_id', 'count'), unique_viewers=('user_id', 'nunique'),
+            avg_duration=('duration_watched', 'mean'), completion_std=('completion_rate', 'std'),
+        )
+        result = by_title.set_index('content_id').loc[expected.index]
+        pd.testing.assert_frame_equal(result[expected.columns], expected, check_dtype=False)
+        self.assertEqual(by_title['content_id'].iloc[0], 'C001')  # most sessions
+        
+        drama = by_genre.set_index('genre').loc['Drama']
+        self.assertEqual(drama['sessions_count'], 4)
+        self.assertEqual(drama['unique_viewers'], 2)  # U001 and U002
+        self.assertAlmostEqual(drama['avg_completion'], 70.0)
+    
+    def test_list_valued_genres(self):
+        """Test that titles with a list of genres count in each of them"""
+        content = self.content.astype({'genre': object})
+        content.at[0, 'genre'] = ['Drama', 'Thriller']
+        content.at[1, 'genre'] = []
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            stats = update_content_statistics(self.sessions)
+        by_title, by_genre = aggregate_content_metrics(stats, content, UserContentSets.from_frame(self.sessions))
+        
+        self.assertEqual(by_title.set_index('content_id').loc['C001', 'genre'], 'Drama|Thriller')
+        by_genre = by_genre.set_index('genre')
+        self.assertEqual(by_genre.loc['Drama', 'sessions_count'], 4)
+        self.assertEqual(by_genre.loc['Drama', 'unique_viewers'], 2)
+        self.assertEqual(by_genre.loc['Thriller', 'sessions_count'], 3)
+        self.assertEqual(by_genre.loc['Thriller', 'unique_viewers'], 2)  # U001 and U002
+        self.assertEqual(by_genre.loc['Unknown', 'unique_viewers'], 2)  # C002: U001 and U003
+    
+    def test_viewers_cover_all_batches(self):
+        """Test that distinct viewers come from cumulative sets, like the statistics"""
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            update_content_statistics(self.sessions.iloc[:3])
+            update_user_aggregate_store(self.sessions.iloc[:3])
+            stats = update_content_statistics(self.sessions.iloc[3:])
+            update_user_aggregate_store(self.sessions.iloc[3:])
+            sets = load_user_content_sets()
+        by_title, _ = aggregate_content_metrics(stats, self.content, sets)
+        
+        viewers = by_title.set_index('content_id')['unique_viewers']
+        self.assertEqual(viewers.to_dict(), self.sessions.groupby('content_id')['user_id'].nunique().to_dict())
+
+class TestContentSimilarity(unittest.TestCase):
+    """Test the sparse user x content matrix and co-viewing neighbours"""
+    
+    def setUp(self):
+        """Set up sessions with two groups of co-viewed titles"""
+        self.sessions = pd.DataFrame({
+            'user_id': ['U1', 'U1', 'U1', 'U2', 'U2', 'U3', 'U3', 'U4', 'U4', 'U5'],
+            'content_id': ['C1', 'C2', 'C1', 'C1', 'C2', 'C3', 'C4', 'C3', 'C4', 'C5'],
+            'duration_watched': [10, 20, 30, 40, 40, 5, 5, 10, 20, 50],
+            'completion_rate': [50, 100, 70, 80, 90, 10, 20, 30, 40, 100],
+        })
+    
+    def test_matrix_values(self):
+        """Test summed watch time and averaged completion per user/content pair"""
+        duration, users, contents = user_content_matrix(self.sessions, 'duration')
+        completion, _, _ = user_content_matrix(self.sessions, 'completion')
+        
+        self.assertEqual(duration.shape, (5, 5))
+        self.assertEqual(duration.nnz, 9)
+        self.assertEqual(duration[users.get_loc('U1'), contents.get_loc('C1')], 40)
+        self.assertEqual(completion[users.get_loc('U1'), contents.get_loc('C1')], 60)
+    
+    def test_top_k_matches_dense_cosine(self):
+        """Test that blocked sparse products give the dense cosine neighbours, co-viewed titles only"""
+        matrix, _, contents = user_content_matrix(self.sessions, 'duration')
+        similar = content_similarity(matrix, contents, k=3, block_cells=5)
+        
+        dense = matrix.toarray()
+        norms = np.linalg.norm(dense, axis=0)
+        expected = dense[:, 0] @ dense[:, 1] / norms[0] / norms[1]
+        c1 = similar[similar['content_id'] == 'C1']
+        self.assertEqual(c1['similar_content_id'].tolist(), ['C2'])
+        self.assertAlmostEqual(c1['similarity'].iloc[0], expected)
+        self.assertEqual(c1['co_viewers'].iloc[0], 2)
+        self.assertEqual(similar[similar['content_id'] == 'C3']['similar_content_id'].tolist(), ['C4'])
+        self.assertNotIn('C5', similar['content_id'].tolist())
+        self.assertTrue((similar['content_id'] != similar['similar_content_id']).all())
+
+class TestOlapCube(unittest.TestCase):
+    """Test the precomputed country x subscription x cluster x week cube"""
+    
+    def setUp(self):
+        """Set up sessions and clustered users"""
+        self.users = pd.DataFrame({
+            'user_id': ['U001', 'U002', 'U003', 'U004'],
+            'country': ['Mexico', 'Mexico', 'Brazil', 'Brazil'],
+            'subscription_type': ['Premium', 'Basic', 'Premium', 'Basic'],
+            'cluster_kmeans': [0, 1, 0, 1],
+        })
+        self.sessions = pd.DataFrame({
+            'session_id': ['S001', 'S002', 'S003', 'S004', 'S005', 'S006'],
+            'user_id': ['U001', 'U001', 'U002', 'U003', 'U004', 'U001'],
+            'watch_date': ['2023-01-02', '2023-01-03', '2023-01-02', '2023-01-10', '2023-01-10', '2023-01-11'],
+            'duration_watched': [60, 90, 45, 120, np.nan, 30],
+            'completion_rate': [80.0, 90.0, 60.0, 100.0, 85.0, 40.0],
+        })
+    
+    def test_every_filter_combination_matches_scan(self):
+        """Test that summing cube cells reproduces a scan of the sessions"""
+        cube = build_olap_cube(self.sessions, self.users)
+        self.assertEqual(cube['grouping_id'].nunique(), 16)
+        
+        merged = self.sessions.merge(self.users, on='user_id')
+        for filters in ({}, {'country': 'Mexico'}, {'subscription_type': 'Premium', 'cluster_kmeans': 0},
+                        {'country': ['Mexico', 'Brazil'], 'subscription_type': 'Basic'}):
+            selected = merged
+            for dim, values in filters.items():
+                selected = selected[selected[dim].isin(values if isinstance(values, list) else [values])]
+            totals = query_olap_cube(cube, **filters)
+            self.assertEqual(totals['users'], selected['user_id'].nunique())
+            self.assertEqual(totals['premium_users'], selected.loc[selected['subscription_type'] == 'Premium', 'user_id'].nunique())
+            self.assertEqual(totals['sessions'], len(selected))
+            self.assertAlmostEqual(totals['duration_sum'], selected['duration_watched'].sum())
+        
+        week = query_olap_cube(cube, week=pd.Timestamp('2023-01-09'))
+        self.assertEqual((week['users'], week['sessions']), (3, 3))
+    
+    def test_sessions_count_rows_with_session_id(self):
+        """Test that cube sessions match sessions_count of the user aggregates"""
+        sessions = self.sessions.copy()
+        sessions.loc[1, 'session_id'] = None
+        cube = build_olap_cube(sessions, self.users)
+        
+        user_agg = aggregate_user_metrics(sessions.merge(self.users, on='user_id').assign(content_id='C001', age=30))
+        self.assertEqual(query_olap_cube(cube)['sessions'], user_agg['sessions_count'].sum())
+        self.assertEqual(query_olap_cube(cube, country='Mexico')['sessions'], 3)
+    
+    def test_missing_country_matches_csv_label(self):
+        """Test that missing countries get the label the dashboard reads from the CSV"""
+        users = self.users.copy()
+        users.loc[3, 'country'] = None
+        temp_dir = tempfile.mkdtemp()
+        try:
+            # Same fill as the user aggregates exported to user_aggregation_with_clusters.csv
+            users.fillna(0).to_csv(Path(temp_dir) / 'users.csv', index=False)
+            label = pd.read_csv(Path(temp_dir) / 'users.csv')['country'].iloc[3]
+        finally:
+            import shutil
+            shutil.rmtree(temp_dir)
+        
+        cube = build_olap_cube(self.sessions, users)
+        self.assertEqual(label, '0')
+        self.assertEqual(query_olap_cube(cube, country=label)['users'], 1)
 
 class TestClustering(unittest.TestCase):
     """Test clustering functionality"""
@@ -272,6 +976,344 @@ class TestClustering(unittest.TestCase):
         # Check that clusters are assigned
         self.assertTrue(result['cluster_kmeans'].notna().all())
         self.assertTrue((result['cluster_kmeans'] >= 0).all())
+    
+    def test_streaming_matches_full_kmeans(self):
+        """Test that batched MiniBatchKMeans recovers the same separated groups"""
+        rng = np.random.default_rng(0)
+        group = np.repeat([0, 1, 2], 200)
+        base = np.array([[5, 30, 10], [40, 90, 50], [80, 60, 20]])[group]
+        users = pd.DataFrame({
+            'user_id': [f'U{i:04d}' for i in range(600)],
+            'sessions_count': base[:, 0] + rng.normal(0, 1, 600),
+            'avg_duration': base[:, 1] + rng.normal(0, 1, 600),
+            'duration_std': rng.normal(10, 1, 600),
+            'avg_completion': base[:, 2] + rng.normal(0, 1, 600),
+            'completion_std': rng.normal(10, 1, 600),
+            'unique_content': base[:, 0] + rng.normal(0, 1, 600),
+            'subscription_numeric': group + 1,
+        })
+        full, _ = cluster_users(users)
+        streaming, profiles = cluster_users_streaming(users, batch_rows=64)
+        
+        self.assertEqual(len(profiles), 3)
+        self.assertEqual(pd.crosstab(full['cluster_kmeans'], streaming['cluster_kmeans']).gt(0).sum().max(), 1)
+    
+    def test_sample_fit_full_assign(self):
+        """Test that a stratified sample fit assigns every user and profiles the full population"""
+        rng = np.random.default_rng(5)
+        group = np.repeat([0, 1, 2], 400)
+        centers = rng.normal(0, 10, (3, 7))
+        columns = ['sessions_count', 'avg_duration', 'duration_std', 'avg_completion', 'completion_std', 'unique_content', 'subscription_numeric']
+        users = pd.DataFrame(centers[group] + rng.normal(0, 1, (1200, 7)), columns=columns)
+        users.insert(0, 'user_id', [f'U{i:04d}' for i in range(1200)])
+        users['subscription_type'] = np.tile(['Basic', 'Premium'], 600)
+        
+        full, _ = cluster_users(users)
+        result, profiles, info = cluster_users_sampled(users, sample_size=150, strata=['subscription_type'], chunk_rows=100)
+        
+        self.assertEqual(info['sample_rows'], 150)
+        self.assertEqual(pd.crosstab(full['cluster_kmeans'], result['cluster_kmeans']).gt(0).sum().max(), 1)
+        expected = result.groupby('cluster_kmeans')[columns].mean().round(2).reset_index()
+        pd.testing.assert_frame_equal(profiles, expected, check_dtype=False)
+        self.assertLess(abs(info['inertia_gap']), 0.2)
+    
+    def test_birch_hierarchical_segmentation(self):
+        """Test BIRCH leaves + Ward linkage recover the groups and give a dendrogram linkage"""
+        from scipy.cluster import hierarchy
+        rng = np.random.default_rng(2)
+        group = np.repeat([0, 1, 2], 300)
+        centers = rng.normal(0, 10, (3, 7))
+        columns = ['sessions_count', 'avg_duration', 'duration_std', 'avg_completion', 'completion_std', 'unique_content', 'subscription_numeric']
+        users = pd.DataFrame(centers[group] + rng.normal(0, 1, (900, 7)), columns=columns)
+        
+        labels, linkage, leaves = hierarchical_segmentation(users, 3, threshold=0.5, batch_rows=128)
+        
+        self.assertEqual(len(labels), 900)
+        self.assertEqual(pd.crosstab(group, labels.to_numpy()).gt(0).sum().max(), 1)
+        self.assertEqual(leaves['users'].sum(), 900)
+        self.assertEqual(linkage.shape, (len(leaves) - 1, 4))
+        self.assertTrue(hierarchy.is_valid_linkage(linkage))
+    
+    def test_select_n_clusters(self):
+        """Test that parallel k selection scores every k on one sample and picks the true k"""
+        rng = np.random.default_rng(3)
+        group = np.repeat([0, 1, 2, 3], 60)
+        centers = rng.normal(0, 10, (4, 7))
+        columns = ['sessions_count', 'avg_duration', 'duration_std', 'avg_completion', 'completion_std', 'unique_content', 'subscription_numeric']
+        users = pd.DataFrame(centers[group] + rng.normal(0, 1, (240, 7)), columns=columns)
+        
+        best_k, scores = select_n_clusters(users, [2, 3, 4, 5], sample_size=100, workers=2)
+        serial_k, serial_scores = select_n_clusters(users, [2, 3, 4, 5], sample_size=100, workers=1)
+        
+        self.assertEqual(best_k, 4)
+        self.assertEqual(scores['k'].tolist(), [2, 3, 4, 5])
+        self.assertTrue((scores['sample_rows'] == 100).all())
+        self.assertEqual(scores.loc[scores['selected'], 'k'].tolist(), [4])
+        pd.testing.assert_frame_equal(scores, serial_scores)
+    
+    def test_persisted_model_predicts_changed_users_and_refits_on_drift(self):
+        """Test the predict-only path, stable ids after refit and the drift trigger"""
+        rng = np.random.default_rng(1)
+        group = np.repeat([0, 1, 2], 100)
+        centers = rng.normal(0, 10, (3, 7))
+        columns = ['sessions_count', 'avg_duration', 'duration_std', 'avg_completion', 'completion_std', 'unique_content', 'subscription_numeric']
+        users = pd.DataFrame(centers[group] + rng.normal(0, 1, (300, 7)), columns=columns)
+        users.insert(0, 'user_id', [f'U{i:04d}' for i in range(300)])
+        temp_dir = tempfile.mkdtemp()
+        try:
+            with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(temp_dir)):
+                first, _, info = cluster_users_incremental(users)
+                self.assertEqual(info['refit'], 'initial')
+                
+                changed = users.copy()
+                changed.loc[:4, 'avg_duration'] += 0.01
+                second, _, info = cluster_users_incremental(changed)
+                self.assertEqual((info['predicted_users'], info['refit']), (5, ''))
+                self.assertTrue((first['cluster_kmeans'] == second['cluster_kmeans']).all())
+                
+                drifted = users.copy()
+                drifted.loc[group == 0, columns] += 3
+                third, _, info = cluster_users_incremental(drifted)
+                self.assertEqual(info['refit'], 'inertia')
+                self.assertTrue((first['cluster_kmeans'] == third['cluster_kmeans']).all())  # ids aligned
+        finally:
+            import shutil
+            shutil.rmtree(temp_dir)
+
+class TestSimilarUsersIndex(unittest.TestCase):
+    """Test the LSH similar-users index"""
+    
+    def setUp(self):
+        """Set up clustered users"""
+        rng = np.random.default_rng(8)
+        group = rng.integers(0, 10, 3000)
+        centers = rng.normal(0, 3, (10, 7))
+        columns = ['sessions_count', 'avg_duration', 'duration_std', 'avg_completion', 'completion_std', 'unique_content', 'subscription_numeric']
+        self.users = pd.DataFrame(centers[group] + rng.normal(0, 1, (3000, 7)), columns=columns)
+        self.users.insert(0, 'user_id', [f'U{i:04d}' for i in range(3000)])
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        """Clean up the state directory"""
+        import shutil
+        shutil.rmtree(self.temp_dir)
+    
+    def test_recall_against_full_scan(self):
+        """Test that bucket candidates recover most exact nearest neighbours"""
+        index = SimilarUsersIndex.build(self.users, bucket=128)
+        recall = []
+        for row in range(0, 3000, 150):
+            distances = ((index.vectors - index.vectors[row]) ** 2).sum(axis=1)
+            distances[row] = np.inf
+            exact = set(self.users['user_id'].to_numpy()[np.argsort(distances)[:10]])
+            found = index.query(self.users['user_id'][row], 10)
+            self.assertEqual(len(found), 10)
+            self.assertNotIn(self.users['user_id'][row], found['user_id'].tolist())
+            self.assertTrue(found['distance'].is_monotonic_increasing)
+            recall.append(len(exact & set(found['user_id'])) / 10)
+        self.assertGreater(np.mean(recall), 0.8)
+    
+    def test_persisted_index_updates_changed_users_only(self):
+        """Test that a rerun re-projects only new or changed users and drops missing ones"""
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            index, info = update_similar_users_index(self.users)
+            self.assertTrue(info['rebuilt'])
+            changed = self.users.iloc[5:].copy()
+            changed.loc[5:9, 'avg_duration'] += 2
+            changed = pd.concat([changed, self.users.iloc[10:11].assign(user_id='U9999')], ignore_index=True)
+            updated, info = update_similar_users_index(changed)
+        
+        self.assertEqual((info['rebuilt'], info['updated_users']), (False, 6))
+        self.assertEqual(len(updated), 3000 - 5 + 1)
+        self.assertEqual(updated.query('U9999', 1)['user_id'].iloc[0], 'U0010')
+        np.testing.assert_array_equal(updated.vectors[-1], index.vectors[10])
+    
+    def test_dropped_users_are_persisted_with_typed_ids(self):
+        """Test that dropping users alone rewrites the index and integer ids stay integers"""
+        users = self.users.assign(user_id=np.arange(3000))
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            update_similar_users_index(users)
+            _, info = update_similar_users_index(users.iloc[100:])
+            reloaded = SimilarUsersIndex.load(Path(self.temp_dir) / 'state' / 'similar_users_index.npz')
+        
+        self.assertEqual((info['updated_users'], info['dropped_users']), (0, 100))
+        self.assertEqual(len(reloaded), 2900)
+        self.assertEqual(reloaded.users.dtype.kind, 'i')
+        self.assertTrue(np.issubdtype(reloaded.query(500, 3)['user_id'].dtype, np.integer))
+
+    def test_feature_drift_triggers_rebuild(self):
+        """Test that an update collapsing the users into few buckets refits the index"""
+        features = self.users.columns[1:]
+        drifted = self.users.copy()
+        drifted[features] = self.users[features].mean() + (self.users[features] - self.users[features].mean()) * 0.05
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            index, _ = update_similar_users_index(self.users)
+            _, stable = update_similar_users_index(self.users)
+            rebuilt, info = update_similar_users_index(drifted)
+        
+        self.assertFalse(stable['rebuilt'])
+        self.assertLessEqual(stable['drift'], 2.0)
+        self.assertTrue(info['rebuilt'])
+        self.assertGreater(info['drift'], 2.0)
+        np.testing.assert_allclose(rebuilt.scale, index.scale * 0.05)  # mean/scale refitted
+        self.assertLess(rebuilt.occupancy(), 2 * 512)
+
+class TestClusterRecommendations(unittest.TestCase):
+    """Test per-cluster top-N recommendations"""
+    
+    def setUp(self):
+        """Set up two clusters with different favourite titles"""
+        self.sessions = pd.DataFrame({
+            'user_id': ['U1', 'U1', 'U2', 'U2', 'U3', 'U4', 'U4', 'U5'],
+            'content_id': ['C1', 'C2', 'C1', 'C3', 'C2', 'C4', 'C5', 'C4'],
+            'completion_rate': [100, 50, 100, 100, 20, 100, 80, 100],
+            'watch_date': pd.to_datetime(['2024-03-01', '2024-03-01', '2024-03-01', '2024-01-31',
+                                          '2024-03-01', '2024-03-01', '2024-03-01', '2024-03-01']),
+        })
+        self.clusters = pd.DataFrame({'user_id': ['U1', 'U2', 'U3', 'U4', 'U5', 'U6'], 'cluster_kmeans': [0, 0, 0, 1, 1, 1]})
+    
+    def test_scores_weight_completion_and_recency(self):
+        """Test the completion x half-life weighting and per-cluster ranking"""
+        scores = cluster_content_scores(self.sessions, self.clusters, half_life_days=30)
+        cluster_0 = scores[scores['cluster_kmeans'] == 0].set_index('content_id')
+        
+        self.assertEqual(cluster_0.index.tolist(), ['C1', 'C2', 'C3'])
+        self.assertAlmostEqual(cluster_0.loc['C1', 'score'], 2.0)
+        self.assertAlmostEqual(cluster_0.loc['C2', 'score'], 0.7)
+        self.assertAlmostEqual(cluster_0.loc['C3', 'score'], 0.5)
+        self.assertEqual(cluster_0['rank'].tolist(), [1, 2, 3])
+    
+    def test_excludes_watched_titles(self):
+        """Test that watched titles are skipped, including users who watched the head of the list"""
+        scores = cluster_content_scores(self.sessions, self.clusters)
+        content_sets = UserContentSets.from_frame(self.sessions)
+        recommendations = recommend_for_users(scores, self.clusters, content_sets, top_n=1)
+        by_user = recommendations.set_index('user_id')['content_id'].astype(str).to_dict()
+        
+        self.assertEqual(by_user, {'U1': 'C3', 'U2': 'C2', 'U3': 'C1', 'U5': 'C5', 'U6': 'C4'})
+        self.assertNotIn('U4', by_user)
+        self.assertTrue((recommendations['rank'] == 1).all())
+    
+    def test_clusters_without_sessions_and_earlier_batches(self):
+        """Test that users of an unscored cluster get nothing and earlier watches are excluded"""
+        batch = self.sessions[self.sessions['user_id'].isin(['U1', 'U2'])]
+        clusters = pd.DataFrame({'user_id': ['U1', 'U2', 'U7'], 'cluster_kmeans': [0, 0, 2]})
+        scores = cluster_content_scores(batch, clusters)
+        earlier = pd.DataFrame({'user_id': ['U1'], 'content_id': ['C3']})
+        content_sets = UserContentSets.from_frame(pd.concat([earlier, batch[['user_id', 'content_id']]]))
+        recommendations = recommend_for_users(scores, clusters, content_sets, top_n=2)
+        
+        self.assertNotIn('U7', recommendations['user_id'].tolist())
+        self.assertEqual(recommendations[recommendations['user_id'] == 'U1']['content_id'].tolist(), [])
+        self.assertEqual(recommendations[recommendations['user_id'] == 'U2']['content_id'].astype(str).tolist(), ['C2'])
+
+class TestRetentionPrediction(unittest.TestCase):
+    """Test the cached retention model and batched churn scoring"""
+    
+    def setUp(self):
+        """Set up users whose retention depends on engagement"""
+        rng = np.random.default_rng(4)
+        n = 400
+        self.users = pd.DataFrame({
+            'user_id': [f'U{i:04d}' for i in range(n)],
+            'sessions_count': rng.integers(1, 40, n),
+            'avg_duration': rng.normal(60, 15, n),
+            'avg_completion': rng.uniform(0, 100, n),
+            'unique_content': rng.integers(1, 20, n),
+            'age': rng.integers(18, 70, n),
+            'duration_std': rng.normal(10, 2, n),
+            'completion_std': np.nan,
+            'subscription_numeric': rng.integers(1, 4, n),
+            'cluster_kmeans': rng.integers(0, 3, n),
+        })
+        self.users['retained'] = (self.users['sessions_count'] > 20).astype(int)
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        """Clean up the state directory"""
+        import shutil
+        shutil.rmtree(self.temp_dir)
+    
+    def test_trains_once_then_scores_from_cache(self):
+        """Test that the second run reuses the stored model and batching does not change scores"""
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)):
+            first, model, info = predict_retention(self.users, retrain=False, batch_rows=1000)
+            self.assertTrue(info['trained'])
+            second, _, info = predict_retention(self.users, retrain=False, batch_rows=64)
+            self.assertFalse(info['trained'])
+            self.assertEqual(info['model_version'], model.version)
+            _, _, info = predict_retention(self.users, retrain=True)
+            self.assertTrue(info['trained'])
+        
+        pd.testing.assert_series_equal(first['churn_probability'], second['churn_probability'])
+        columns = first.columns.tolist()
+        self.assertEqual(columns[columns.index('cluster_kmeans') + 1], 'churn_probability')
+        self.assertTrue(first['churn_probability'].between(0, 1).all())
+        churn = first.groupby('retained')['churn_probability'].mean()
+        self.assertLess(churn[1], churn[0])
+
+class TestFeatureImportance(unittest.TestCase):
+    """Test parallel permutation importance and its model-version cache"""
+    
+    def setUp(self):
+        """Set up users clustered on two of the features"""
+        rng = np.random.default_rng(6)
+        columns = ['sessions_count', 'avg_duration', 'duration_std', 'avg_completion', 'completion_std', 'unique_content', 'subscription_numeric']
+        self.users = pd.DataFrame(rng.normal(0, 1, (600, 7)), columns=columns)
+        self.labels = (self.users['sessions_count'] > 0).astype(int).to_numpy() + 2 * (self.users['avg_completion'] > 0).to_numpy()
+        self.temp_dir = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        """Clean up output and state"""
+        import shutil
+        shutil.rmtree(self.temp_dir)
+    
+    def test_parallel_matches_serial_and_ranks_informative_features(self):
+        """Test that shared-matrix workers give the serial result and the cluster-defining features lead"""
+        model = ClusterModel.from_labels(self.users, self.labels)
+        parallel = permutation_importance(model, self.users, self.labels, repeats=3, workers=2)
+        serial = permutation_importance(model, self.users, self.labels, repeats=3, workers=1)
+        
+        pd.testing.assert_frame_equal(parallel, serial)
+        self.assertEqual(set(parallel.index[:2]), {'sessions_count', 'avg_completion'})
+        self.assertLess(parallel['importance_mean'].iloc[2:].abs().max(), 0.05)
+    
+    def test_cached_against_model_version(self):
+        """Test the notebook CSV layout and that only a new model version recomputes"""
+        out = Path(self.temp_dir) / 'feature_importance.csv'
+        model = ClusterModel.from_labels(self.users, self.labels)
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)), \
+             patch.dict(os.environ, {'PERMUTATION_REPEATS': '2', 'IMPORTANCE_WORKERS': '1'}):
+            _, cached = cached_permutation_importance('cluster', model, self.users, self.labels, out)
+            self.assertFalse(cached)
+            _, cached = cached_permutation_importance('cluster', model, self.users, self.labels, out)
+            self.assertTrue(cached)
+            shifted = self.users.assign(avg_duration=self.users['avg_duration'] + 1)
+            _, cached = cached_permutation_importance('cluster', ClusterModel.from_labels(shifted, self.labels), shifted, self.labels, out)
+            self.assertFalse(cached)
+        
+        written = pd.read_csv(out, index_col=0)
+        self.assertEqual(written.columns.tolist(), ['0'])
+        self.assertEqual(len(written), 7)
+        self.assertTrue(written['0'].is_monotonic_decreasing)
+
+    def test_refitted_labels_cached_against_assignments(self):
+        """Test that a from_labels model refitted on moved aggregates reuses the importance of unchanged assignments"""
+        out = Path(self.temp_dir) / 'cluster_feature_importance.csv'
+        users = self.users.assign(user_id=[f'U{i:04d}' for i in range(len(self.users))])
+        shifted = users.assign(avg_duration=users['avg_duration'] + 1)
+        relabeled = self.labels.copy()
+        relabeled[0] = (relabeled[0] + 1) % 4
+        with patch('etl.etl_pipeline_enhanced.PROCESSED_PATH', Path(self.temp_dir)), \
+             patch.dict(os.environ, {'PERMUTATION_REPEATS': '2', 'IMPORTANCE_WORKERS': '1'}):
+            results = []
+            for frame, labels in ((users, self.labels), (shifted, self.labels), (shifted, relabeled)):
+                model = ClusterModel.from_labels(frame, labels)
+                _, cached = cached_permutation_importance('cluster', model, frame, labels, out,
+                                                          labels_version(frame['user_id'], labels, model.features))
+                results.append(cached)
+        
+        self.assertEqual(results, [False, True, False])
 
 class TestDataLoading(unittest.TestCase):
     """Test data loading functions"""
@@ -372,8 +1414,23 @@ def run_unit_tests():
         TestDataExtraction,
         TestDataValidation,
         TestDataTransformation,
+        TestProfileSampling,
+        TestOutlierFlags,
+        TestStreamingCorrelation,
+        TestSegmentHypothesisTests,
+        TestSessionRollups,
+        TestSkewDetection,
         TestDataAggregation,
+        TestEngagementWindows,
+        TestCohortRetention,
+        TestContentAggregation,
+        TestContentSimilarity,
+        TestOlapCube,
         TestClustering,
+        TestSimilarUsersIndex,
+        TestClusterRecommendations,
+        TestRetentionPrediction,
+        TestFeatureImportance,
         TestDataLoading,
         TestErrorHandling,
         TestPerformanceMetrics